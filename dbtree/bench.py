@@ -0,0 +1,251 @@
+import csv
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from . import sankoff, tdalp
+from .database import bulk_load, import_newick, finalize_database
+from .newick import read_newick_file
+from .vector import connection
+
+"""
+Benchmarks on synthetic data.
+
+Generates a random tree (Yule, coalescent or caterpillar) and a random
+character (categorical, scored with the sankoff model, or continuous,
+scored with the tdalp model), builds a database from them the way the
+command line tool does, and times each stage of the build and a
+recompute after a cost edit. Results are plain dicts, ready for JSON.
+"""
+
+
+TREES = ("yule", "coalescent", "caterpillar")
+CHARACTERS = ("categorical", "continuous")
+
+
+def yule_tree(ntip, rng):
+    """
+    Return (parent, brlen) lists of a pure-birth tree with unit rate.
+    Node 0 is the root, with parent -1.
+    """
+    parent = [-1]
+    birth = [0.0]
+    end = [0.0]
+    active = [0]
+    t = 0.0
+    for _ in range(ntip - 1):
+        t += rng.expovariate(len(active))
+        i = rng.randrange(len(active))
+        p = active[i]
+        end[p] = t
+        q = len(parent)
+        parent += [p, p]
+        birth += [t, t]
+        end += [0.0, 0.0]
+        active[i] = q
+        active.append(q + 1)
+    t += rng.expovariate(len(active))
+    for i in active:
+        end[i] = t
+    return parent, [e - b for b, e in zip(birth, end)]
+
+
+def coalescent_tree(ntip, rng):
+    """
+    Return (parent, brlen) lists of a Kingman coalescent tree with unit
+    rate per pair of lineages. The last node is the root.
+    """
+    parent = [-1] * ntip
+    height = [0.0] * ntip
+    active = list(range(ntip))
+    t = 0.0
+    while len(active) > 1:
+        m = len(active)
+        t += rng.expovariate(m * (m - 1) / 2)
+        i = rng.randrange(m)
+        j = rng.randrange(m - 1)
+        if j >= i:
+            j += 1
+        q = len(parent)
+        parent.append(-1)
+        height.append(t)
+        parent[active[i]] = parent[active[j]] = q
+        for k in sorted((i, j), reverse=True):
+            active[k] = active[-1]
+            active.pop()
+        active.append(q)
+    return parent, [0.0 if p == -1 else height[p] - h
+        for p, h in zip(parent, height)]
+
+
+def caterpillar_tree(ntip, rng=None):
+    """
+    Return (parent, brlen) lists of a fully unbalanced tree with unit
+    branch lengths. Node 0 is the root.
+    """
+    parent = [-1]
+    p = 0
+    for _ in range(ntip - 2):
+        parent += [p, p]
+        p = len(parent) - 1
+    parent += [p, p]
+    return parent, [0.0] + [1.0] * (len(parent) - 1)
+
+
+def write_newick(parent, brlen, f):
+    """
+    Write the tree given by parent and brlen lists to the file object f,
+    labelling the tips t1, t2, ... in the order written. Returns the
+    number of tips.
+    """
+    children = [[] for _ in parent]
+    for i, p in enumerate(parent):
+        if p == -1:
+            root = i
+        else:
+            children[p].append(i)
+    out = []
+    ntip = 0
+    stack = [(root, 0)]
+    while stack:
+        node, k = stack.pop()
+        kids = children[node]
+        if k < len(kids):
+            out.append("," if k else "(")
+            stack.append((node, k + 1))
+            stack.append((kids[k], 0))
+            continue
+        if kids:
+            out.append(")")
+        else:
+            ntip += 1
+            out.append(f"t{ntip}")
+        if node != root:
+            out.append(f":{brlen[node]:.6g}")
+        if len(out) > 65536:
+            f.write("".join(out))
+            out = []
+    out.append(";\n")
+    f.write("".join(out))
+    return ntip
+
+
+def write_chars(ntip, character, nstates, rng, f):
+    """
+    Write a random state for each of the tips t1..tntip as CSV: one of
+    nstates labels s1, s2, ... if character is categorical, or a
+    lognormal value if it is continuous.
+    """
+    writer = csv.writer(f)
+    for i in range(1, ntip + 1):
+        if character == "categorical":
+            writer.writerow((f"t{i}", f"s{rng.randrange(nstates) + 1}"))
+        else:
+            writer.writerow((f"t{i}", repr(rng.lognormvariate(0, 1))))
+
+
+def generate(tree, ntip, character, nstates, seed, directory):
+    """
+    Write a random tree and character to tree.tre and chars.csv in
+    directory and return their paths.
+    """
+    if ntip < 2:
+        raise Exception("a tree needs at least 2 tips")
+    if tree not in TREES:
+        raise Exception(f"unknown tree model: {tree}")
+    if character not in CHARACTERS:
+        raise Exception(f"unknown character type: {character}")
+    rng = random.Random(seed)
+    make = {"yule": yule_tree, "coalescent": coalescent_tree,
+        "caterpillar": caterpillar_tree}[tree]
+    treefile = os.path.join(directory, "tree.tre")
+    charfile = os.path.join(directory, "chars.csv")
+    with open(treefile, "w") as f:
+        write_newick(*make(ntip, rng), f)
+    with open(charfile, "w", newline="") as f:
+        write_chars(ntip, character, nstates, rng, f)
+    return treefile, charfile
+
+
+@contextmanager
+def stage(times, name):
+    t = time.perf_counter()
+    yield
+    times[name] = time.perf_counter() - t
+
+
+def run(tree="yule", ntip=1000, character="categorical", nstates=4,
+        engine="sql", storage="json", seed=1, directory=None):
+    """
+    Build a database from a random tree and character and return a dict
+    describing the run, with the seconds taken by each stage in "stages".
+    An error in any stage is reported under "error" rather than raised, so
+    that one failing configuration does not end a series of runs.
+    """
+    result = {
+        "tree": tree, "tips": ntip, "character": character,
+        "states": nstates, "engine": engine, "storage": storage,
+        "seed": seed, "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version, "stages": {}}
+    times = result["stages"]
+    model = sankoff if character == "categorical" else tdalp
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        database = os.path.join(tmp, "bench.db")
+        try:
+            with stage(times, "generate"):
+                treefile, charfile = generate(
+                    tree, ntip, character, nstates, seed, tmp)
+            with stage(times, "read_newick_file"):
+                read_newick_file(treefile, arrays=True)
+            with bulk_load(database) as db:
+                model.create_database(db)
+                with stage(times, "import_newick"):
+                    import_newick(treefile, db)
+                if model is sankoff:
+                    with stage(times, "import_chars"):
+                        sankoff.import_chars(charfile, db)
+                    with stage(times, "import_costs"):
+                        sankoff.import_costs(None, db)
+                else:
+                    # the single pass the tdalp command runs, which cuts
+                    # the bins and imports the values together
+                    with stage(times, "import_data"):
+                        tdalp.import_data(None, nstates, 1, charfile, db)
+                with stage(times, "finalize_database"):
+                    finalize_database(db, storage)
+                with stage(times, "compute_parsimony_scores"):
+                    model.finalize_database(db, engine)
+            with connection(database) as db:
+                with stage(times, "recompute"):
+                    if model is sankoff:
+                        db.execute(
+                            "UPDATE cost SET cost = 2 WHERE i = 1 AND j = 2")
+                    else:
+                        db.execute("UPDATE asymmetry SET l = 2")
+                result["score"], = db.execute(
+                    "SELECT sum(score) FROM score").fetchone()
+            result["size"] = os.path.getsize(database)
+        except Exception as err:
+            result["error"] = str(err)
+    result["total"] = sum(
+        t for name, t in times.items() if name != "generate")
+    return result
+
+
+def bench(trees=("yule",), tips=(1000,), characters=("categorical",),
+        nstates=4, engines=("sql",), storages=("json",), seed=1,
+        directory=None):
+    """
+    Yield the result of run() for every combination of the given tree
+    models, tree sizes, character types, engines and storages.
+    """
+    for tree in trees:
+        for ntip in tips:
+            for character in characters:
+                for engine in engines:
+                    for storage in storages:
+                        yield run(tree, ntip, character, nstates, engine,
+                            storage, seed, directory)
@@ -1,22 +1,39 @@
+import asyncio
+import json
 import os
 import click
+from . import bench as benchmarks
 from .database import (
+    bulk_load,
     import_newick,
     finalize_database,
     compute_parsimony_scores
 )
 
+from .matrix import (
+    is_matrix,
+    compute_parsimony_scores as compute_matrix_scores
+)
+
+from .profiling import Profiler
+from .resample import DELETE, resample as resample_matrix
+from .results import CHUNK, export as export_results
+from .search import search as search_tree
+from .serve import serve as serve_database
+from .sweep import sweep_asymmetry, sweep_costfiles
+
 from .sankoff import (
     create_database as sankoff_create_database,
     import_chars as sankoff_import_chars,
     import_costs as sankoff_import_costs,
+    import_matrix as sankoff_import_matrix,
     finalize_database as sankoff_finalize_database,
 )
 
 from .tdalp import (
     create_database as tdalp_create_database,
-    import_chars as tdalp_import_chars,
-    import_costs as tdalp_import_costs,
+    import_data as tdalp_import_data,
+    import_matrix as tdalp_import_matrix,
     finalize_database as tdalp_finalize_database,
 )
 
@@ -28,47 +45,296 @@ def cli():
 @cli.command()
 @click.option("-treefile", required=True,
     type=click.Path(exists=True, dir_okay=False),
-    help="Newick format phylogeny.")
+    help="Newick or NEXUS file of one or more phylogenies.")
 @click.option("-charfile", required=True,
     type=click.Path(exists=True, dir_okay=False),
-    help="Character state data.")
+    help="Character state data, or a character matrix with a header row.")
 @click.option("-costfile", type=click.Path(exists=True, dir_okay=False),
     help="State-to-state transition cost matrix.")
+@click.option("-sparse", is_flag=True,
+    help="Transitions missing from -costfile cost max_cost rather than "
+        "being disallowed.")
+@click.option("-engine", type=click.Choice(["sql", "native"]), default="sql",
+    help="Compute the downpass and uppass with SQL triggers or natively.",
+    show_default=True)
+@click.option("-storage", type=click.Choice(["json", "blob"]), default="json",
+    help="Store cost vectors as JSON text or packed float64 BLOBs.",
+    show_default=True)
+@click.option("-jobs", type=int, default=1,
+    help="Number of worker processes used to score a character matrix.",
+    show_default=True)
+@click.option("-profile", is_flag=True,
+    help="Time each stage, write the timings to the _profile table and "
+        "print a summary.")
 @click.argument("database", type=click.Path(exists=False, dir_okay=False))
-def sankoff(treefile, charfile, costfile, database):
+def sankoff(treefile, charfile, costfile, sparse, engine, storage, jobs,
+        profile, database):
     if os.path.exists(database):
         click.UsageError("database already exists.")
-    sankoff_create_database(database)
-    import_newick(treefile, database)
-    sankoff_import_chars(charfile, database)
-    sankoff_import_costs(costfile, database)
-    finalize_database(database)
-    sankoff_finalize_database(database)
+    with bulk_load(database) as db:
+        profiler = Profiler(db, profile)
+        with profiler.stage("create_database"):
+            sankoff_create_database(db)
+        with profiler.stage("import_newick"):
+            import_newick(treefile, db)
+        if is_matrix(charfile):
+            with profiler.stage("import_matrix"):
+                sankoff_import_matrix(charfile, costfile, db, sparse)
+            with profiler.stage("compute_parsimony_scores"):
+                compute_matrix_scores(db, jobs)
+        else:
+            with profiler.stage("import_chars"):
+                sankoff_import_chars(charfile, db)
+            with profiler.stage("import_costs"):
+                sankoff_import_costs(costfile, db, sparse)
+            with profiler.stage("finalize_database"):
+                finalize_database(db, storage)
+            with profiler.stage("compute_parsimony_scores"):
+                sankoff_finalize_database(db, engine)
+        profiler.save()
+        profiler.report()
 
 
 @cli.command()
 @click.option("-treefile", required=True,
     type=click.Path(exists=True, dir_okay=False),
-    help="Newick format phylogeny.")
+    help="Newick or NEXUS file of one or more phylogenies.")
 @click.option("-charfile", required=True,
     type=click.Path(exists=True, dir_okay=False),
-    help="Character state data.")
+    help="Character state data, or a character matrix with a header row.")
 @click.option("-nbreaks", type=int, default=4,
     help="Cut continuous character values into this number of groups.",
     show_default=True)
 @click.option("-brksfile", type=click.Path(exists=True, dir_okay=False),
     help="User-supplied breaks for cutting character values.")
 @click.option("-asymmetry", type=float, default=1, help="Asymmetry parameter.")
+@click.option("-engine", type=click.Choice(["sql", "native"]), default="sql",
+    help="Compute the downpass and uppass with SQL triggers or natively.",
+    show_default=True)
+@click.option("-storage", type=click.Choice(["json", "blob"]), default="json",
+    help="Store cost vectors as JSON text or packed float64 BLOBs.",
+    show_default=True)
+@click.option("-jobs", type=int, default=1,
+    help="Number of worker processes used to score a character matrix.",
+    show_default=True)
+@click.option("-profile", is_flag=True,
+    help="Time each stage, write the timings to the _profile table and "
+        "print a summary.")
 @click.argument("database", type=click.Path(exists=False, dir_okay=False))
-def tdalp(treefile, charfile, nbreaks, brksfile, asymmetry, database):
+def tdalp(treefile, charfile, nbreaks, brksfile, asymmetry, engine, storage,
+        jobs, profile, database):
     if os.path.exists(database):
         click.UsageError("database already exists.")
-    tdalp_create_database(database)
-    import_newick(treefile, database)
+    with bulk_load(database) as db:
+        profiler = Profiler(db, profile)
+        with profiler.stage("create_database"):
+            tdalp_create_database(db)
+        with profiler.stage("import_newick"):
+            import_newick(treefile, db)
+        if is_matrix(charfile):
+            with profiler.stage("import_matrix"):
+                try:
+                    tdalp_import_matrix(brksfile, nbreaks, asymmetry, charfile,
+                        db)
+                except Exception as err:
+                    raise click.UsageError(str(err))
+            with profiler.stage("compute_parsimony_scores"):
+                compute_matrix_scores(db, jobs)
+        else:
+            with profiler.stage("import_data"):
+                try:
+                    tdalp_import_data(brksfile, nbreaks, asymmetry, charfile,
+                        db)
+                except Exception as err:
+                    raise click.UsageError(str(err))
+            with profiler.stage("finalize_database"):
+                finalize_database(db, storage)
+            with profiler.stage("compute_parsimony_scores"):
+                tdalp_finalize_database(db, engine)
+        profiler.save()
+        profiler.report()
+
+
+@cli.command()
+@click.option("-asymmetry", type=float, multiple=True,
+    help="Asymmetry parameter to evaluate a tdalp database at. Repeatable.")
+@click.option("-grid", type=(float, float, int), default=None,
+    metavar="START STOP NUM",
+    help="Evaluate a tdalp database at NUM evenly spaced asymmetry values.")
+@click.option("-costfile", multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Cost matrix to evaluate a sankoff database with. Repeatable.")
+@click.option("-jobs", type=int, default=1,
+    help="Number of worker processes.", show_default=True)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def sweep(asymmetry, grid, costfile, jobs, database):
+    """
+    Evaluate a database under several cost matrices. The results are
+    stored in the sweep_result table (summarized by sweep_score).
+    """
+    values = list(asymmetry)
+    if any(a <= 0 for a in values):
+        raise click.UsageError("asymmetry values must be positive.")
+    if grid is not None:
+        start, stop, num = grid
+        if num < 1:
+            raise click.UsageError("grid needs at least one value.")
+        if start <= 0 or stop <= 0:
+            raise click.UsageError("grid values must be positive.")
+        step = (stop - start) / (num - 1) if num > 1 else 0
+        values.extend(start + i * step for i in range(num))
+    if values and costfile:
+        raise click.UsageError(
+            "give either asymmetry values or cost files, not both.")
+    if values:
+        sweep_asymmetry(database, values, jobs)
+    elif costfile:
+        sweep_costfiles(database, costfile, jobs)
+    else:
+        raise click.UsageError("nothing to evaluate.")
+
+
+@cli.command()
+@click.option("-method", type=click.Choice(["bootstrap", "jackknife"]),
+    default="bootstrap", help="How to resample the characters.",
+    show_default=True)
+@click.option("-replicates", type=int, default=1000,
+    help="Number of pseudo-replicate matrices.", show_default=True)
+@click.option("-seed", type=int, default=1, help="Random seed.",
+    show_default=True)
+@click.option("-delete", type=float, default=DELETE,
+    help="Probability that a jackknife replicate deletes a character.  "
+        "[default: 1/e]")
+@click.option("-jobs", type=int, default=1,
+    help="Number of worker processes.", show_default=True)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def resample(method, replicates, seed, delete, jobs, database):
+    """
+    Estimate the support of each tree of a character matrix database by
+    bootstrap or jackknife resampling of its characters. The summary is
+    stored in the resample_support table.
+    """
+    if replicates < 1:
+        raise click.UsageError("replicates must be at least 1.")
+    if not 0 <= delete < 1:
+        raise click.UsageError("delete must be at least 0 and less than 1.")
+    for tree, score, support, mean, sd in resample_matrix(database, method,
+            replicates, seed, delete, jobs):
+        click.echo(f"tree {tree}\tscore {score:g}\tsupport {support:.3f}\t"
+            f"mean {mean:g}\tsd {sd:g}")
+
+
+@cli.command()
+@click.option("-format", "format_", type=click.Choice(["csv", "parquet"]),
+    default=None,
+    help="Output format.  [default: from the extension of OUTPUT, else csv]")
+@click.option("-chunk", type=int, default=CHUNK,
+    help="Rows read and written at a time.", show_default=True)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False))
+def export(format_, chunk, database, output):
+    """
+    Write the downpass and uppass costs of every node of every tree to a
+    CSV or Parquet file, one row per node and one column per state.
+    """
+    if chunk < 1:
+        raise click.UsageError("chunk must be at least 1.")
+    nrows = export_results(database, output, format_, chunk)
+    click.echo(f"{nrows} rows written to {output}", err=True)
+
+
+@cli.command()
+@click.option("-nni", is_flag=True,
+    help="Only try nearest neighbour interchanges (SPR with radius 1).")
+@click.option("-radius", type=int, default=None,
+    help="Regraft at most this many branches from the cut.  "
+        "[default: anywhere]")
+@click.option("-tree", "tree_id", type=int, default=1,
+    help="Tree to search.", show_default=True)
+@click.option("-seconds", type=float, default=None,
+    help="Stop after this many seconds.")
+@click.option("-moves", type=int, default=None,
+    help="Stop after this many moves.")
+@click.option("-jobs", type=int, default=1,
+    help="Number of worker processes.", show_default=True)
+@click.option("-engine", type=click.Choice(["sql", "native"]), default="sql",
+    help="Recompute the downpass and uppass of the best tree with SQL "
+        "triggers or natively.", show_default=True)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def search(nni, radius, tree_id, seconds, moves, jobs, engine, database):
+    """
+    Improve a tree of a finished database by SPR (or NNI) moves under its
+    cost matrix, and write the best tree found back to the node table.
+    """
+    if nni:
+        if radius not in (None, 1):
+            raise click.UsageError("give either -nni or -radius, not both.")
+        radius = 1
+    if radius is not None and radius < 1:
+        raise click.UsageError("radius must be at least 1.")
+    first, score, made = search_tree(database, tree_id, radius, jobs, seconds,
+        moves, engine)
+    click.echo(f"score {first} -> {score} after {made} moves", err=True)
+
+
+@cli.command()
+@click.option("-host", default="127.0.0.1", help="Address to listen on.",
+    show_default=True)
+@click.option("-port", type=int, default=8000, help="Port to listen on.",
+    show_default=True)
+@click.option("-socket", type=click.Path(dir_okay=False), default=None,
+    help="Listen on this Unix socket instead of a port.")
+@click.option("-readers", type=int, default=4,
+    help="Number of read connections.", show_default=True)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def serve(host, port, socket, readers, database):
+    """
+    Serve a finished database over HTTP: its scores and mpr rows, what-if
+    rescoring under other costs, and edits to the costs. The database is
+    switched to WAL mode.
+    """
+    if readers < 1:
+        raise click.UsageError("readers must be at least 1.")
+    where = socket or f"http://{host}:{port}"
     try:
-        tdalp_import_costs(brksfile, nbreaks, asymmetry, charfile, database)
-    except Exception as err:
-        click.UsageError(str(err))
-    tdalp_import_chars(charfile, database)
-    finalize_database(database)
-    tdalp_finalize_database(database)
+        asyncio.run(serve_database(database, host, port, socket, readers,
+            ready=lambda: click.echo(f"serving {database} on {where}", err=True)))
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+@click.option("-tree", type=click.Choice(benchmarks.TREES), multiple=True,
+    help="Random tree model. Repeatable.  [default: yule]")
+@click.option("-tips", type=int, multiple=True,
+    help="Number of tips. Repeatable.  [default: 1000]")
+@click.option("-character", type=click.Choice(benchmarks.CHARACTERS),
+    multiple=True,
+    help="Character type, scored with the sankoff (categorical) or tdalp "
+        "(continuous) model. Repeatable.  [default: categorical]")
+@click.option("-states", type=int, default=4,
+    help="Number of categories, or of bins for a continuous character.",
+    show_default=True)
+@click.option("-engine", type=click.Choice(["sql", "native"]), multiple=True,
+    help="Engine to benchmark. Repeatable.  [default: sql]")
+@click.option("-storage", type=click.Choice(["json", "blob"]), multiple=True,
+    help="Storage to benchmark. Repeatable.  [default: json]")
+@click.option("-seed", type=int, default=1, help="Random seed.",
+    show_default=True)
+@click.option("-output", type=click.File("w"), default="-",
+    help="Write the results here rather than to standard output.")
+def bench(tree, tips, character, states, engine, storage, seed, output):
+    """
+    Time each stage of building a database from random data, for every
+    combination of the given options, and write the results as JSON.
+    """
+    results = []
+    for result in benchmarks.bench(tree or ("yule",), tips or (1000,),
+            character or ("categorical",), states, engine or ("sql",),
+            storage or ("json",), seed):
+        click.echo(f"{result['tree']} {result['tips']} "
+            f"{result['character']} {result['engine']} {result['storage']}: "
+            f"{result.get('error') or '%.2fs' % result['total']}", err=True)
+        results.append(result)
+    json.dump(results, output, indent=2)
+    output.write("\n")
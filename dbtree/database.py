@@ -1,49 +1,214 @@
-import sqlite3
-from .newick import read_newick_file
-from .schema import schema2
-
-
-def finalize_database(database):
-    db = sqlite3.connect(database)
-    db.executescript(schema2)
-    db.close()
-
-
-def import_newick(newickfile, database):
-    root = read_newick_file(newickfile)
-    db = sqlite3.connect(database, isolation_level=None)
-    db.execute("BEGIN")
-    for node in root.preorder():
-        values = (node.index, node.lfidx, node.rtidx,
-                node.anc.index if node.anc else None,
-                node.brlen, node.height, node.label)
-        db.execute("INSERT INTO node VALUES (?,?,?,?,?,?,?)", values)
-    db.execute("COMMIT")
-    db.close()
-
-
-def compute_parsimony_scores(database):
-    db = sqlite3.connect(database)
-    db.executescript("""
-        DELETE FROM downpass;
-        INSERT INTO downpass(node_id,parent_id,g)
-        SELECT
-            node.id,
-            node.anc,
-            node_state.state
-        FROM node LEFT JOIN node_state ON node.id = node_state.node_id
-        ORDER BY postorder;
-
-        DELETE FROM uppass;
-        INSERT INTO uppass(node_id,parent_id,g,h)
-        SELECT
-            node_id,
-            parent_id,
-            g,
-            h
-        FROM downpass JOIN node ON node_id=id
-        ORDER BY preorder;
-        """
-    )
-    db.close()
+from contextlib import contextmanager
+from .newick import iter_newick_file
+from .node import Node
+from .schema import (
+    schema2,
+    schema2_blob,
+    compute_scores,
+    compute_scores_blob,
+    node_indexes,
+    bulk_load_pragmas
+)
+from .vector import connect, connection, dumps, is_packed, pack
+from .engine import compute_parsimony_scores as native_compute_parsimony_scores
 
+
+@contextmanager
+def bulk_load(database):
+    """
+    Yield one connection to build a new database through
+
+    Pass it in place of the database path to each stage of the build. The
+    journal is kept in memory and writes are not synced while it is open,
+    so a build interrupted by a crash must be started again.
+    """
+    with connection(database) as db:
+        db.executescript(bulk_load_pragmas)
+        yield db
+
+
+def import_leaf_states(database, packed=False):
+    """
+    Fill node_state with the cost vector of each leaf: 0 for the states
+    observed for its OTU (more than one if ambiguous) and max_cost for the
+    rest, or 0 throughout if the state is unknown. Vectors are JSON text,
+    or packed if packed is true.
+    """
+    encode = pack if packed else dumps
+    with connection(database) as db:
+        db.execute("BEGIN")
+        max_cost, = db.execute(
+            "SELECT max_cost FROM max_cost LIMIT 1").fetchone()
+        pos = {label: p for p, (label,) in enumerate(db.execute(
+            "SELECT label FROM character_states ORDER BY id"))}
+        k = len(pos)
+        observed = {}
+        for otu, state in db.execute(
+                "SELECT otu_label, state_label FROM character_state_data"):
+            observed.setdefault(otu, set()).add(pos.get(state))
+        vectors = {}
+        unknown = encode([0] * k)
+        rows = []
+        for tree_id, id, label in db.execute(
+                "SELECT tree_id, id, label FROM node WHERE preorder = postorder"):
+            states = observed.get(label)
+            if states is None or None in states:
+                rows.append((tree_id, id, unknown))
+                continue
+            states = frozenset(states)
+            vec = vectors.get(states)
+            if vec is None:
+                vec = vectors[states] = encode(
+                    [0 if i in states else max_cost for i in range(k)])
+            rows.append((tree_id, id, vec))
+        db.executemany(
+            "INSERT INTO node_state(tree_id,node_id,state) VALUES (?,?,?)",
+            rows)
+        db.execute("COMMIT")
+
+
+def finalize_database(database, storage="json"):
+    with connection(database) as db:
+        db.executescript(schema2_blob if storage == "blob" else schema2)
+        import_leaf_states(db, storage == "blob")
+
+
+def import_newick(newickfile, database, arrays=True):
+    """
+    Import every tree in a Newick or NEXUS file. The trees are numbered
+    1, 2, ... in file order and each is stored under its tree_id. They are
+    parsed into compact ArrayTrees unless arrays is false.
+    """
+    with connection(database) as db:
+        db.execute("BEGIN")
+        ntree = 0
+        for tree_id, root in enumerate(iter_newick_file(newickfile, arrays), 1):
+            db.executemany("""INSERT INTO node
+                (id,preorder,postorder,anc,brlen,height,label,tree_id)
+                VALUES (?,?,?,?,?,?,?,?)""",
+                (row + (tree_id,) for row in root.rows()))
+            ntree = tree_id
+        if ntree == 0:
+            raise Exception("no tree found in Newick file")
+        db.execute("COMMIT")
+        db.executescript(node_indexes)
+
+
+def read_tree(database, tree_id=1):
+    """
+    Return the root of a tree of the database as Nodes, with the ids,
+    preorder/postorder indices, branch lengths, heights and labels stored
+    in node
+    """
+    with connection(database) as db:
+        rows = db.execute("""
+            SELECT id, preorder, postorder, anc, brlen, height, label
+            FROM node WHERE tree_id = ? ORDER BY preorder""", (tree_id,))
+        nodes = {}
+        last = {}
+        root = None
+        for id, preorder, postorder, anc, brlen, height, label in rows:
+            node = nodes[id] = Node()
+            node.index = id
+            node.lfidx = preorder
+            node.rtidx = postorder
+            node.brlen = brlen
+            node.height = height
+            node.label = label
+            # children come in order after their parent, so link each after
+            # the last one seen rather than walk the list of siblings
+            if anc is None:
+                root = node
+                continue
+            a = nodes[anc]
+            node.anc = a
+            prev = last.get(anc)
+            if prev is None:
+                a.lfdesc = node
+            else:
+                prev.next = node
+                node.prev = prev
+            last[anc] = node
+    if root is None:
+        raise Exception(f"no tree {tree_id} in database")
+    Node.generation += 1
+    return root
+
+
+def write_tree(root, database, tree_id=1, engine="sql"):
+    """
+    Store a tree read by read_tree and then edited (with Node.ladderize,
+    rotate, swap or node.reroot, prune, regraft). Only the rows of node that
+    changed are written, and nodes no longer in the tree are deleted along
+    with their leaf states. If the shape of the tree changed, the
+    parsimony scores are recomputed with engine. Returns the number of
+    rows of node written or deleted.
+    """
+    with connection(database) as db:
+        old = {row[0]: row[1:] for row in db.execute("""
+            SELECT id, preorder, postorder, anc, brlen, height, label
+            FROM node WHERE tree_id = ?""", (tree_id,))}
+        new = {row[0]: row[1:] for row in root.rows()}
+        changed = [(id,) + row for id, row in new.items() if old.get(id) != row]
+        removed = [(tree_id, id) for id in old if id not in new]
+        reshaped = bool(removed) or any(
+            id not in old or old[id][2] != row[2] for id, row in new.items())
+        db.execute("BEGIN")
+        db.executemany("DELETE FROM node WHERE tree_id = ? AND id = ?", removed)
+        if db.execute("""SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = 'node_state'""").fetchone():
+            db.executemany(
+                "DELETE FROM node_state WHERE tree_id = ? AND node_id = ?",
+                removed)
+        # preorder and postorder are unique within a tree, so move the
+        # changed rows out of the way before numbering them afresh
+        db.executemany("""
+            UPDATE node SET preorder = -preorder, postorder = -postorder
+            WHERE tree_id = ? AND id = ?""",
+            ((tree_id, row[0]) for row in changed if row[0] in old))
+        db.executemany("""
+            UPDATE node SET preorder = ?, postorder = ?, anc = ?, brlen = ?,
+                height = ?, label = ?
+            WHERE tree_id = ? AND id = ?""",
+            (row[1:] + (tree_id, row[0]) for row in changed if row[0] in old))
+        db.executemany("""INSERT INTO node
+            (id,preorder,postorder,anc,brlen,height,label,tree_id)
+            VALUES (?,?,?,?,?,?,?,?)""",
+            (row + (tree_id,) for row in changed if row[0] not in old))
+        db.execute("COMMIT")
+        if reshaped and db.execute("""SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = 'downpass'""").fetchone():
+            compute_parsimony_scores(db, engine)
+        return len(changed) + len(removed)
+
+
+def compute_parsimony_scores(database, engine="sql"):
+    if engine == "native":
+        native_compute_parsimony_scores(database)
+        return
+    with connection(database) as db:
+        db.executescript(compute_scores_blob if is_packed(db) else compute_scores)
+
+
+@contextmanager
+def deferred_recompute(database):
+    """
+    Batch edits to the cost matrix (or asymmetry parameter)
+
+    Yields a connection inside a transaction. Edits made through it are
+    only recorded, and the downpass and uppass are recomputed once, and
+    only where an edit can change them, when the block exits.
+    """
+    db = connect(database, isolation_level=None)
+    try:
+        db.execute("BEGIN")
+        db.execute("UPDATE recompute SET deferred = 1")
+        try:
+            yield db
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("UPDATE recompute SET deferred = 0")
+        db.execute("COMMIT")
+    finally:
+        db.close()
@@ -0,0 +1,313 @@
+import json
+from math import inf as INF
+from .kernels import kernels
+from .schema import cache_store
+from .vector import connection, dumps, is_packed, pack, unpack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Native Sankoff engine.
+
+Computes the same downpass and uppass as the triggers in schema2 (or
+schema2_blob), but loads the tree, cost matrix and leaf states into
+Python lists once and bulk-writes the results, so that the mpr view works
+unchanged. With NumPy installed, the passes go a level of the tree at a
+time instead (see array_passes), as dense min-plus products over all the
+nodes of a level at once.
+"""
+
+
+# elements of the arrays made at a time by the products of array_kernels
+BLOCK = 1 << 22
+
+# the least mean number of nodes per level for which array_passes is used;
+# narrower trees (a caterpillar has one node per level) are faster node by
+# node
+WIDTH = 8
+
+
+def missing_cost(db):
+    """
+    Return the cost of a pair of states missing from the cost matrix:
+    max_cost if sparse_costs.sparse is set, else infinity.
+    """
+    cost, = db.execute("""
+        SELECT CASE WHEN sparse THEN (SELECT max_cost FROM max_cost LIMIT 1) END
+        FROM sparse_costs""").fetchone()
+    return INF if cost is None else cost
+
+
+def load_costs(db):
+    """
+    Return the min-plus products of the cost matrix for the downpass and
+    uppass (see dbtree.kernels), over the ordered list of character
+    states. Missing cells cost missing_cost(db), as in the SQL triggers.
+    """
+    ids = [i for i, in db.execute("SELECT id FROM character_states ORDER BY id")]
+    return cost_kernels(ids,
+        db.execute("SELECT i, j, cost FROM cost ORDER BY i, j").fetchall(),
+        missing_cost(db))
+
+
+def cost_kernels(ids, cells, default=INF):
+    """
+    Return the products returned by load_costs for (i, j, cost) cells,
+    where ids are the character state ids in order and missing cells cost
+    default.
+    """
+    pos = {id: p for p, id in enumerate(ids)}
+    down, up, _ = kernels(len(ids),
+        ((pos[i], pos[j], c) for i, j, c in cells), default)
+    return down, up
+
+
+def load_tree(db):
+    """
+    Return the nodes in postorder as (id, anc, g) tuples, where g is the
+    leaf state vector as stored in node_state (None for internal nodes),
+    along with the node ids in preorder. Node ids are only unique within
+    a tree, so ids here are (tree_id, node_id) pairs.
+    """
+    nodes = [((t, id), None if anc is None else (t, anc), state)
+        for t, id, anc, state in db.execute("""
+        SELECT
+            node.tree_id,
+            node.id,
+            node.anc,
+            node_state.state
+        FROM node LEFT JOIN node_state
+            ON node.tree_id = node_state.tree_id AND node.id = node_state.node_id
+        ORDER BY node.tree_id, postorder
+        """)]
+    preorder = list(db.execute(
+        "SELECT tree_id, id FROM node ORDER BY tree_id, preorder"))
+    return nodes, preorder
+
+
+def downpass(nodes, down):
+    """
+    Return dicts of node costs g and stem costs h keyed by node id.
+    """
+    g = {}
+    h = {}
+    acc = {}
+    for id, anc, state in nodes:
+        if state is None:
+            gv = acc.pop(id)
+        elif isinstance(state, bytes):
+            gv = unpack(state)
+        elif isinstance(state, str):
+            gv = json.loads(state)
+        else:
+            gv = state
+        hv = down(gv)
+        g[id] = gv
+        h[id] = hv
+        if anc is not None:
+            sv = acc.get(anc)
+            if sv is None:
+                acc[anc] = hv
+            else:
+                acc[anc] = [a + b for a, b in zip(sv, hv)]
+    return g, h
+
+
+def uppass(nodes, preorder, up, g, h):
+    """
+    Return a dict of final costs f keyed by node id.
+    """
+    anc = {id: a for id, a, _ in nodes}
+    f = {}
+    for id in preorder:
+        a = anc[id]
+        if a is None:
+            f[id] = g[id]
+            continue
+        # a state the parent cannot take stays impossible
+        d = [INF if x == INF else x - y for x, y in zip(f[a], h[id])]
+        f[id] = [x + y for x, y in zip(up(d), g[id])]
+    return f
+
+
+def load_array_costs(db):
+    """
+    Return the min-plus products of the cost matrix for array_passes, as
+    load_costs does for downpass and uppass.
+    """
+    ids = [i for i, in db.execute("SELECT id FROM character_states ORDER BY id")]
+    pos = {id: p for p, id in enumerate(ids)}
+    cells = [(pos[i], pos[j], c)
+        for i, j, c in db.execute("SELECT i, j, cost FROM cost")]
+    return array_kernels(len(ids), cells, missing_cost(db))
+
+
+def _blocks(v, width):
+    step = max(1, BLOCK // width)
+    for start in range(0, len(v), step):
+        yield slice(start, start + step)
+
+
+def _sparse(k, rows, cols, cost, default):
+    # out[n,r] is default plus the least v[n] or the least v[n,c] plus the
+    # cost of a cell (r, c), whichever is less
+    order = numpy.lexsort((cols, rows))
+    rows, cols, cost = rows[order], cols[order], cost[order]
+    starts = numpy.flatnonzero(numpy.diff(rows, prepend=-1))
+    given = rows[starts]
+
+    def product(v):
+        out = numpy.empty_like(v)
+        for b in _blocks(v, len(cost) + k):
+            o = numpy.repeat(v[b].min(axis=1, keepdims=True) + default, k, axis=1)
+            if len(cost):
+                best = numpy.minimum.reduceat(v[b][:, cols] + cost, starts, axis=1)
+                o[:, given] = numpy.minimum(o[:, given], best)
+            out[b] = o
+        return out
+    return product
+
+
+def array_kernels(k, cells, default=INF):
+    """
+    Return the products of array_passes for (i, j, cost) cells, over
+    nodes x states arrays: out[n,i] = min_j cost[i,j] + v[n,j] for the
+    downpass and out[n,j] = min_i v[n,i] + cost[i,j] for the uppass. A
+    sparse matrix whose default is no less than any of its cells takes
+    the least state of each node at the default, and then the cells given
+    one by one; any other matrix is taken as a dense one.
+    """
+    if default < INF and len(cells) < k * k and all(c <= default for _, _, c in cells):
+        i = numpy.array([i for i, _, _ in cells], dtype=int)
+        j = numpy.array([j for _, j, _ in cells], dtype=int)
+        c = numpy.array([c for _, _, c in cells], dtype=float)
+        return _sparse(k, i, j, c, default), _sparse(k, j, i, c, default)
+    m = numpy.full((k, k), default)
+    for i, j, c in cells:
+        m[i, j] = c
+
+    def down(v):
+        out = numpy.empty_like(v)
+        for b in _blocks(v, k * k):
+            out[b] = (v[b][:, None, :] + m).min(axis=2)
+        return out
+
+    def up(v):
+        out = numpy.empty_like(v)
+        for b in _blocks(v, k * k):
+            out[b] = (v[b][:, :, None] + m).min(axis=1)
+        return out
+    return down, up
+
+
+def _decode(state):
+    if isinstance(state, bytes):
+        return unpack(state)
+    if isinstance(state, str):
+        return json.loads(state)
+    return state
+
+
+def array_passes(nodes, preorder, down, up):
+    """
+    Return the same dicts as downpass and uppass, computed with NumPy a
+    level at a time: the downpass over the nodes at the same height above
+    their farthest tip, and the uppass over the nodes at the same depth, so
+    that each level is one min-plus product of a nodes x states array.
+    Returns None if the levels are too narrow to gain from it (see WIDTH).
+    """
+    n = len(nodes)
+    pos = {id: p for p, (id, _, _) in enumerate(nodes)}
+    anc = [-1 if a is None else pos[a] for _, a, _ in nodes]
+    # nodes come in postorder, so children before their parents
+    height = [0] * n
+    for p, a in enumerate(anc):
+        if a >= 0 and height[a] < height[p] + 1:
+            height[a] = height[p] + 1
+    depth = [0] * n
+    for id in preorder:
+        p = pos[id]
+        if anc[p] >= 0:
+            depth[p] = depth[anc[p]] + 1
+    nlevels = max(height, default=0) + 1
+    if n < WIDTH * nlevels:
+        return None
+    parent = numpy.array(anc)
+    leaves = {p: _decode(state) for p, (_, _, state) in enumerate(nodes)
+        if state is not None}
+    k = len(next(iter(leaves.values())))
+    g = numpy.zeros((n, k))
+    g[list(leaves)] = list(leaves.values())
+    h = numpy.empty((n, k))
+    height = numpy.array(height)
+    order = numpy.argsort(height, kind="stable")
+    bounds = numpy.searchsorted(height[order], numpy.arange(nlevels + 1))
+    for level in range(nlevels):
+        idx = order[bounds[level]:bounds[level + 1]]
+        h[idx] = down(g[idx])
+        idx = idx[parent[idx] >= 0]
+        numpy.add.at(g, parent[idx], h[idx])
+    f = numpy.empty((n, k))
+    depth = numpy.array(depth)
+    order = numpy.argsort(depth, kind="stable")
+    bounds = numpy.searchsorted(depth[order], numpy.arange(depth.max() + 2))
+    with numpy.errstate(invalid="ignore"):
+        for level in range(len(bounds) - 1):
+            idx = order[bounds[level]:bounds[level + 1]]
+            if level == 0:
+                f[idx] = g[idx]
+                continue
+            d = f[parent[idx]] - h[idx]
+            # a state the parent cannot take stays impossible
+            d[numpy.isnan(d)] = INF
+            f[idx] = up(d) + g[idx]
+    ids = [id for id, _, _ in nodes]
+    return (dict(zip(ids, g.tolist())), dict(zip(ids, h.tolist())),
+        dict(zip(ids, f.tolist())))
+
+
+def compute_parsimony_scores(database):
+    with connection(database) as db:
+        db.execute("BEGIN")
+        encode = pack if is_packed(db) else dumps
+        nodes, preorder = load_tree(db)
+        result = None
+        if numpy is not None:
+            result = array_passes(nodes, preorder, *load_array_costs(db))
+        if result is not None:
+            g, h, f = result
+        else:
+            down, up = load_costs(db)
+            g, h = downpass(nodes, down)
+            f = uppass(nodes, preorder, up, g, h)
+        gs = {id: state for id, _, state in nodes if state is not None}
+        for id in g:
+            if id not in gs:
+                gs[id] = encode(g[id])
+        hs = {id: encode(v) for id, v in h.items()}
+        anc = {id: a for id, a, _ in nodes}
+        # no trigger needs the indexes during the load, so rebuild them
+        # afterwards rather than update them row by row
+        indexes = db.execute("""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name IN ('downpass', 'uppass')
+                AND sql NOT NULL""").fetchall()
+        for name, _ in indexes:
+            db.execute(f"DROP INDEX {name}")
+        db.execute("DELETE FROM downpass")
+        db.executemany(
+            "INSERT INTO downpass(tree_id,node_id,parent_id,g,h) VALUES (?,?,?,?,?)",
+            ((id[0], id[1], a and a[1], gs[id], hs[id]) for id, a, _ in nodes))
+        db.execute("DELETE FROM uppass")
+        db.executemany(
+            "INSERT INTO uppass(tree_id,node_id,parent_id,g,h,f) VALUES (?,?,?,?,?,?)",
+            ((id[0], id[1], anc[id] and anc[id][1], gs[id], hs[id], encode(f[id]))
+                for id in preorder))
+        for _, sql in indexes:
+            db.execute(sql)
+        db.execute("DELETE FROM cost_edit")
+        db.execute("COMMIT")
+        db.executescript(cache_store)
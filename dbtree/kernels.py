@@ -0,0 +1,151 @@
+from math import inf as INF, isclose
+
+"""
+Min-plus kernels for structured cost matrices.
+
+Both passes of Sankoff's algorithm reduce to the min-plus product
+out[i] = min_j cost[i,j] + v[j], which takes O(k^2) time for k states.
+Two common cost structures admit O(k) products:
+
+uniform   every change costs the same (Fitch parsimony, the default
+          sankoff costs)
+linear    the states are ordered and a change costs the sum of the steps
+          between them, possibly different upwards and downwards
+          (Wagner and asymmetric linear parsimony, the tdalp costs)
+
+The diagonal may be anything, including missing. Pairs of states missing
+from the matrix are not allowed (infinite), or else all cost the same
+default, and a sparse matrix with a default is scored in O(k log k) plus
+the number of pairs given. kernel() picks the fastest product that the
+cost matrix admits.
+"""
+
+
+def costs(k, cells, default=INF):
+    """
+    Return (i, j, cost) cells, with i and j positions 0..k-1, as a k x k
+    list of lists with missing cells default.
+    """
+    m = [[default] * k for _ in range(k)]
+    for i, j, c in cells:
+        m[i][j] = c
+    return m
+
+
+def generic(k, cells):
+    rows = [[] for _ in range(k)]
+    for i, j, c in cells:
+        rows[i].append((j, c))
+    def product(v):
+        return [min([c + v[j] for j, c in row], default=INF) for row in rows]
+    return product
+
+
+def sparse(k, cells, default):
+    rows = [{} for _ in range(k)]
+    for i, j, c in cells:
+        rows[i][j] = c
+    def product(v):
+        # the best missing pair of row i is the first state, in order of
+        # v, that is not in the row
+        order = sorted(range(k), key=v.__getitem__)
+        out = []
+        for row in rows:
+            best = min([c + v[j] for j, c in row.items()], default=INF)
+            for j in order:
+                if j not in row:
+                    best = min(best, default + v[j])
+                    break
+            out.append(best)
+        return out
+    return product
+
+
+def is_uniform(m):
+    k = len(m)
+    off = {m[i][j] for i in range(k) for j in range(k) if i != j}
+    return len(off) <= 1 and INF not in off
+
+
+def uniform(m):
+    k = len(m)
+    diag = [m[i][i] for i in range(k)]
+    a = m[0][1] if k > 1 else INF
+    def product(v):
+        # a + min over j != i is the smallest of the other values plus a,
+        # which is the best value unless i holds it
+        best = second = INF
+        at = -1
+        for j, x in enumerate(v):
+            if x < best:
+                best, second, at = x, best, j
+            elif x < second:
+                second = x
+        return [min(d + x, (second if i == at else best) + a)
+            for i, (d, x) in enumerate(zip(diag, v))]
+    return product
+
+
+def is_linear(m):
+    k = len(m)
+    for i in range(k):
+        for j in range(i + 2, k):
+            if not isclose(m[i][j], m[i][j-1] + m[j-1][j], rel_tol=1e-9):
+                return False
+            if not isclose(m[j][i], m[j][i+1] + m[i+1][i], rel_tol=1e-9):
+                return False
+    return all(m[i][i+1] != INF and m[i+1][i] != INF for i in range(k - 1))
+
+
+def linear(m):
+    k = len(m)
+    diag = [m[i][i] for i in range(k)]
+    up = [m[i][i+1] for i in range(k - 1)]
+    down = [m[i+1][i] for i in range(k - 1)]
+    def product(v):
+        out = [d + x for d, x in zip(diag, v)]
+        # sweep down from the top for the states above i, then up from the
+        # bottom for the states below i
+        best = INF
+        for i in range(k - 2, -1, -1):
+            best = up[i] + min(v[i+1], best)
+            if best < out[i]:
+                out[i] = best
+        best = INF
+        for i in range(1, k):
+            best = down[i-1] + min(v[i-1], best)
+            if best < out[i]:
+                out[i] = best
+        return out
+    return product
+
+
+def kernel(k, cells, default=INF):
+    """
+    Return a function computing the min-plus product of the cost matrix
+    given as (i, j, cost) cells with a vector, with the name of the kernel
+    used. Missing cells cost default.
+    """
+    cells = list(cells)
+    # only test a matrix with at most the diagonal missing for structure,
+    # so that a sparse one is never expanded
+    if len(cells) >= k * (k - 1):
+        m = costs(k, cells, default)
+        if is_uniform(m):
+            return uniform(m), "uniform"
+        if is_linear(m):
+            return linear(m), "linear"
+    if default == INF:
+        return generic(k, cells), "generic"
+    return sparse(k, cells, default), "sparse"
+
+
+def kernels(k, cells, default=INF):
+    """
+    Return the kernels for the downpass, min_j cost[i,j] + v[j], and the
+    uppass, min_i v[i] + cost[i,j], along with the name of the kernel.
+    """
+    cells = list(cells)
+    down, name = kernel(k, cells, default)
+    up, _ = kernel(k, [(j, i, c) for i, j, c in cells], default)
+    return down, up, name
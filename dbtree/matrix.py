@@ -0,0 +1,179 @@
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from .engine import downpass, missing_cost, uppass
+from .kernels import kernels
+from .schema import schema_matrix
+from .vector import connection, dumps
+
+"""
+Parallel parsimony analysis of a character matrix.
+
+A character matrix is a CSV file with a header row naming the characters
+(the first header cell, above the OTU labels, is ignored) and one row per
+OTU. An empty cell or "?" is an unknown state. Each (character, tree) pair
+is scored by a worker process with the native engine and the parent
+process writes the results to character_mpr.
+"""
+
+
+def is_matrix(charfile):
+    """
+    True if charfile has more than the two columns (OTU, state) of a
+    single character.
+    """
+    with open(charfile, newline='') as f:
+        for row in csv.reader(f):
+            return len(row) > 2
+    return False
+
+
+def read_matrix(charfile):
+    """
+    Return the character labels and the rows as (otu, cells) pairs.
+    """
+    with open(charfile, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        labels = header[1:]
+        rows = []
+        for row in reader:
+            if len(row) != len(header):
+                raise Exception(
+                    f"expected {len(header)} columns in row for {row[0]}")
+            rows.append((row[0], row[1:]))
+    return labels, rows
+
+
+def is_missing(cell):
+    return cell.strip() in ("", "?")
+
+
+def create_tables(database):
+    with connection(database) as db:
+        db.executescript(schema_matrix)
+
+
+def load_trees(db):
+    """
+    Return {tree_id: (nodes, preorder)}, where nodes are (id, anc, label)
+    tuples in postorder with label None for internal nodes.
+    """
+    trees = {}
+    for t, id, anc, label, tip in db.execute("""
+            SELECT tree_id, id, anc, label, preorder = postorder
+            FROM node ORDER BY tree_id, postorder"""):
+        if t not in trees:
+            trees[t] = ([], [])
+        trees[t][0].append((id, anc, label if tip else None))
+    for t, id in db.execute("SELECT tree_id, id FROM node ORDER BY tree_id, preorder"):
+        trees[t][1].append(id)
+    return trees
+
+
+def load_characters(db):
+    """
+    Return {character_id: (k, cells, data)}, where cells are the cost
+    matrix as (i, j, cost) with i and j state positions and data maps each
+    OTU label to the set of its state positions (None if unknown).
+    """
+    characters = {}
+    for c, k in db.execute("""
+            SELECT character.id, count(character_state.id)
+            FROM character LEFT JOIN character_state
+                ON character.id = character_state.character_id
+            GROUP BY character.id"""):
+        characters[c] = (k, [], {})
+    for c, i, j, cost in db.execute(
+            "SELECT character_id, i, j, cost FROM character_cost ORDER BY character_id, i, j"):
+        characters[c][1].append((i-1, j-1, cost))
+    for c, otu, s in db.execute(
+            "SELECT character_id, otu_label, state_id FROM character_data"):
+        data = characters[c][2]
+        data.setdefault(otu, set()).add(None if s is None else s - 1)
+    return characters
+
+
+def leaf_vectors(k, data, max_cost):
+    """
+    Return the leaf state vector of each OTU of a character (see
+    load_characters): 0 for its states and max_cost for the others, or 0
+    for every state if unknown.
+    """
+    zero = [0.0] * k
+    leaves = {}
+    for label, states in data.items():
+        if None in states:
+            leaves[label] = zero
+        else:
+            leaves[label] = [0.0 if s in states else max_cost for s in range(k)]
+    return leaves
+
+
+def leaf_nodes(nodes, k, leaves):
+    """
+    Return the nodes of a tree (see load_trees) as (id, anc, g) tuples for
+    engine.downpass, with g the leaf vector of each tip (all 0 for tips
+    without data) and None for internal nodes.
+    """
+    zero = [0.0] * k
+    return [(id, anc, None if label is None else leaves.get(label, zero))
+        for id, anc, label in nodes]
+
+
+_trees = None
+_characters = None
+_max_cost = None
+_missing = None
+_kernels = {}
+
+
+def _init(trees, characters, max_cost, missing):
+    global _trees, _characters, _max_cost, _missing
+    _trees = trees
+    _characters = characters
+    _max_cost = max_cost
+    _missing = missing
+    _kernels.clear()
+
+
+def _score(task):
+    """
+    Score one character on one tree. Returns the rows for character_mpr.
+    """
+    c, t = task
+    k, cells, data = _characters[c]
+    if c not in _kernels:
+        _kernels[c] = kernels(k, cells, _missing)
+    down, up, _ = _kernels[c]
+    nodes, preorder = _trees[t]
+    nodes = leaf_nodes(nodes, k, leaf_vectors(k, data, _max_cost))
+    g, h = downpass(nodes, down)
+    f = uppass(nodes, preorder, up, g, h)
+    return [(c, t, id, dumps(g[id]), dumps(f[id])) for id in preorder]
+
+
+def compute_parsimony_scores(database, jobs=1):
+    """
+    Score every character on every tree, using jobs worker processes.
+    """
+    with connection(database) as db:
+        max_cost, = db.execute("SELECT max_cost FROM max_cost LIMIT 1").fetchone()
+        missing = missing_cost(db)
+        trees = load_trees(db)
+        characters = load_characters(db)
+        tasks = [(c, t) for c in characters for t in trees]
+        db.execute("BEGIN")
+        db.execute("DELETE FROM character_mpr")
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=_init,
+                    initargs=(trees, characters, max_cost, missing)) as pool:
+                chunksize = max(1, len(tasks) // (4 * jobs))
+                for result in pool.map(_score, tasks, chunksize=chunksize):
+                    db.executemany(
+                        "INSERT INTO character_mpr VALUES (?,?,?,?,?)", result)
+        else:
+            _init(trees, characters, max_cost, missing)
+            for result in map(_score, tasks):
+                db.executemany(
+                    "INSERT INTO character_mpr VALUES (?,?,?,?,?)", result)
+        db.execute("COMMIT")
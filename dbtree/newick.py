@@ -1,4 +1,7 @@
-from .node import Node
+import io
+import itertools
+import re
+from .node import ArrayTree, Node
 
 class Newick:
     def __init__(self, newick):
@@ -55,7 +58,9 @@ class Newick:
         return (cursor, label)
 
     @staticmethod
-    def parse(newick_string):
+    def parse(newick_string, arrays=False):
+        if arrays:
+            return parse_arrays(tokenize(io.StringIO(newick_string)))
         parser = Newick(newick_string)
         cursor = 0
         stack = 0
@@ -91,42 +96,325 @@ class Newick:
         if stack != 0:
             raise Exception(
                 "invalid Newick string: unmatched opening parenthesis")
-        for i, tip in enumerate(p.tips()):
-            tip.index = i + 1
-        ntip = i + 1
-        for i, node in enumerate(p.preorder_internal()):
-            h = node.anc.height if node.anc else 0.0
-            node.index = i + ntip + 1
-            node.height = h + node.brlen
-        for tip in p.tips():
-            tip.height = tip.anc.height + tip.brlen
-        root = p
-        idx = 1
-        while p:
-            p.lfidx = idx
-            if p.istip:
+        index_nodes(p)
+        return p
+
+
+def index_nodes(root):
+    """
+    Assign node indices, heights and preorder/postorder (nested set)
+    indices to a freshly parsed tree
+    """
+    p = root
+    for i, tip in enumerate(p.tips()):
+        tip.index = i + 1
+    ntip = i + 1
+    for i, node in enumerate(p.preorder_internal()):
+        h = node.anc.height if node.anc else 0.0
+        node.index = i + ntip + 1
+        node.height = h + node.brlen
+    for tip in p.tips():
+        tip.height = tip.anc.height + tip.brlen
+    idx = 1
+    while p:
+        p.lfidx = idx
+        if p.istip:
+            p.rtidx = idx
+        idx += 1
+        if p.lfdesc:
+            p = p.lfdesc
+        elif p.next:
+            p = p.next
+        else:
+            # on entry p is a terminal node that marks clade boundary
+            p = p.anc
+            while p.anc and not p.next:
                 p.rtidx = idx
-            idx += 1
-            if p.lfdesc:
-                p = p.lfdesc
-            elif p.next:
-                p = p.next
-            else:
-                # on entry p is a terminal node that marks clade boundary
                 p = p.anc
-                while p.anc and not p.next:
-                    p.rtidx = idx
-                    p = p.anc
-                    idx += 1
-                p.rtidx = idx
                 idx += 1
-                p = p.next
-        return root
+            p.rtidx = idx
+            idx += 1
+            p = p.next
+
+
+# token kinds other than the punctuation characters "(),;"
+NOTE, BRLEN, LABEL, SPACE = "note", "brlen", "label", "space"
+
+TOKEN = re.compile(r"""
+    ([(),;])            # 1: structure
+    |\[([^\]]*)\]       # 2: note
+    |:([^,);]*)         # 3: branch length
+    |([^\s(),:;\[\]]+)  # 4: label
+    |(\s+)              # 5: whitespace between tokens
+    """, re.VERBOSE)
 
-def read_newick_string(newick_string):
-    return Newick.parse(newick_string.strip())
 
-def read_newick_file(newick_file):
+def tokenize(f, chunksize=1 << 20):
+    """
+    Yield (kind, text) tokens from a file object, reading it incrementally
+
+    kind is the character itself for "(", ")", "," and ";", and NOTE,
+    BRLEN, LABEL or SPACE (whitespace between tokens, with text None)
+    otherwise.
+    """
+    kinds = (None, None, NOTE, BRLEN, LABEL)
+    buf = f.read(chunksize)
+    while buf:
+        more = f.read(chunksize)
+        end = len(buf)
+        pos = 0
+        for m in TOKEN.finditer(buf):
+            if m.start() != pos:
+                break
+            k = m.lastindex
+            if more and k != 1 and m.end() == end:
+                # the token may continue into the next chunk
+                break
+            pos = m.end()
+            if k == 1:
+                yield (m.group(1), None)
+            elif k == 5:
+                yield (SPACE, None)
+            else:
+                yield (kinds[k], m.group(k))
+        if pos < end and not (
+                more and (buf[pos] == "[" or TOKEN.match(buf, pos))):
+            if buf[pos] == "[":
+                raise Exception("missing closing ']' in note")
+            raise Exception(
+                f"invalid character in Newick string: \"{buf[pos]}\"")
+        buf = buf[pos:] + more
+
+
+def checked(tokens):
+    """
+    Yield the tokens of a tree without the whitespace, raising on what
+    Newick.parse rejects: a second label of a node (the rest of a label
+    with whitespace in it), a note after a label, and a label or branch
+    length followed by "(" or, after whitespace, by anything but ",", ")"
+    or ";". A note alone may come before "(", as in "[&R] (A,B);".
+    """
+    label = brlen = space = False
+    for kind, text in tokens:
+        if kind == SPACE:
+            space = label or brlen
+            continue
+        if kind == LABEL and label:
+            raise Exception("invalid character in node label: \" \"")
+        if kind == NOTE and label:
+            raise Exception("invalid character in node label: \"[\"")
+        if kind == "(" and (label or brlen):
+            raise Exception("invalid character in node label: \"(\"")
+        if space and kind in (LABEL, NOTE, BRLEN):
+            raise Exception("invalid character in node label: \" \"")
+        if kind in ("(", ")", ",", ";"):
+            label = brlen = space = False
+        elif kind == LABEL:
+            label = True
+        elif kind == BRLEN:
+            brlen = True
+        yield kind, text
+
+
+def parse_tokens(tokens):
+    """
+    Build a tree from the tokens up to and including the next ";"
+
+    Gives the same tree and indices as Newick.parse, and rejects the same
+    malformed labels (see checked). Returns None if the tokens run out
+    before a tree starts.
+    """
+    root = p = None
+    depth = 0
+    for kind, text in checked(tokens):
+        if p is None:
+            root = p = Node()
+        if kind == "(":
+            if p.lfdesc:
+                raise Exception(
+                    "invalid Newick string: unexpected opening parenthesis")
+            q = Node()
+            q.anc = p
+            p.lfdesc = q
+            p = q
+            depth += 1
+        elif kind == ",":
+            if not p.anc:
+                raise Exception("invalid Newick string: unexpected comma")
+            q = Node()
+            q.anc = p.anc
+            q.prev = p
+            p.next = q
+            p = q
+        elif kind == ")":
+            p = p.anc
+            if not p:
+                raise Exception(
+                    "invalid Newick string: unmatched closing parenthesis")
+            depth -= 1
+        elif kind == ";":
+            if depth != 0:
+                raise Exception(
+                    "invalid Newick string: unmatched opening parenthesis")
+            index_nodes(root)
+            return root
+        elif kind == LABEL:
+            p.label = text
+        elif kind == NOTE:
+            p.note = text
+        else:
+            try:
+                p.brlen = float(text)
+            except:
+                raise Exception(f"invalid branch length: {text}")
+    if root is not None:
+        raise Exception("missing terminating semi-colon")
+    return None
+
+
+def parse_arrays(tokens):
+    """
+    Same as parse_tokens, but build an ArrayTree
+    """
+    tree = None
+    labels = []
+    p = -1
+    depth = 0
+    for kind, text in checked(tokens):
+        if tree is None:
+            tree = ArrayTree()
+            p = tree.add_node(-1)
+            labels.append("")
+        if kind == "(":
+            if tree.lfdesc[p] != -1:
+                raise Exception(
+                    "invalid Newick string: unexpected opening parenthesis")
+            q = tree.add_node(p)
+            labels.append("")
+            tree.lfdesc[p] = q
+            p = q
+            depth += 1
+        elif kind == ",":
+            if tree.parent[p] == -1:
+                raise Exception("invalid Newick string: unexpected comma")
+            q = tree.add_node(tree.parent[p])
+            labels.append("")
+            tree.next[p] = q
+            p = q
+        elif kind == ")":
+            p = tree.parent[p]
+            if p == -1:
+                raise Exception(
+                    "invalid Newick string: unmatched closing parenthesis")
+            depth -= 1
+        elif kind == ";":
+            if depth != 0:
+                raise Exception(
+                    "invalid Newick string: unmatched opening parenthesis")
+            tree.set_labels(labels)
+            tree.finish()
+            return tree
+        elif kind == LABEL:
+            labels[p] = text
+        elif kind == BRLEN:
+            try:
+                tree.brlen[p] = float(text)
+            except:
+                raise Exception(f"invalid branch length: {text}")
+    if tree is not None:
+        raise Exception("missing terminating semi-colon")
+    return None
+
+
+def translate_tips(root, translate):
+    """
+    Replace the tip labels of a Node or ArrayTree found in translate
+    """
+    if isinstance(root, ArrayTree):
+        root.set_labels([
+            translate.get(root.label(i), root.label(i)) if root.istip(i)
+            else root.label(i) for i in range(len(root))])
+    else:
+        for tip in root.tips():
+            tip.label = translate.get(tip.label, tip.label)
+
+
+def nexus_trees(tokens, parse=parse_tokens):
+    """
+    Yield the trees in the TREES block(s) of a NEXUS token stream
+
+    Tip labels are mapped through the block's TRANSLATE command, if any.
+    Every other command is skipped.
+    """
+    translate = {}
+    for kind, text in tokens:
+        if kind != LABEL:
+            continue
+        command = text.lower()
+        if command == "translate":
+            translate = {}
+            key = None
+            for kind, text in tokens:
+                if kind == ";":
+                    break
+                if kind == LABEL:
+                    if key is None:
+                        key = text
+                    else:
+                        translate[key] = text
+                elif kind == ",":
+                    key = None
+        elif command in ("tree", "utree"):
+            # skip the tree name up to and including "="
+            for kind, text in tokens:
+                if kind == LABEL and text.endswith("="):
+                    break
+                if kind == ";":
+                    raise Exception("invalid NEXUS tree command")
+            root = parse(tokens)
+            if root is None:
+                raise Exception("missing terminating semi-colon")
+            if translate:
+                translate_tips(root, translate)
+            yield root
+        else:
+            # skip to the end of the command
+            for kind, text in tokens:
+                if kind == ";":
+                    break
+
+
+def iter_newick_file(newick_file, arrays=False):
+    """
+    Yield the trees of a Newick (one or more trees, each terminated by a
+    semi-colon) or NEXUS file one at a time
+
+    The file is read incrementally, so only the current tree is held in
+    memory. The trees are ArrayTrees if arrays is true, else Node trees.
+    """
+    parse = parse_arrays if arrays else parse_tokens
     with open(newick_file) as f:
-        return Newick.parse(f.read().strip())
+        tokens = tokenize(f)
+        first = next((t for t in tokens if t[0] != SPACE), None)
+        if first is None:
+            return
+        if first[0] == LABEL and first[1].upper() == "#NEXUS":
+            yield from nexus_trees(tokens, parse)
+            return
+        tokens = itertools.chain([first], tokens)
+        while True:
+            root = parse(tokens)
+            if root is None:
+                return
+            yield root
+
+
+def read_newick_string(newick_string, arrays=False):
+    return Newick.parse(newick_string.strip(), arrays)
+
+def read_newick_file(newick_file, arrays=False):
+    for root in iter_newick_file(newick_file, arrays):
+        return root
+    raise Exception("no tree found in Newick file")
+
 
@@ -1,3 +1,6 @@
+from array import array
+
+
 class Node:
     """
     A node in a tree
@@ -8,6 +11,12 @@ class Node:
     the left and the right. Children thus form a doubly-linked list
     with the leftmost child as the head.
     """
+    __slots__ = ("anc", "lfdesc", "next", "prev", "index", "lfidx", "rtidx",
+        "brlen", "height", "label", "note", "_data", "_ntips", "_nnodes",
+        "_tree_index")
+
+    generation = 0      # bumped on every change to the shape of any tree
+
     def __init__(self):
         self.anc = None     # ref to ancestor
         self.lfdesc = None  # ref to leftmost child
@@ -20,7 +29,14 @@ class Node:
         self.height = 0.0
         self.label = ""
         self.note = ""
-        self.data = {}
+        self._data = None
+
+    @property
+    def data(self):
+        # created on first use, as most nodes never need one
+        if self._data is None:
+            self._data = {}
+        return self._data
 
     @property
     def istip(self):
@@ -37,6 +53,7 @@ class Node:
             desc.next = node
             node.prev = desc
         node.anc = self
+        Node.generation += 1
 
     def remove_child(self, node):
         assert isinstance(node, Node)
@@ -57,6 +74,7 @@ class Node:
             node.prev = None
             node.next = None
             node.anc = None
+            Node.generation += 1
             return node
         return None
 
@@ -105,32 +123,81 @@ class Node:
             self.lfdesc = b
         elif b == self.lfdesc:
             self.lfdesc = a
-        ai, al, ar = a.index, a.lfidx, a.rtidx
-        bi, bl, br = b.index, b.lfidx, b.rtidx
-        a.index, a.lfidx, a.rtidx = bi, bl, br
-        b.index, b.lfidx, b.rtidx = ai, al, ar
+        Node.generation += 1
+        self.renumber()
+
+    def set_children(self, kids):
+        """
+        Relink the children of this node in the order given, which must hold
+        the same nodes
+        """
+        prev = None
+        for node in kids:
+            node.prev = prev
+            if prev:
+                prev.next = node
+            prev = node
+        if prev:
+            prev.next = None
+        self.lfdesc = kids[0] if kids else None
+        Node.generation += 1
 
     def rotate(self):
-        kids = list(self.children())
-        start = 0
-        end = len(kids) - 1
-        while end > start:
-            self.swap(kids[start], kids[end])
-            start += 1
-            end -= 1
+        """
+        Reverse the order of the children of this node
+        """
+        self.set_children(list(self.children())[::-1])
+        self.renumber()
 
     def ladderize(self):
-        for node in self.levelorder_internal():
-            n = len(list(node.children()))
-            while n > 1:
-                new_n = 0
-                c = node.lfdesc.next
-                for i in range(1, n):
-                    if c.prev.ntips < c.ntips:
-                        node.swap(c.prev, c)
-                        new_n = i
-                    c = c.next
-                n = new_n
+        """
+        Order the children of every node in the clade by decreasing number
+        of tips, keeping the order of children with as many tips
+        """
+        ntips = {}
+        for node in self._postorder():
+            if node.istip:
+                ntips[node] = 1
+            else:
+                ntips[node] = sum(ntips[c] for c in node.children())
+                if node.lfdesc.next:
+                    node.set_children(sorted(node.children(),
+                        key=ntips.__getitem__, reverse=True))
+        self.renumber()
+
+    def renumber(self, start=None):
+        """
+        Reassign the preorder/postorder (nested set) indices of the clade,
+        numbering from start (by default its current preorder index). The
+        clade keeps its interval if its set of nodes is unchanged, so a
+        change to the order of children only has to renumber the clade of
+        their parent. Returns the index after the clade.
+        """
+        idx = self.lfidx if start is None else start
+        p = self
+        while True:
+            p.lfidx = idx
+            idx += 1
+            if p.lfdesc:
+                p = p.lfdesc
+                continue
+            p.rtidx = p.lfidx
+            while p is not self and not p.next:
+                p = p.anc
+                p.rtidx = idx
+                idx += 1
+            if p is self:
+                return idx
+            p = p.next
+
+    def set_heights(self):
+        """
+        Recompute the heights of the nodes in the clade from its branch
+        lengths and the height of this node
+        """
+        for node in self._preorder():
+            if node is not self:
+                node.height = node.anc.height + node.brlen
 
     def children(self):
         desc = self.lfdesc
@@ -138,17 +205,61 @@ class Node:
             yield desc
             desc = desc.next
 
+    def tree_index(self):
+        """
+        Return the TreeIndex of the subtree rooted here, built on first use
+        and rebuilt after the shape of any tree changes
+        """
+        index = self.cached_index()
+        if index is None:
+            index = self._tree_index = TreeIndex(self)
+        return index
+
+    def cached_index(self):
+        index = getattr(self, "_tree_index", None)
+        if index is not None and index.generation == Node.generation:
+            return index
+        return None
+
     def preorder(self):
-        yield self
-        for child in self.children():
-            for d in child.preorder():
-                yield d
+        index = self.cached_index()
+        if index is not None:
+            return iter(index.preorder)
+        return self._preorder()
 
     def postorder(self):
-        for child in self.children():
-            for d in child.postorder():
-                yield d
-        yield self
+        index = self.cached_index()
+        if index is not None:
+            return iter(index.postorder)
+        return self._postorder()
+
+    def _preorder(self):
+        # follows the child and sibling links, so needs neither recursion
+        # nor a stack
+        p = self
+        while p:
+            yield p
+            if p.lfdesc:
+                p = p.lfdesc
+            else:
+                while p is not self and not p.next:
+                    p = p.anc
+                p = None if p is self else p.next
+
+    def _postorder(self):
+        p = self
+        while p.lfdesc:
+            p = p.lfdesc
+        while True:
+            yield p
+            if p is self:
+                return
+            if p.next:
+                p = p.next
+                while p.lfdesc:
+                    p = p.lfdesc
+            else:
+                p = p.anc
 
     def levelorder(self):
         curlvl = [self]
@@ -164,7 +275,10 @@ class Node:
             n = len(curlvl)
 
     def tips(self):
-        return (node for node in self.preorder() if node.istip)
+        index = self.cached_index()
+        if index is not None:
+            return iter(index.tips)
+        return (node for node in self._preorder() if node.istip)
 
     def preorder_internal(self):
         return (node for node in self.preorder() if not node.istip)
@@ -183,41 +297,417 @@ class Node:
     def max_height(self):
         return max(tip.height for tip in self.tips())
 
+    # ntips and nnodes are cached along with the generation they were
+    # counted in, so that a change to the shape of any tree recounts them
+
     @property
     def ntips(self):
-        if hasattr(self, "_ntips"):
-            return self._ntips
-        else:
-            self._ntips = len(list(self.tips()))
-            return self._ntips
+        cached = getattr(self, "_ntips", None)
+        if cached is None or cached[0] != Node.generation:
+            cached = self._ntips = (Node.generation, sum(1 for _ in self.tips()))
+        return cached[1]
 
     @property
     def nnodes(self):
-        if hasattr(self, "_nnodes"):
-            return self._nnodes
-        else:
-            self._nnodes = len(list(self.preorder()))
-            return self._nnodes
+        cached = getattr(self, "_nnodes", None)
+        if cached is None or cached[0] != Node.generation:
+            cached = self._nnodes = (Node.generation,
+                sum(1 for _ in self.preorder()))
+        return cached[1]
+
+    def rows(self):
+        """
+        Yield the rows of the node table for the subtree rooted here, in
+        preorder
+        """
+        for node in self.preorder():
+            yield (node.index, node.lfidx, node.rtidx,
+                node.anc.index if node.anc else None,
+                node.brlen, node.height, node.label)
 
     @property
     def sql(self):
-        return "INSERT INTO node VALUES ("\
+        return "INSERT INTO node"\
+            "(id,preorder,postorder,anc,brlen,height,label) VALUES ("\
             f"{self.index},{self.lfidx},{self.rtidx},"\
             f"{self.anc.index},{self.brlen},{self.height},{self.label}"\
             ");"
 
-def mrca(a, b):
+class TreeIndex:
+    """
+    Traversal arrays of a tree, computed once
+
+    preorder and postorder are lists of the nodes, tips lists the tips in
+    preorder and parent[i] is the position in preorder of the parent of
+    preorder[i] (-1 for the root). The index is stale, and Node no longer
+    uses it, once the shape of any tree changes.
+    """
+    def __init__(self, root):
+        self.generation = Node.generation
+        self.preorder = list(root._preorder())
+        self.postorder = list(root._postorder())
+        self.tips = [node for node in self.preorder if node.istip]
+        self.position = pos = {node: i for i, node in enumerate(self.preorder)}
+        self.parent = [pos.get(node.anc, -1) for node in self.preorder]
+        self._ancestors = None
+
+    @property
+    def ancestors(self):
+        """
+        The AncestorIndex of the tree, built on first use
+        """
+        if self._ancestors is None:
+            self._ancestors = AncestorIndex(self.parent)
+        return self._ancestors
+
+    def mrca(self, nodes):
+        """
+        Return the most recent common ancestor of one or more nodes
+        """
+        pos = self.position
+        return self.preorder[self.ancestors.lca_many(pos[n] for n in nodes)]
+
+
+class AncestorIndex:
+    """
+    Constant time ancestor queries on a tree given by parent positions
+
+    parent[i] is the position in preorder of the parent of the node at
+    position i (-1 for the root). The clade of i is the positions i to
+    end[i], and the most recent common ancestor of i < j, when j is not in
+    that clade, is the parent of the shallowest node at positions i+1 to j.
+    That is found with a sparse table of range minima, which takes
+    O(n log n) memory and time to build but answers in O(1); it is the
+    Euler tour method over the preorder sequence, which is half as long as
+    the tour. The most recent common ancestor of a set of nodes is that of
+    its first and last nodes in preorder.
+    """
+    def __init__(self, parent):
+        n = self.n = len(parent)
+        self.parent = parent
+        depth = [0] * n
+        end = list(range(n))
+        for i in range(1, n):
+            depth[i] = depth[parent[i]] + 1
+        for i in range(n - 1, 0, -1):
+            p = parent[i]
+            if end[i] > end[p]:
+                end[p] = end[i]
+        self.depth = depth
+        self.end = end
+        # tips[i] is the number of tips before position i
+        tips = array("l", [0]) * (n + 1)
+        count = 0
+        for i in range(n):
+            tips[i] = count
+            if end[i] == i:
+                count += 1
+        tips[n] = count
+        self.tips = tips
+        # level k holds, for each i, the least depth * n + position over
+        # positions i to i + 2**k - 1
+        level = array("q", (d * n + i for i, d in enumerate(depth)))
+        self.table = [level]
+        h = 1
+        while 2 * h <= n:
+            level = array("q", map(min, level[:-h], level[h:]))
+            self.table.append(level)
+            h *= 2
+
+    def is_ancestor(self, a, b):
+        """
+        Whether position a is b or an ancestor of it
+        """
+        return a <= b <= self.end[a]
+
+    def ntips(self, i):
+        return self.tips[self.end[i] + 1] - self.tips[i]
+
+    def lca(self, a, b):
+        if a > b:
+            a, b = b, a
+        if b <= self.end[a]:
+            return a
+        a += 1
+        k = (b - a + 1).bit_length() - 1
+        level = self.table[k]
+        x = level[a]
+        y = level[b - (1 << k) + 1]
+        return self.parent[(x if x < y else y) % self.n]
+
+    def lca_many(self, positions):
+        """
+        Return the most recent common ancestor of one or more positions
+        """
+        lo = hi = None
+        for i in positions:
+            if lo is None:
+                lo = hi = i
+            elif i < lo:
+                lo = i
+            elif i > hi:
+                hi = i
+        if lo is None:
+            raise Exception("no nodes given")
+        return self.lca(lo, hi)
+
+
+class ArrayTree:
+    """
+    A tree stored as parallel arrays rather than as Node objects
+
+    Nodes are numbered 0, 1, ... in preorder. Node i has parent parent[i],
+    leftmost child lfdesc[i] and next sibling next[i] (-1 for none), branch
+    length brlen[i] and height height[i], and its label is
+    labels[label_start[i]:label_start[i+1]]. index, lfidx and rtidx hold the
+    node ids and preorder/postorder (nested set) indices that index_nodes
+    assigns to the equivalent Node tree. Notes are not kept.
+    """
+    def __init__(self):
+        self.parent = array("l")
+        self.lfdesc = array("l")
+        self.next = array("l")
+        self.brlen = array("d")
+        self.height = array("d")
+        self.labels = ""
+        self.label_start = array("l", [0])
+        self.index = array("l")
+        self.lfidx = array("l")
+        self.rtidx = array("l")
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent):
+        """
+        Append a node (a child of parent, or -1) and return its number.
+        Nodes must be added in preorder.
+        """
+        self.parent.append(parent)
+        self.lfdesc.append(-1)
+        self.next.append(-1)
+        self.brlen.append(0.0)
+        return len(self.parent) - 1
+
+    def istip(self, i):
+        return self.lfdesc[i] == -1
+
+    def label(self, i):
+        return self.labels[self.label_start[i]:self.label_start[i+1]]
+
+    def set_labels(self, labels):
+        """
+        Store a list of labels, one per node
+        """
+        start = array("l", [0])
+        pos = 0
+        for label in labels:
+            pos += len(label)
+            start.append(pos)
+        self.labels = "".join(labels)
+        self.label_start = start
+
+    def finish(self):
+        """
+        Assign node ids, heights and nested set indices, as index_nodes
+        does, once all nodes have been added
+        """
+        n = len(self.parent)
+        parent = self.parent
+        lfdesc = self.lfdesc
+        brlen = self.brlen
+        height = self.height = array("d", [0.0]) * n
+        index = self.index = array("l", [0]) * n
+        lfidx = self.lfidx = array("l", [0]) * n
+        rtidx = self.rtidx = array("l", [0]) * n
+        tip = 0
+        node = lfdesc.count(-1)
+        stack = []
+        idx = 1
+        for i in range(n):
+            a = parent[i]
+            while stack and stack[-1] != a:
+                rtidx[stack.pop()] = idx
+                idx += 1
+            lfidx[i] = idx
+            idx += 1
+            height[i] = (height[a] if a >= 0 else 0.0) + brlen[i]
+            if lfdesc[i] == -1:
+                tip += 1
+                index[i] = tip
+                rtidx[i] = lfidx[i]
+            else:
+                node += 1
+                index[i] = node
+                stack.append(i)
+        while stack:
+            rtidx[stack.pop()] = idx
+            idx += 1
+
+    def rows(self):
+        """
+        Yield the rows of the node table, in preorder
+        """
+        index = self.index
+        parent = self.parent
+        for i in range(len(parent)):
+            a = parent[i]
+            yield (index[i], self.lfidx[i], self.rtidx[i],
+                index[a] if a >= 0 else None,
+                self.brlen[i], self.height[i], self.label(i))
+
+
+def mrca(a, b, index=None):
+    """
+    Return the most recent common ancestor of a and b. Pass the TreeIndex
+    of their tree (see Node.tree_index) to answer in constant time rather
+    than by walking up the tree.
+    """
     assert isinstance(a, Node)
     assert isinstance(b, Node)
     assert a != b
-    mrca = None
-    path = {}
+    if index is not None:
+        return index.mrca((a, b))
+    path = set()
     while a:
-        path.update({a: True})
+        path.add(a)
         a = a.anc
     while b:
-        mrca = path.get(b, None)
-        if mrca:
-            break
+        if b in path:
+            return b
         b = b.anc
-    return mrca
+    return None
+
+
+def root_of(node):
+    while node.anc:
+        node = node.anc
+    return node
+
+
+def suppress(node):
+    """
+    Remove node, which has one child, joining its branch to its child's.
+    Returns the child.
+    """
+    child = node.lfdesc
+    node.remove_child(child)
+    child.brlen += node.brlen
+    anc = node.anc
+    if anc:
+        kids = [child if c is node else c for c in anc.children()]
+        anc.remove_child(node)
+        for c in kids:
+            c.prev = c.next = None
+            c.anc = anc
+        anc.set_children(kids)
+    return child
+
+
+def prune(node):
+    """
+    Remove the clade of node from its tree, and its parent as well if that
+    is left with a single child. Returns the root of what remains, with
+    its nodes renumbered.
+    """
+    anc = node.anc
+    if anc is None:
+        raise Exception("cannot prune the root")
+    anc.remove_child(node)
+    if anc.lfdesc and not anc.lfdesc.next:
+        child = suppress(anc)
+        root = root_of(child)
+    else:
+        root = root_of(anc)
+    root.renumber(1)
+    return root
+
+
+def reroot(node):
+    """
+    Root the tree of node halfway along the branch leading to node, so
+    that the new root has node and the rest of the tree as its children.
+    The old root is removed if that leaves it with a single child, and
+    the new root takes its id, else the next unused id. Returns the new
+    root, with its nodes renumbered and their heights recomputed.
+    """
+    if node.anc is None:
+        return node
+    path = []
+    p = node.anc
+    while p:
+        path.append(p)
+        p = p.anc
+    old = path[-1]
+    root = Node()
+    half = node.brlen / 2
+    node.anc.remove_child(node)
+    root.add_child(node)
+    node.brlen = half
+    # each node on the path becomes the child of the one below it, taking
+    # over the branch that led to that one
+    below, brlen = root, half
+    for p in path:
+        up = p.brlen
+        if p.anc:
+            p.anc.remove_child(p)
+        below.add_child(p)
+        p.brlen = brlen
+        below, brlen = p, up
+    if old.lfdesc and not old.lfdesc.next:
+        root.index = old.index
+        suppress(old)
+    else:
+        root.index = max(n.index for n in root._preorder()) + 1
+    root.renumber(1)
+    root.set_heights()
+    return root
+
+
+def regraft(node, target):
+    """
+    Move the clade of node (a subtree prune and regraft) onto the branch
+    leading to target, through a new parent placed halfway along it, or
+    above the root if target is the root. The old parent of node is
+    removed if that leaves it with a single child, and the new parent
+    takes its id, else the next unused id. Returns the root, with its
+    nodes renumbered and their heights recomputed.
+    """
+    anc = node.anc
+    if anc is None:
+        raise Exception("cannot move the root")
+    p = target
+    while p:
+        if p is node:
+            raise Exception("cannot regraft a clade within itself")
+        p = p.anc
+    new = Node()
+    last = max(n.index for n in root_of(node)._preorder())
+    anc.remove_child(node)
+    if anc.lfdesc and not anc.lfdesc.next:
+        new.index = anc.index
+        child = suppress(anc)
+        if target is anc:
+            target = child
+    else:
+        new.index = last + 1
+    up = target.anc
+    if up:
+        new.brlen = target.brlen / 2
+        target.brlen -= new.brlen
+        kids = [new if c is target else c for c in up.children()]
+        up.remove_child(target)
+        for c in kids:
+            c.prev = c.next = None
+            c.anc = up
+        up.set_children(kids)
+    else:
+        new.brlen = target.brlen
+        new.height = target.height
+        target.brlen = 0.0
+    new.add_child(target)
+    new.add_child(node)
+    root = root_of(new)
+    root.renumber(1)
+    root.set_heights()
+    return root
@@ -0,0 +1,176 @@
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+Stage-level profiling of a database build.
+
+A Profiler wraps the connection a build is done through (see
+database.bulk_load). Each stage run inside Profiler.stage() records its
+wall time, the rows it wrote (including rows written by triggers) and the
+peak resident set size so far. Within a stage, time and SQLite virtual
+machine steps are attributed to the top-level SQL statements run, with
+literals replaced by "?" so that repeated statements are counted together.
+Any trigger cascade a statement sets off is counted against it, as SQLite
+does not tell Python which trigger is running.
+"""
+
+
+PROFILE = """
+CREATE TABLE IF NOT EXISTS _profile(
+    stage           TEXT,
+    statement       TEXT,   -- NULL for the totals of the stage
+    seconds         REAL,
+    vm_steps        INTEGER,
+    rows_written    INTEGER,
+    peak_rss        INTEGER -- bytes
+);
+DELETE FROM _profile;
+"""
+
+# VM instructions between calls of the progress handler
+STEPS = 10000
+
+LITERAL = re.compile(r"""
+    [xX]'[0-9a-fA-F]*'          # blob
+    |'(?:[^']|'')*'             # string
+    |(?<![\w.])-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?   # number
+    """, re.VERBOSE)
+
+
+def normalize(sql):
+    return " ".join(LITERAL.sub("?", sql).split())
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes of this process or of the largest of
+    its finished worker processes, or None where this is not available.
+    """
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes everywhere but macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    """
+    Profile the stages of a build done through the connection db. hook, if
+    given, is called with the record of each stage as it ends. A profiler
+    that is not enabled runs the stages without recording anything.
+    """
+    def __init__(self, db, enabled=True, hook=None):
+        self.db = db
+        self.enabled = enabled
+        self.hook = hook
+        self.stages = []
+        self.statements = {}
+        self.current = None
+        self.name = None
+        self.sql = None
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        record = {"stage": name, "seconds": 0.0, "vm_steps": 0,
+            "rows_written": 0, "peak_rss": None}
+        self.name = name
+        self.current = None
+        self.sql = None
+        self.last = time.perf_counter()
+        self.changes = changes = self.db.total_changes
+        self.db.set_trace_callback(self.trace)
+        self.db.set_progress_handler(self.progress, STEPS)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.trace(None)
+            self.db.set_trace_callback(None)
+            self.db.set_progress_handler(None, STEPS)
+            record["seconds"] = time.perf_counter() - start
+            record["rows_written"] = self.db.total_changes - changes
+            record["vm_steps"] = sum(s["vm_steps"]
+                for (stage, _), s in self.statements.items() if stage == name)
+            record["peak_rss"] = peak_rss()
+            self.stages.append(record)
+            if self.hook is not None:
+                self.hook(record)
+
+    def trace(self, sql):
+        if sql == self.sql:
+            # a trigger program of the running statement is starting
+            return
+        self.sql = sql
+        # a statement is starting, so the one before it has finished;
+        # the time since its last progress call is not counted, as it may
+        # have been spent in Python
+        if self.current is not None:
+            self.current["rows_written"] += self.db.total_changes - self.changes
+        self.changes = self.db.total_changes
+        self.last = time.perf_counter()
+        if sql is None:
+            self.current = None
+            return
+        key = (self.name, normalize(sql))
+        if key not in self.statements:
+            self.statements[key] = {"seconds": 0.0, "vm_steps": 0,
+                "rows_written": 0}
+        self.current = self.statements[key]
+
+    def progress(self):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.current["seconds"] += now - self.last
+            self.current["vm_steps"] += STEPS
+        self.last = now
+        return 0
+
+    def save(self):
+        """
+        Write the records to the _profile table of the database.
+        """
+        if not self.enabled:
+            return
+        db = self.db
+        db.executescript(PROFILE)
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO _profile VALUES (?,NULL,?,?,?,?)",
+            ((s["stage"], s["seconds"], s["vm_steps"], s["rows_written"],
+                s["peak_rss"]) for s in self.stages))
+        db.executemany("INSERT INTO _profile VALUES (?,?,?,?,?,NULL)",
+            ((stage, sql, s["seconds"], s["vm_steps"], s["rows_written"])
+                for (stage, sql), s in self.statements.items()))
+        db.execute("COMMIT")
+
+    def report(self, file=sys.stderr, top=10):
+        """
+        Print a summary of the stages and the slowest statements.
+        """
+        if not self.enabled:
+            return
+        print(f"{'stage':<28}{'seconds':>10}{'rows':>12}{'peak MB':>10}",
+            file=file)
+        for s in self.stages:
+            rss = "" if s["peak_rss"] is None else f"{s['peak_rss'] / 2**20:.0f}"
+            print(f"{s['stage']:<28}{s['seconds']:>10.3f}"
+                f"{s['rows_written']:>12}{rss:>10}", file=file)
+        slowest = sorted(self.statements.items(),
+            key=lambda item: item[1]["seconds"], reverse=True)[:top]
+        if slowest:
+            print(f"\n{'seconds':>10}{'vm steps':>14}  statement", file=file)
+        for (stage, sql), s in slowest:
+            if len(sql) > 60:
+                sql = sql[:57] + "..."
+            print(f"{s['seconds']:>10.3f}{s['vm_steps']:>14}  [{stage}] {sql}",
+                file=file)
@@ -0,0 +1,168 @@
+from .node import AncestorIndex
+from .reconstruction import close, decode
+from .vector import connection
+
+"""
+Clade queries.
+
+import_newick stores the preorder and postorder indices of each node as a
+nested set: the clade of a node (the node and all its descendants) is the
+nodes of its tree whose preorder index lies between its own preorder and
+postorder indices, and a is an ancestor of b when b's preorder index lies
+in a's interval. The functions here answer one query each with a range
+scan of node_clade_idx (see also the clade and clade_size views). For
+many queries on the same tree, load a CladeIndex once, which answers
+membership, tip counts and most recent common ancestors in constant time.
+"""
+
+
+def _node(db, tree_id, node_id):
+    row = db.execute(
+        "SELECT preorder, postorder FROM node WHERE tree_id = ? AND id = ?",
+        (tree_id, node_id)).fetchone()
+    if row is None:
+        raise Exception(f"no node {node_id} in tree {tree_id}")
+    return row
+
+
+def clade(database, node_id, tree_id=1):
+    """
+    Return the ids of the nodes in the clade of a node, in preorder.
+    """
+    with connection(database) as db:
+        lo, hi = _node(db, tree_id, node_id)
+        return [id for id, in db.execute("""
+            SELECT id FROM node
+            WHERE tree_id = ? AND preorder BETWEEN ? AND ?
+            ORDER BY preorder""", (tree_id, lo, hi))]
+
+
+def clade_tips(database, node_id, tree_id=1):
+    """
+    Return the labels of the tips in the clade of a node, in preorder.
+    """
+    with connection(database) as db:
+        lo, hi = _node(db, tree_id, node_id)
+        return [label for label, in db.execute("""
+            SELECT label FROM node
+            WHERE tree_id = ? AND preorder BETWEEN ? AND ?
+                AND preorder = postorder
+            ORDER BY preorder""", (tree_id, lo, hi))]
+
+
+def is_descendant(database, node_id, ancestor_id, tree_id=1):
+    """
+    Whether a node is in the clade of another (or is that node).
+    """
+    with connection(database) as db:
+        lo, hi = _node(db, tree_id, ancestor_id)
+        pre, _ = _node(db, tree_id, node_id)
+        return lo <= pre <= hi
+
+
+def mrca(database, labels, tree_id=1):
+    """
+    Return the id of the most recent common ancestor of the nodes with the
+    given labels: the deepest node whose interval holds all of theirs.
+    """
+    labels = list(labels)
+    if not labels:
+        raise Exception("no nodes given")
+    with connection(database) as db:
+        lo, hi, found = db.execute(f"""
+            SELECT min(preorder), max(postorder), count(DISTINCT label)
+            FROM node
+            WHERE tree_id = ? AND label IN ({",".join("?" * len(labels))})""",
+            [tree_id] + labels).fetchone()
+        if found != len(set(labels)):
+            raise Exception(f"not every label is in tree {tree_id}")
+        id, = db.execute("""
+            SELECT id FROM node
+            WHERE tree_id = ? AND preorder <= ? AND postorder >= ?
+            ORDER BY preorder DESC LIMIT 1""", (tree_id, lo, hi)).fetchone()
+        return id
+
+
+def clade_summary(database, node_id, tree_id=1):
+    """
+    Return a dict mapping each character state id to the number of nodes
+    in the clade of a node for which it is a most parsimonious state, that
+    is, has the least final (uppass) cost.
+    """
+    with connection(database) as db:
+        lo, hi = _node(db, tree_id, node_id)
+        states = [i for i, in db.execute(
+            "SELECT id FROM character_states ORDER BY id")]
+        counts = dict.fromkeys(states, 0)
+        for f, in db.execute("""
+                SELECT uppass.f
+                FROM node JOIN uppass
+                    ON node.tree_id = uppass.tree_id
+                        AND node.id = uppass.node_id
+                WHERE node.tree_id = ? AND node.preorder BETWEEN ? AND ?""",
+                (tree_id, lo, hi)):
+            f = decode(f)
+            best = min(f)
+            for s, x in zip(states, f):
+                if close(x, best):
+                    counts[s] += 1
+        return counts
+
+
+class CladeIndex:
+    """
+    The nested set of one tree of a database, loaded into memory for
+    constant time queries by node id or label (see AncestorIndex). Labels
+    that occur more than once in the tree refer to the last such node in
+    preorder.
+    """
+    def __init__(self, database, tree_id=1):
+        with connection(database) as db:
+            rows = db.execute("""
+                SELECT id, anc, label FROM node
+                WHERE tree_id = ? ORDER BY preorder""", (tree_id,)).fetchall()
+        if not rows:
+            raise Exception(f"no tree {tree_id}")
+        self.ids = [id for id, _, _ in rows]
+        self.position = pos = {id: p for p, id in enumerate(self.ids)}
+        self.labels = {label: p for p, (_, _, label) in enumerate(rows) if label}
+        self.ancestors = AncestorIndex(
+            [-1 if anc is None else pos[anc] for _, anc, _ in rows])
+
+    def node(self, label):
+        return self.ids[self.labels[label]]
+
+    def clade(self, node_id):
+        p = self.position[node_id]
+        return self.ids[p:self.ancestors.end[p] + 1]
+
+    def tips(self, node_id):
+        p = self.position[node_id]
+        end = self.ancestors.end
+        return [self.ids[i] for i in range(p, end[p] + 1) if end[i] == i]
+
+    def ntips(self, node_id):
+        return self.ancestors.ntips(self.position[node_id])
+
+    def nnodes(self, node_id):
+        p = self.position[node_id]
+        return self.ancestors.end[p] - p + 1
+
+    def is_descendant(self, node_id, ancestor_id):
+        pos = self.position
+        return self.ancestors.is_ancestor(pos[ancestor_id], pos[node_id])
+
+    def lca(self, a, b):
+        """
+        Return the id of the most recent common ancestor of two node ids.
+        """
+        pos = self.position
+        return self.ids[self.ancestors.lca(pos[a], pos[b])]
+
+    def mrca(self, labels):
+        """
+        Return the id of the most recent common ancestor of the nodes with
+        the given labels.
+        """
+        pos = self.labels
+        return self.ids[self.ancestors.lca_many(pos[l] for l in labels)]
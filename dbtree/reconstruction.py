@@ -0,0 +1,274 @@
+import json
+import random
+from bisect import bisect_right
+from itertools import islice
+from .engine import missing_cost
+from .vector import connection, unpack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Most parsimonious reconstructions (MPRs).
+
+An MPR assigns a state to every node of a tree so that the total cost of
+the changes along the branches (plus the leaf costs) is the parsimony
+score. The downpass computed by schema2 (or the native engine) determines
+them all: the root takes a state of least cost g, and a child takes, given
+its parent's state i, a state j with cost[i,j] + g[j] equal to its stem
+cost h[i]. Counting the MPRs below each node and state in a postorder pass
+then gives their number, and drawing each node's state in proportion to
+those counts, in preorder, gives uniform random MPRs. Only the states that
+occur in some MPR are visited, and nothing is materialised beyond one
+table of choices per node. With NumPy installed, samples are drawn a batch
+at a time, node by node in preorder, with the tables of each node
+flattened into one sorted array of cumulative fractions to search.
+
+Costs are compared to within a relative tolerance, as the engines may sum
+them in a different order.
+"""
+
+
+# states drawn at a time by Reconstructions.sample with NumPy: a batch
+# holds this many divided by the number of nodes MPRs
+BLOCK = 1 << 22
+
+
+def close(x, target):
+    return x <= target + 1e-9 * max(1.0, abs(target))
+
+
+def decode(vec):
+    if isinstance(vec, bytes):
+        return list(unpack(vec))
+    return json.loads(vec)
+
+
+class Reconstructions:
+    """
+    The MPRs of one tree of a database. Each MPR is given as the character
+    state ids of the nodes, in the order of self.nodes (preorder); mpr()
+    turns one into a dict mapping node id to character state id.
+    """
+    def __init__(self, database, tree_id=1):
+        with connection(database) as db:
+            self.states = [i for i, in db.execute(
+                "SELECT id FROM character_states ORDER BY id")]
+            pos = {id: p for p, id in enumerate(self.states)}
+            k = len(self.states)
+            default = missing_cost(db)
+            rows = [{} for _ in range(k)]
+            for i, j, c in db.execute("SELECT i, j, cost FROM cost"):
+                rows[pos[i]][pos[j]] = c
+            nodes = db.execute("""
+                SELECT node.id, node.anc, downpass.g, downpass.h
+                FROM node JOIN downpass
+                    ON node.tree_id = downpass.tree_id
+                        AND node.id = downpass.node_id
+                WHERE node.tree_id = ?
+                ORDER BY node.preorder""", (tree_id,)).fetchall()
+        if not nodes:
+            raise Exception(f"no downpass for tree {tree_id}")
+        self.nodes = [id for id, _, _, _ in nodes]
+        index = {id: p for p, id in enumerate(self.nodes)}
+        # positions of the parents, in preorder, so parents come first
+        self.parent = [-1 if anc is None else index[anc]
+            for _, anc, _, _ in nodes]
+        g = [decode(g) for _, _, g, _ in nodes]
+        h = [None if anc is None else decode(h) for _, anc, _, h in nodes]
+
+        # preorder: the states each node takes in some MPR, and the
+        # choices of a child for each such state of its parent
+        best = min(g[0])
+        root = [s for s, x in enumerate(g[0]) if close(x, best)]
+        reach = [set() for _ in nodes]
+        reach[0].update(root)
+        choices = [{} for _ in nodes]
+        for p in range(1, len(nodes)):
+            gp = g[p]
+            order = sorted(range(k), key=gp.__getitem__)
+            for s in reach[self.parent[p]]:
+                target = h[p][s]
+                row = rows[s]
+                ts = [t for t, c in row.items() if close(c + gp[t], target)]
+                for t in order:
+                    if default + gp[t] > target + 1e-9 * max(1.0, abs(target)):
+                        break
+                    if t not in row:
+                        ts.append(t)
+                ts.sort()
+                choices[p][s] = ts
+                reach[p].update(ts)
+
+        # postorder: the number of MPRs of the subtree below each node for
+        # each state it can take
+        count = [dict.fromkeys(r, 1) for r in reach]
+        for p in range(len(nodes) - 1, 0, -1):
+            a = self.parent[p]
+            cp = count[p]
+            ca = count[a]
+            for s, ts in choices[p].items():
+                ca[s] *= sum(cp[t] for t in ts)
+
+        # cumulative counts for drawing a state in proportion to its count
+        def table(ts, cp):
+            cum = []
+            n = 0
+            for t in ts:
+                n += cp[t]
+                cum.append(n)
+            return ts, cum, n
+        self.root = table(root, count[0])
+        self.choices = [None] + [
+            {s: table(ts, count[p]) for s, ts in choices[p].items()}
+            for p in range(1, len(nodes))]
+        self.flat = None
+
+    def count(self):
+        """
+        Return the number of MPRs.
+        """
+        return self.root[2]
+
+    def mpr(self, states):
+        """
+        Return an MPR given as state ids by position as a dict mapping
+        node id to character state id.
+        """
+        if not isinstance(states, list):
+            states = states.tolist()
+        return dict(zip(self.nodes, states))
+
+    def _flatten(self):
+        # for each node, either an array of the only state it takes for
+        # each state of its parent, or its tables flattened: the r-th state
+        # its parent takes has the keys r + cum / total, so a draw u given
+        # that state is found by searching for r + u
+        if self.flat is None:
+            k = len(self.states)
+            ts, cum, total = self.root
+            flat = [(None, numpy.array([c / total for c in cum]), numpy.array(ts),
+                numpy.array([len(ts) - 1]))]
+            for tables in self.choices[1:]:
+                if all(len(ts) == 1 for ts, _, _ in tables.values()):
+                    only = numpy.zeros(k, dtype=int)
+                    for s, (ts, _, _) in tables.items():
+                        only[s] = ts[0]
+                    flat.append(only)
+                    continue
+                rank = numpy.zeros(k, dtype=int)
+                keys = []
+                states = []
+                last = []
+                for r, (s, (ts, cum, total)) in enumerate(tables.items()):
+                    rank[s] = r
+                    keys.extend(r + c / total for c in cum)
+                    states.extend(ts)
+                    last.append(len(states) - 1)
+                flat.append((rank, numpy.array(keys), numpy.array(states),
+                    numpy.array(last)))
+            self.flat = flat
+        return self.flat
+
+    def _batches(self, seed):
+        # endless batches of MPRs as (MPRs, nodes) arrays of state ids
+        rng = numpy.random.default_rng(seed)
+        flat = self._flatten()
+        parent = self.parent
+        ids = numpy.array(self.states)
+        size = len(self.nodes)
+        m = max(1, BLOCK // size)
+        states = numpy.empty((size, m), dtype=int)
+        zero = numpy.zeros(m, dtype=int)
+        while True:
+            for p, a in enumerate(flat):
+                up = states[parent[p]] if p else zero
+                if not isinstance(a, tuple):
+                    states[p] = a[up]
+                    continue
+                rank, keys, choices, last = a
+                r = zero if rank is None else rank[up]
+                # r + u may round up to r + 1, the start of the next table
+                i = keys.searchsorted(r + rng.random(m), side="right")
+                states[p] = choices[numpy.minimum(i, last[r])]
+            yield ids[states.T]
+
+    def sample(self, n=None, seed=None):
+        """
+        Yield n (or, if n is None, endless) MPRs drawn uniformly at random
+        and independently. The draws are the same for the same seed. With
+        NumPy installed, the MPRs are arrays drawn a batch at a time, and
+        uniform to within the precision of a float.
+        """
+        if numpy is not None:
+            drawn = (states for batch in self._batches(seed) for states in batch)
+            yield from drawn if n is None else islice(drawn, n)
+            return
+        drawn = 0
+        rng = random.Random(seed)
+        randrange = rng.randrange
+        parent = self.parent
+        choices = self.choices
+        ids = self.states
+        size = len(self.nodes)
+        while n is None or drawn < n:
+            ts, cum, total = self.root
+            states = [ts[bisect_right(cum, randrange(total))]]
+            for p in range(1, size):
+                ts, cum, total = choices[p][states[parent[p]]]
+                if len(ts) == 1:
+                    states.append(ts[0])
+                else:
+                    states.append(ts[bisect_right(cum, randrange(total))])
+            yield [ids[s] for s in states]
+            drawn += 1
+
+    def __iter__(self):
+        """
+        Yield every MPR, one at a time.
+        """
+        parent = self.parent
+        choices = self.choices
+        ids = self.states
+        size = len(self.nodes)
+        options = [None] * size
+        choice = [0] * size
+        states = [0] * size
+        options[0] = self.root[0]
+        p = 0
+        while p >= 0:
+            if choice[p] == len(options[p]):
+                p -= 1
+                continue
+            states[p] = options[p][choice[p]]
+            choice[p] += 1
+            if p + 1 == size:
+                yield [ids[s] for s in states]
+                continue
+            p += 1
+            options[p] = choices[p][states[parent[p]]][0]
+            choice[p] = 0
+
+
+def count_mprs(database, tree_id=1):
+    """
+    Return the number of MPRs of a tree.
+    """
+    return Reconstructions(database, tree_id).count()
+
+
+def sample_mprs(database, n=None, seed=None, tree_id=1):
+    """
+    Yield MPRs of a tree drawn uniformly at random (see
+    Reconstructions.sample).
+    """
+    return Reconstructions(database, tree_id).sample(n, seed)
+
+
+def iter_mprs(database, tree_id=1):
+    """
+    Yield every MPR of a tree, one at a time.
+    """
+    return iter(Reconstructions(database, tree_id))
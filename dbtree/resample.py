@@ -0,0 +1,172 @@
+import random
+from concurrent.futures import ProcessPoolExecutor
+from math import exp, sqrt
+from operator import mul
+from .engine import downpass, missing_cost
+from .kernels import kernels
+from .matrix import leaf_nodes, leaf_vectors, load_characters, load_trees
+from .reconstruction import close
+from .schema import schema_resample
+from .vector import connection
+
+"""
+Bootstrap and jackknife support.
+
+Resamples the characters of a character matrix database (see
+dbtree.matrix) to estimate the support of each of its trees. The score of
+a tree on a matrix is the sum of the scores of its characters, so a
+pseudo-replicate matrix, which holds each character some number of times,
+scores a tree as the sum of its character scores weighted by those
+numbers. The trees are loaded and the leaf vectors of each character
+encoded once, each character is scored on each tree once, and a replicate
+is then only a weighted sum per tree: no replicate matrix is built or
+imported. Replicate r draws its characters with its own generator, seeded
+by the seed and r, so that the results do not depend on how the
+replicates are shared among worker processes. Only a summary per tree is
+written, to resample_support.
+"""
+
+
+# replicates drawn by each task
+BLOCK = 100
+
+# probability that a jackknife replicate deletes a character
+DELETE = exp(-1)
+
+
+_trees = None
+_characters = None
+_max_cost = None
+_missing = None
+
+
+def _init(trees, characters, max_cost, missing):
+    global _trees, _characters, _max_cost, _missing
+    _trees = trees
+    _characters = characters
+    _max_cost = max_cost
+    _missing = missing
+
+
+def _length(c):
+    """
+    Return the score of character c on each tree, in tree id order.
+    """
+    k, cells, data = _characters[c]
+    down, _, _ = kernels(k, cells, _missing)
+    leaves = leaf_vectors(k, data, _max_cost)
+    scores = []
+    for t in sorted(_trees):
+        nodes, preorder = _trees[t]
+        g, _ = downpass(leaf_nodes(nodes, k, leaves), down)
+        scores.append(min(g[preorder[0]]))
+    return scores
+
+
+def weights(method, n, rng, delete=DELETE):
+    """
+    Return the number of times each of n characters occurs in a replicate
+    drawn with rng: n draws with replacement (bootstrap), or each kept once
+    unless deleted with probability delete (jackknife).
+    """
+    if method == "bootstrap":
+        w = [0] * n
+        for c in rng.choices(range(n), k=n):
+            w[c] += 1
+        return w
+    if method == "jackknife":
+        return [0 if rng.random() < delete else 1 for _ in range(n)]
+    raise Exception(f"unknown resampling method: {method}")
+
+
+def _replicates(task):
+    """
+    Draw replicates start to stop. Returns, for each tree, the number of
+    them in which it has the least score (shared among trees that tie),
+    and the sum and sum of squares of its scores.
+    """
+    columns, method, delete, seed, start, stop = task
+    n = len(columns[0])
+    wins = [0.0] * len(columns)
+    sums = [0.0] * len(columns)
+    squares = [0.0] * len(columns)
+    for r in range(start, stop):
+        w = weights(method, n, random.Random(f"{seed}:{r}"), delete)
+        scores = [sum(map(mul, w, col)) for col in columns]
+        best = min(scores)
+        tied = [t for t, s in enumerate(scores) if close(s, best)]
+        for t in tied:
+            wins[t] += 1 / len(tied)
+        for t, s in enumerate(scores):
+            sums[t] += s
+            squares[t] += s * s
+    return wins, sums, squares
+
+
+def resample(database, method="bootstrap", replicates=1000, seed=1,
+        delete=DELETE, jobs=1):
+    """
+    Estimate the support of each tree of a character matrix database from
+    replicates resamplings of its characters by method (bootstrap, or
+    jackknife deleting each character with probability delete), and store
+    it in resample_support, replacing any earlier results of the same
+    method. Returns the rows stored as (tree_id, score, support,
+    mean_score, sd_score) tuples.
+    """
+    if method not in ("bootstrap", "jackknife"):
+        raise Exception(f"unknown resampling method: {method}")
+    if replicates < 1:
+        raise Exception("replicates must be at least 1")
+    if not 0 <= delete < 1:
+        raise Exception("delete must be at least 0 and less than 1")
+    with connection(database) as db:
+        if db.execute("""
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = 'character'""").fetchone() is None:
+            raise Exception("resampling needs a character matrix database")
+        db.executescript(schema_resample)
+        max_cost, = db.execute("SELECT max_cost FROM max_cost LIMIT 1").fetchone()
+        missing = missing_cost(db)
+        trees = load_trees(db)
+        characters = load_characters(db)
+        if not characters:
+            raise Exception("no characters to resample")
+        order = sorted(characters)
+        blocks = [(start, min(start + BLOCK, replicates))
+            for start in range(0, replicates, BLOCK)]
+
+        def tasks(columns):
+            return [(columns, method, delete, seed, start, stop)
+                for start, stop in blocks]
+
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=_init,
+                    initargs=(trees, characters, max_cost, missing)) as pool:
+                chunksize = max(1, len(order) // (4 * jobs))
+                lengths = list(pool.map(_length, order, chunksize=chunksize))
+                columns = list(zip(*lengths))
+                results = list(pool.map(_replicates, tasks(columns)))
+        else:
+            _init(trees, characters, max_cost, missing)
+            lengths = list(map(_length, order))
+            columns = list(zip(*lengths))
+            results = list(map(_replicates, tasks(columns)))
+
+        rows = []
+        for i, t in enumerate(sorted(trees)):
+            wins = sum(r[0][i] for r in results)
+            total = sum(r[1][i] for r in results)
+            squares = sum(r[2][i] for r in results)
+            mean = total / replicates
+            var = 0.0
+            if replicates > 1:
+                var = (squares - total * mean) / (replicates - 1)
+            rows.append((t, sum(columns[i]), wins / replicates, mean,
+                sqrt(max(var, 0.0))))
+        db.execute("BEGIN")
+        db.execute("DELETE FROM resample_support WHERE method = ?", (method,))
+        db.executemany("INSERT INTO resample_support VALUES (?,?,?,?,?,?,?,?)",
+            ((method, t, replicates, seed, score, support, mean, sd)
+                for t, score, support, mean, sd in rows))
+        db.execute("COMMIT")
+    return rows
@@ -0,0 +1,225 @@
+import csv
+import json
+from array import array
+from .engine import missing_cost
+from .vector import connection
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+"""
+Results as arrays.
+
+load() reads the downpass and uppass of a tree into dense nodes x states
+NumPy arrays in one go: packed vectors are joined and viewed as float64
+without copying them value by value, and JSON vectors are joined and
+parsed by a single json.loads call, rather than row by row. export()
+streams the same results for every tree to a CSV or Parquet file, a chunk
+of rows at a time, so that they never all have to fit in memory.
+"""
+
+
+# rows read and written at a time by export
+CHUNK = 10000
+
+# elements of the branches x states x states arrays made at a time by
+# Results.branch_lengths
+BLOCK = 1 << 22
+
+
+def _decode(vectors):
+    """
+    Decode a list of vectors, all packed or all JSON, into one flat list
+    of floats (an array if packed).
+    """
+    if not vectors:
+        return []
+    if isinstance(vectors[0], bytes):
+        flat = array("d")
+        flat.frombytes(b"".join(vectors))
+        return flat
+    return [x for vec in json.loads("[" + ",".join(vectors) + "]") for x in vec]
+
+
+def _matrix(vectors, k):
+    if vectors and isinstance(vectors[0], bytes):
+        m = numpy.frombuffer(b"".join(vectors), dtype=numpy.float64)
+    else:
+        m = numpy.array(_decode(vectors), dtype=numpy.float64)
+    return m.reshape(len(vectors), k)
+
+
+class Results:
+    """
+    The downpass and uppass of one tree as arrays. Rows are nodes in
+    preorder and columns character states in id order:
+
+    nodes       node ids
+    parent      row of the parent of each node (-1 for the root)
+    labels      node labels
+    states      character state ids
+    g, h, f     node (downpass), stem and final (uppass) costs
+    cost        the cost matrix, with missing pairs at their cost
+    """
+    def __init__(self, database, tree_id=1):
+        if numpy is None:
+            raise Exception("dbtree.results needs numpy")
+        with connection(database) as db:
+            states = db.execute(
+                "SELECT id, label FROM character_states ORDER BY id").fetchall()
+            self.states = numpy.array([id for id, _ in states])
+            self.state_labels = [label for _, label in states]
+            k = len(states)
+            pos = {id: p for p, (id, _) in enumerate(states)}
+            cost = numpy.full((k, k), missing_cost(db))
+            for i, j, c in db.execute("SELECT i, j, cost FROM cost"):
+                cost[pos[i], pos[j]] = c
+            self.cost = cost
+            rows = db.execute("""
+                SELECT node.id, node.anc, node.label, uppass.g, uppass.h,
+                    uppass.f
+                FROM node JOIN uppass
+                    ON node.tree_id = uppass.tree_id
+                        AND node.id = uppass.node_id
+                WHERE node.tree_id = ?
+                ORDER BY node.preorder""", (tree_id,)).fetchall()
+        if not rows:
+            raise Exception(f"no uppass for tree {tree_id}")
+        ids, ancs, labels, g, h, f = zip(*rows)
+        self.nodes = numpy.array(ids)
+        index = {id: p for p, id in enumerate(ids)}
+        self.parent = numpy.array([-1 if a is None else index[a] for a in ancs])
+        self.labels = list(labels)
+        self.g = _matrix(g, k)
+        self.h = _matrix(h, k)
+        self.f = _matrix(f, k)
+
+    def tree_length(self):
+        """
+        Return the parsimony score, the least cost of the root.
+        """
+        return float(self.g[0].min())
+
+    def tolerance(self):
+        # the engines may sum costs in different orders
+        return 1e-9 * max(1.0, abs(self.tree_length()))
+
+    def mpr_states(self):
+        """
+        Return a nodes x states boolean array, true where a state is a most
+        parsimonious state of a node (has the least final cost).
+        """
+        f = self.f
+        return f <= f.min(axis=1, keepdims=True) + self.tolerance()
+
+    def branch_lengths(self):
+        """
+        Return the least and greatest cost, over all MPRs, of the branch
+        leading to each node (NaN for the root). A pair of states (i, j)
+        of a parent and child occurs in some MPR when f[parent, i] -
+        h[child, i] + cost[i, j] + g[child, j] is the tree length.
+        """
+        n, k = self.g.shape
+        low = numpy.full(n, numpy.nan)
+        high = numpy.full(n, numpy.nan)
+        limit = self.tree_length() + self.tolerance()
+        cost = self.cost
+        children = numpy.flatnonzero(self.parent >= 0)
+        step = max(1, BLOCK // (k * k))
+        with numpy.errstate(invalid="ignore"):
+            for start in range(0, len(children), step):
+                c = children[start:start + step]
+                p = self.parent[c]
+                total = ((self.f[p] - self.h[c])[:, :, None] + cost
+                    + self.g[c][:, None, :])
+                ok = total <= limit
+                low[c] = numpy.where(ok, cost, numpy.inf).min(axis=(1, 2))
+                high[c] = numpy.where(ok, cost, -numpy.inf).max(axis=(1, 2))
+        return low, high
+
+
+def load(database, tree_id=1):
+    """
+    Return the Results of a tree.
+    """
+    return Results(database, tree_id)
+
+
+def columns(database):
+    """
+    Return the column names of an export: the tree, node id, parent id and
+    label, then the downpass and uppass cost of each character state.
+    """
+    with connection(database) as db:
+        labels = [label for label, in db.execute(
+            "SELECT label FROM character_states ORDER BY id")]
+    return (["tree", "node", "parent", "label"]
+        + [f"downpass_{label}" for label in labels]
+        + [f"uppass_{label}" for label in labels])
+
+
+def chunks(database, chunk=CHUNK):
+    """
+    Yield the rows of an export (see columns) of every tree, in preorder,
+    as lists of at most chunk rows.
+    """
+    with connection(database) as db:
+        k, = db.execute("SELECT count(*) FROM character_states").fetchone()
+        cursor = db.execute("""
+            SELECT node.tree_id, node.id, node.anc, node.label, uppass.g,
+                uppass.f
+            FROM node JOIN uppass
+                ON node.tree_id = uppass.tree_id AND node.id = uppass.node_id
+            ORDER BY node.tree_id, node.preorder""")
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                return
+            g = _decode([row[4] for row in rows])
+            f = _decode([row[5] for row in rows])
+            yield [row[:4] + tuple(g[r*k:(r+1)*k]) + tuple(f[r*k:(r+1)*k])
+                for r, row in enumerate(rows)]
+
+
+def export(database, path, format=None, chunk=CHUNK):
+    """
+    Write the downpass and uppass of every tree to path as CSV or, with
+    pyarrow, Parquet (one row group per chunk of rows). The format is
+    taken from the extension of path unless given. Returns the number of
+    rows written.
+    """
+    if format is None:
+        format = "parquet" if path.endswith((".parquet", ".pq")) else "csv"
+    names = columns(database)
+    nrows = 0
+    if format == "csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for rows in chunks(database, chunk):
+                writer.writerows(rows)
+                nrows += len(rows)
+    elif format == "parquet":
+        if pyarrow is None:
+            raise Exception("Parquet export needs pyarrow")
+        types = [pyarrow.int64(), pyarrow.int64(), pyarrow.int64(),
+            pyarrow.string()] + [pyarrow.float64()] * (len(names) - 4)
+        schema = pyarrow.schema(list(zip(names, types)))
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for rows in chunks(database, chunk):
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(col, type=t)
+                        for col, t in zip(zip(*rows), types)],
+                    schema=schema))
+                nrows += len(rows)
+    else:
+        raise Exception(f"unknown export format: {format}")
+    return nrows
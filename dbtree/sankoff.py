@@ -1,6 +1,8 @@
 import csv
-import sqlite3
 from .schema import schema1 as schema_init
+from .database import compute_parsimony_scores
+from .matrix import create_tables, is_missing, read_matrix
+from .vector import connection
 
 """
 Schema for parsimony analysis of categorical character states
@@ -32,77 +34,96 @@ END;
 
 
 def create_database(database):
-    db = sqlite3.connect(database)
-    db.executescript(schema1)
-    db.close()
+    with connection(database) as db:
+        db.executescript(schema1)
 
 
 def import_chars(charfile, database):
-    db = sqlite3.connect(database, isolation_level=None)
-    db.execute("BEGIN")
-    with open(charfile, newline='') as f:
-        for otu, state in csv.reader(f):
-            db.execute(
-                "INSERT INTO character_state_data VALUES (?,?)", (otu, state))
-    db.execute("COMMIT")
-    db.close()
+    with connection(database) as db:
+        db.execute("BEGIN")
+        with open(charfile, newline='') as f:
+            db.executemany("INSERT INTO character_state_data VALUES (?,?)",
+                ((otu, state) for otu, state in csv.reader(f)))
+        db.execute("COMMIT")
 
 
-def import_costs(costfile, database):
-    db = sqlite3.connect(database, isolation_level=None)
-    db.execute("BEGIN")
-    if costfile is None:
-        db.execute("""
-            INSERT INTO cost
-            SELECT
-                id, id, 0
-            FROM character_states
-            """
-        )
-        db.execute("""
-            INSERT INTO cost
-            SELECT
-                f.id, t.id, 1
-            FROM character_states AS f, character_states AS t
-            WHERE f.id != t.id
-            """
-        )
-    else:
+def import_costs(costfile, database, sparse=False):
+    """
+    Import the costs in costfile, or unit costs if it is None. Pairs of
+    states missing from costfile are not allowed, or cost max_cost if
+    sparse is true.
+    """
+    with connection(database) as db:
+        db.execute("BEGIN")
+        db.execute("UPDATE sparse_costs SET sparse = ?", (int(sparse),))
+        if costfile is None:
+            db.execute("""
+                INSERT INTO cost
+                SELECT
+                    id, id, 0
+                FROM character_states
+                """
+            )
+            db.execute("""
+                INSERT INTO cost
+                SELECT
+                    f.id, t.id, 1
+                FROM character_states AS f, character_states AS t
+                WHERE f.id != t.id
+                """
+            )
+        else:
+            with open(costfile, newline='') as f:
+                db.executemany("""INSERT INTO cost VALUES (
+                    (SELECT id FROM character_states WHERE label=?),
+                    (SELECT id FROM character_states WHERE label=?),
+                    ?)""",
+                    ((frm, to, float(cost)) for frm, to, cost in csv.reader(f)))
+        db.execute("COMMIT")
+
+
+def import_matrix(charfile, costfile, database, sparse=False):
+    """
+    Import a character matrix (see dbtree.matrix). States are numbered in
+    order of appearance within each character, and the costs in costfile,
+    if given, apply to every character with both states. Missing pairs are
+    treated as by import_costs.
+    """
+    labels, rows = read_matrix(charfile)
+    costs = []
+    if costfile is not None:
         with open(costfile, newline='') as f:
             for frm, to, cost in csv.reader(f):
-                db.execute(f"""INSERT INTO cost VALUES (
-                    (SELECT id FROM character_states WHERE label='{frm}'),
-                    (SELECT id FROM character_states WHERE label='{to}'),
-                    {cost})""")
-    db.execute("COMMIT")
-    db.close()
+                costs.append((frm, to, float(cost)))
+    create_tables(database)
+    with connection(database) as db:
+        db.execute("BEGIN")
+        db.execute("UPDATE sparse_costs SET sparse = ?", (int(sparse),))
+        for c, label in enumerate(labels, 1):
+            db.execute("INSERT INTO character VALUES (?,?)", (c, label))
+            states = {}
+            data = []
+            for otu, cells in rows:
+                cell = cells[c-1]
+                if is_missing(cell):
+                    data.append((c, otu, None))
+                    continue
+                if cell not in states:
+                    states[cell] = len(states) + 1
+                data.append((c, otu, states[cell]))
+            db.executemany("INSERT INTO character_state VALUES (?,?,?)",
+                ((c, i, state) for state, i in states.items()))
+            db.executemany("INSERT INTO character_data VALUES (?,?,?)", data)
+            if costfile is None:
+                db.executemany("INSERT INTO character_cost VALUES (?,?,?,?)",
+                    ((c, i, j, 0 if i == j else 1)
+                        for i in states.values() for j in states.values()))
+            else:
+                db.executemany("INSERT INTO character_cost VALUES (?,?,?,?)",
+                    ((c, states[frm], states[to], cost) for frm, to, cost in costs
+                        if frm in states and to in states))
+        db.execute("COMMIT")
 
 
-def finalize_database(database):
-    db = sqlite3.connect(database)
-    db.executescript("""
-        CREATE TRIGGER compute_new_costs_and_scores_trig
-        AFTER UPDATE ON cost
-        BEGIN
-            DELETE FROM downpass;
-            INSERT INTO downpass(node_id,parent_id,g)
-            SELECT
-                node.id,
-                node.anc,
-                node_state.state
-            FROM node LEFT JOIN node_state ON node.id = node_state.node_id
-            ORDER BY postorder;
-            DELETE FROM uppass;
-            INSERT INTO uppass(node_id,parent_id,g,h)
-            SELECT
-                node_id,
-                parent_id,
-                g,
-                h
-            FROM downpass JOIN node ON node_id=id
-            ORDER BY preorder;
-        END;
-        UPDATE cost SET cost=0 WHERE i=1 AND j=1;
-        """
-    )
-    db.close()
+def finalize_database(database, engine="sql"):
+    compute_parsimony_scores(database, engine)
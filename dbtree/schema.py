@@ -22,6 +22,14 @@ CREATE UNIQUE INDEX cost_ij_idx ON cost(i, j, cost);
 CREATE UNIQUE INDEX cost_ji_idx ON cost(j, i, cost);
 
 
+-- 1 if pairs of states missing from cost cost max_cost, 0 if changes
+-- between them are not allowed
+CREATE TABLE sparse_costs(
+    sparse  INTEGER NOT NULL DEFAULT 0 CHECK (sparse IN (0, 1))
+);
+INSERT INTO sparse_costs VALUES (0);
+
+
 CREATE TABLE node (
     id          INTEGER NOT NULL,                    -- unique id for node
     preorder    INTEGER NOT NULL,                    -- preorder index
@@ -30,76 +38,502 @@ CREATE TABLE node (
     brlen       REAL,
     height      REAL,
     label       TEXT NOT NULL,
-    FOREIGN KEY (anc) REFERENCES node(id)
+    tree_id     INTEGER NOT NULL DEFAULT 1           -- tree the node is in
 );
-CREATE INDEX node_id_idx ON node(id);
-CREATE INDEX node_anc_idx ON node(anc);
-CREATE UNIQUE INDEX node_preorder_idx ON node(preorder ASC);
-CREATE UNIQUE INDEX node_postorder_idx ON node(postorder ASC);
-CREATE INDEX node_label_idx ON node(label);
-"""
 
 
-schema2 = """
-CREATE TEMPORARY TABLE node_state_data(node_id INTEGER, state_id INTEGER);
-INSERT INTO node_state_data
+-- The clade of a node is the nodes whose preorder index lies between its
+-- preorder and postorder indices (a nested set), found by a range scan
+-- of node_clade_idx. It includes the node itself.
+CREATE VIEW clade AS
 SELECT
-    a.id,
-    (SELECT id FROM character_states WHERE label = b.state_label)
-FROM
-node AS a LEFT JOIN character_state_data AS b ON a.label = b.otu_label
-WHERE a.preorder = a.postorder;  -- limit to leaf nodes
-
--- there may be multiple rows per node when state is ambiguous, hence the
--- complicated min aggregate and group by
-CREATE TABLE node_state(node_id INTEGER, state TEXT);
-INSERT INTO node_state
-WITH
-    tmp AS (
-        SELECT
-            a.node_id AS node_id,
-            b.id AS state_id,
-            min(CASE
-                    WHEN a.state_id ISNULL OR a.state_id = b.id
-                    THEN 0 ELSE (SELECT max_cost FROM max_cost LIMIT 1)
-                END) AS cost
-        FROM node_state_data AS a, character_states AS b
-        GROUP BY a.node_id, b.id
-)
+    a.tree_id AS tree,
+    a.id AS node,
+    d.id AS member,
+    d.label AS label,
+    d.preorder = d.postorder AS tip
+FROM node AS a JOIN node AS d
+    ON d.tree_id = a.tree_id
+        AND d.preorder BETWEEN a.preorder AND a.postorder;
+
+
+CREATE VIEW clade_size AS
+SELECT
+    a.tree_id AS tree,
+    a.id AS node,
+    (SELECT count(*) FROM node AS d
+        WHERE d.tree_id = a.tree_id
+            AND d.preorder BETWEEN a.preorder AND a.postorder
+            AND d.preorder = d.postorder) AS ntips,
+    (SELECT count(*) FROM node AS d
+        WHERE d.tree_id = a.tree_id
+            AND d.preorder BETWEEN a.preorder AND a.postorder) AS nnodes
+FROM node AS a;
+"""
+
+
+# Node cost of an internal node NEW.node_id (of tree NEW.tree_id), the sum
+# of the stem costs of all of its children. The children are read once
+# through downpass_covering_idx, so the cost is linear in the out-degree.
+child_cost = """
+        WITH
+        node_cost(j, cost) AS (
+            SELECT
+                j0.id,
+                sum(j0.value)
+            FROM
+                downpass AS children,
+                json_each(children.h) AS j0
+            WHERE children.tree_id = NEW.tree_id
+                AND children.parent_id = NEW.node_id
+            GROUP BY j0.id
+        )"""
+
+
+# Terms of the stem cost h of a node with node cost node_cost(j, cost),
+# to be minimized per state i: one for each pair (i, j) in cost and, if
+# sparse_costs.sparse = 1, one for each pair missing from cost, at
+# max_cost.
+stem_terms = """
+            SELECT
+                cost.i AS i,
+                cost.cost + node_cost.cost AS cost
+            FROM
+                cost,
+                node_cost
+            WHERE cost.j = node_cost.j
+            UNION ALL
+            SELECT
+                s.id,
+                (SELECT max_cost FROM max_cost LIMIT 1) + node_cost.cost
+            FROM
+                character_states AS s,
+                node_cost
+            WHERE (SELECT sparse FROM sparse_costs) AND NOT EXISTS (
+                SELECT 1 FROM cost
+                WHERE cost.i = s.id AND cost.j = node_cost.j)"""
+
+
+# Same for the single state j0.id, split into the terms of the stored pairs
+# and the terms of the missing pairs, which only count if sparse.
+edited_stem_terms = """
+                SELECT
+                    cost.cost + node_cost.cost AS cost
+                FROM
+                    cost,
+                    node_cost
+                WHERE cost.i = j0.id AND cost.j = node_cost.j"""
+missing_stem_terms = """
+                SELECT
+                    (SELECT max_cost FROM max_cost LIMIT 1) + node_cost.cost
+                FROM node_cost
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM cost
+                    WHERE cost.i = j0.id AND cost.j = node_cost.j)"""
+
+
+# Stem cost of the state j0.id, testing for sparse costs up front so that
+# the usual case is as fast as a plain join.
+edited_stem_min = """(
+            CASE WHEN (SELECT sparse FROM sparse_costs)
+            THEN (SELECT min(cost) FROM (""" + edited_stem_terms + """
+                UNION ALL""" + missing_stem_terms + """))
+            ELSE (SELECT min(cost) FROM (""" + edited_stem_terms + """))
+            END)"""
+
+
+# Downpass (g, h) of an internal node NEW.node_id. Here and below, the
+# arrays are built with replace(json_group_array(...), 'Inf', '9e999'), as
+# SQLite before 3.45 writes an infinite cost as Inf, which its own JSON
+# functions then reject, and later versions write 9e999.
+node_cost = child_cost + """,
+        stem_cost(i, cost) AS (
+            SELECT i, min(cost) FROM (""" + stem_terms + """)
+            GROUP BY i
+        )
+        VALUES(
+            (SELECT replace(json_group_array(cost), 'Inf', '9e999')
+                FROM node_cost ORDER BY j),
+            (SELECT replace(json_group_array(cost), 'Inf', '9e999')
+                FROM stem_cost ORDER BY i)
+        )"""
+
+
+# Stem cost h of a leaf downpass row being updated, recomputing only the
+# rows that appear in cost_edit and keeping the others.
+edited_leaf_stem_cost = """
+        WITH
+        node_cost(j, cost) AS (
+            SELECT id, value FROM json_each(downpass.g)
+        )
+        SELECT replace(json_group_array(
+            CASE WHEN EXISTS (SELECT 1 FROM cost_edit WHERE i = j0.id)
+            THEN """ + edited_stem_min + """
+            ELSE j0.value END), 'Inf', '9e999')
+        FROM json_each(downpass.h) AS j0"""
+
+
+# Same for an internal node NEW.node_id. The node cost is summed again from
+# the children, rather than read back from g, so that the result is
+# identical to a full recompute.
+edited_stem_cost = child_cost + """
+        SELECT replace(json_group_array(
+            CASE WHEN EXISTS (SELECT 1 FROM cost_edit WHERE i = j0.id)
+            THEN """ + edited_stem_min + """
+            ELSE j0.value END), 'Inf', '9e999')
+        FROM json_each(downpass.h) AS j0"""
+
+
+# Terms of the uppass cost f of the uppass row being updated, to be
+# minimized per state j, over the stored and (if sparse) missing pairs
+# (i, j) as in stem_terms.
+final_terms = """
+                SELECT
+                    cost.j AS j,
+                    (j0.value-j1.value) + cost.cost + j2.value AS cost
+                FROM
+                    cost,
+                    json_each((SELECT f FROM uppass AS p
+                        WHERE p.tree_id = uppass.tree_id
+                            AND p.node_id = uppass.parent_id)) AS j0,
+                    json_each(uppass.h) AS j1,
+                    json_each(uppass.g) AS j2
+                WHERE cost.i = j0.id AND cost.i = j1.id AND cost.j = j2.id
+                UNION ALL
+                SELECT
+                    j2.id,
+                    (j0.value-j1.value) + (SELECT max_cost FROM max_cost LIMIT 1)
+                        + j2.value
+                FROM
+                    json_each((SELECT f FROM uppass AS p
+                        WHERE p.tree_id = uppass.tree_id
+                            AND p.node_id = uppass.parent_id)) AS j0,
+                    json_each(uppass.h) AS j1,
+                    json_each(uppass.g) AS j2
+                WHERE (SELECT sparse FROM sparse_costs) AND j0.id = j1.id
+                    AND NOT EXISTS (SELECT 1 FROM cost
+                        WHERE cost.i = j0.id AND cost.j = j2.id)"""
+
+
+# Same for the single state f0.id, split as edited_stem_terms is.
+edited_final_terms = """
+                    SELECT
+                        (j0.value-j1.value) + cost.cost + j2.value AS cost
+                    FROM
+                        cost,
+                        json_each((SELECT f FROM uppass AS p
+                            WHERE p.tree_id = uppass.tree_id
+                                AND p.node_id = uppass.parent_id)) AS j0,
+                        json_each(uppass.h) AS j1,
+                        json_each(uppass.g) AS j2
+                    WHERE cost.j = f0.id
+                        AND cost.i = j0.id AND cost.i = j1.id AND cost.j = j2.id"""
+missing_final_terms = """
+                    SELECT
+                        (j0.value-j1.value)
+                            + (SELECT max_cost FROM max_cost LIMIT 1) + j2.value
+                    FROM
+                        json_each((SELECT f FROM uppass AS p
+                            WHERE p.tree_id = uppass.tree_id
+                                AND p.node_id = uppass.parent_id)) AS j0,
+                        json_each(uppass.h) AS j1,
+                        json_each(uppass.g) AS j2
+                    WHERE j0.id = j1.id AND j2.id = f0.id
+                        AND NOT EXISTS (SELECT 1 FROM cost
+                            WHERE cost.i = j0.id AND cost.j = f0.id)"""
+
+
+# Uppass cost of the state f0.id, testing for sparse costs up front as
+# edited_stem_min does.
+edited_final_min = """(
+            CASE WHEN (SELECT sparse FROM sparse_costs)
+            THEN (SELECT min(cost) FROM (""" + edited_final_terms + """
+                UNION ALL""" + missing_final_terms + """))
+            ELSE (SELECT min(cost) FROM (""" + edited_final_terms + """))
+            END)"""
+
+
+# Uppass cost f of the uppass row being updated.
+final_cost = """
+        WITH
+        final(j, cost) AS (
+            SELECT j, min(cost) FROM (""" + final_terms + """)
+            GROUP BY j
+        )
+        SELECT replace(json_group_array(cost), 'Inf', '9e999')
+        FROM final ORDER BY j"""
+
+
+# Uppass cost f of the uppass row being updated, recomputing only the
+# columns that appear in cost_edit and keeping the others.
+edited_final_cost = """
+        SELECT replace(json_group_array(
+            CASE WHEN EXISTS (SELECT 1 FROM cost_edit WHERE j = f0.id)
+            THEN """ + edited_final_min + """
+            ELSE f0.value END), 'Inf', '9e999')
+        FROM json_each(uppass.f) AS f0"""
+
+
+# Drop the least recently used snapshots beyond the size budget.
+cache_evict = """
+DELETE FROM result_cache WHERE id IN (
+    SELECT id FROM result_cache ORDER BY last_used DESC
+    LIMIT -1 OFFSET (SELECT max_entries FROM result_cache_size));
+DELETE FROM result_cache_data
+WHERE cache_id NOT IN (SELECT id FROM result_cache);
+"""
+
+
+# Start of a recompute: if the current cost matrix is cached, restore its
+# snapshot and note it in result_cache_hit, so the statements that follow
+# can skip the computation.
+cache_restore = """
+DELETE FROM result_cache_hit;
+INSERT INTO result_cache_hit
+SELECT id FROM result_cache WHERE key = (SELECT key FROM cost_fingerprint);
+UPDATE result_cache SET last_used = (SELECT max(last_used) + 1 FROM result_cache)
+WHERE id = (SELECT id FROM result_cache_hit);
+UPDATE downpass SET (g, h) = (
+    SELECT g, h FROM result_cache_data AS c
+    WHERE c.cache_id = (SELECT id FROM result_cache_hit)
+        AND c.tree_id = downpass.tree_id AND c.node_id = downpass.node_id)
+WHERE EXISTS (SELECT 1 FROM result_cache_hit);
+UPDATE uppass SET (g, h, f) = (
+    SELECT g, h, f FROM result_cache_data AS c
+    WHERE c.cache_id = (SELECT id FROM result_cache_hit)
+        AND c.tree_id = uppass.tree_id AND c.node_id = uppass.node_id)
+WHERE EXISTS (SELECT 1 FROM result_cache_hit);
+"""
+
+
+# End of a computation: snapshot the results, unless they were restored
+# from the cache.
+cache_store = """
+INSERT INTO result_cache(key, last_used)
+SELECT key, (SELECT coalesce(max(last_used), 0) + 1 FROM result_cache)
+FROM cost_fingerprint
+WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit)
+    AND (SELECT max_entries FROM result_cache_size) > 0
+    AND EXISTS (SELECT 1 FROM uppass)
+ON CONFLICT (key) DO UPDATE SET last_used = excluded.last_used;
+INSERT OR IGNORE INTO result_cache_data
 SELECT
+    (SELECT id FROM result_cache
+        WHERE key = (SELECT key FROM cost_fingerprint)),
+    tree_id,
     node_id,
-    json_group_array(cost)
-FROM tmp
-GROUP BY node_id
-ORDER BY state_id;
+    g,
+    h,
+    f
+FROM uppass
+WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit)
+    AND (SELECT max_entries FROM result_cache_size) > 0;
+""" + cache_evict + """
+DELETE FROM result_cache_hit;
+"""
+
+
+# Recording of cost matrix edits, common to both storage formats.
+cost_edits = """
+-- Edits to the cost matrix are recorded in cost_edit and trigger a
+-- recompute. While recompute.deferred = 1 edits are only recorded;
+-- resetting it to 0 recomputes once for the whole batch.
+CREATE TABLE recompute(
+    deferred    INTEGER NOT NULL DEFAULT 0 CHECK (deferred IN (0, 1))
+);
+INSERT INTO recompute VALUES (0);
+
+
+CREATE TABLE cost_edit(
+    i       INTEGER NOT NULL,
+    j       INTEGER NOT NULL,
+    PRIMARY KEY (i, j)
+) WITHOUT ROWID;
+CREATE INDEX cost_edit_j_idx ON cost_edit(j);
+CREATE TRIGGER cost_edit_update_trig
+AFTER UPDATE ON cost
+WHEN NEW.cost IS NOT OLD.cost OR NEW.i IS NOT OLD.i OR NEW.j IS NOT OLD.j
+BEGIN
+    INSERT OR IGNORE INTO cost_edit VALUES (OLD.i, OLD.j), (NEW.i, NEW.j);
+    UPDATE recompute SET deferred = 0 WHERE deferred = 0;
+END;
+CREATE TRIGGER cost_edit_insert_trig
+AFTER INSERT ON cost
+BEGIN
+    INSERT OR IGNORE INTO cost_edit VALUES (NEW.i, NEW.j);
+END;
+CREATE TRIGGER cost_edit_delete_trig
+AFTER DELETE ON cost
+BEGIN
+    INSERT OR IGNORE INTO cost_edit VALUES (OLD.i, OLD.j);
+END;
+CREATE TRIGGER sparse_costs_trig
+AFTER UPDATE ON sparse_costs
+WHEN NEW.sparse IS NOT OLD.sparse
+BEGIN
+    -- the cost of every missing pair changes, so mark every row and column
+    INSERT OR IGNORE INTO cost_edit SELECT id, id FROM character_states;
+    UPDATE recompute SET deferred = 0 WHERE deferred = 0;
+END;
+"""
+
+
+# Cache of earlier results, common to both storage formats. A snapshot of
+# uppass (which holds the downpass vectors too) is kept for each of the last
+# result_cache_size.max_entries cost matrices that were computed, keyed by
+# the matrix, max_cost and sparse_costs. A recompute under a cached matrix
+# restores the snapshot instead. Leaf states are not part of the key, so
+# any change to node_state empties the cache.
+result_cache = """
+CREATE TABLE result_cache_size(
+    max_entries INTEGER NOT NULL CHECK (max_entries >= 0)
+);
+INSERT INTO result_cache_size VALUES (4);
+
+
+CREATE TABLE result_cache(
+    id          INTEGER PRIMARY KEY,
+    key         TEXT NOT NULL UNIQUE,
+    last_used   INTEGER NOT NULL
+);
+CREATE TABLE result_cache_data(
+    cache_id    INTEGER NOT NULL,
+    tree_id     INTEGER NOT NULL,
+    node_id     INTEGER NOT NULL,
+    g,
+    h,
+    f,
+    PRIMARY KEY (cache_id, tree_id, node_id)
+) WITHOUT ROWID;
+-- id of the snapshot being restored by the current recompute, if any
+CREATE TABLE result_cache_hit(id INTEGER);
+
+
+CREATE VIEW cost_fingerprint AS
+SELECT
+    (SELECT printf('%.17g', max_cost) FROM max_cost LIMIT 1) || ';' ||
+    (SELECT sparse FROM sparse_costs) || ';' ||
+    coalesce((
+        SELECT group_concat(i || ',' || j || ',' || printf('%.17g', cost), ';')
+        FROM (SELECT i, j, cost FROM cost ORDER BY i, j)), '') AS key;
+
+
+CREATE TRIGGER result_cache_size_trig
+AFTER UPDATE ON result_cache_size
+BEGIN
+""" + cache_evict + """
+END;
+CREATE TRIGGER result_cache_insert_state_trig
+AFTER INSERT ON node_state
+WHEN EXISTS (SELECT 1 FROM result_cache)
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+CREATE TRIGGER result_cache_update_state_trig
+AFTER UPDATE ON node_state
+WHEN EXISTS (SELECT 1 FROM result_cache)
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+CREATE TRIGGER result_cache_delete_state_trig
+AFTER DELETE ON node_state
+WHEN EXISTS (SELECT 1 FROM result_cache)
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+-- nor is the shape of the trees
+CREATE TRIGGER result_cache_update_node_trig
+AFTER UPDATE OF anc ON node
+WHEN EXISTS (SELECT 1 FROM result_cache) AND NEW.anc IS NOT OLD.anc
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+CREATE TRIGGER result_cache_insert_node_trig
+AFTER INSERT ON node
+WHEN EXISTS (SELECT 1 FROM result_cache)
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+CREATE TRIGGER result_cache_delete_node_trig
+AFTER DELETE ON node
+WHEN EXISTS (SELECT 1 FROM result_cache)
+BEGIN
+    DELETE FROM result_cache;
+    DELETE FROM result_cache_data;
+END;
+"""
+
+
+# Indexes on node, built once the trees have been loaded (by import_newick,
+# or else by schema2) rather than maintained row by row during the load.
+node_indexes = """
+-- holds the nested set interval, so that finding a clade by node id reads
+-- no table rows
+CREATE INDEX IF NOT EXISTS node_id_idx
+    ON node(tree_id, id, preorder, postorder);
+CREATE INDEX IF NOT EXISTS node_anc_idx ON node(tree_id, anc);
+CREATE UNIQUE INDEX IF NOT EXISTS node_preorder_idx
+    ON node(tree_id, preorder ASC);
+CREATE UNIQUE INDEX IF NOT EXISTS node_postorder_idx
+    ON node(tree_id, postorder ASC);
+CREATE INDEX IF NOT EXISTS node_label_idx ON node(label);
+-- covers the range scans of the clade views
+CREATE INDEX IF NOT EXISTS node_clade_idx
+    ON node(tree_id, preorder, postorder, id, label);
+"""
+
+
+# Settings for building a database over a single connection (see
+# dbtree.database.bulk_load). They last only as long as the connection.
+bulk_load_pragmas = """
+PRAGMA journal_mode = MEMORY;
+PRAGMA synchronous = OFF;
+PRAGMA cache_size = -262144;     -- 256MB
+PRAGMA temp_store = MEMORY;
+"""
+
+
+# Leaf state vectors, common to both storage formats. node_state is filled
+# in by dbtree.database.import_leaf_states once the tables are created.
+leaf_states = node_indexes + """
+CREATE TABLE node_state(
+    node_id INTEGER, state TEXT, tree_id INTEGER NOT NULL DEFAULT 1);
+CREATE INDEX node_state_node_idx ON node_state(tree_id, node_id);
+"""
 
 
+schema2 = leaf_states + """
+
 CREATE TABLE downpass(
     node_id         INTEGER,
     parent_id       INTEGER,
     g               TEXT,      -- cost at node
-    h               TEXT       -- cost at stem
+    h               TEXT,      -- cost at stem
+    tree_id         INTEGER NOT NULL DEFAULT 1
 );
-CREATE INDEX downpass_node_idx ON downpass(node_id);
-CREATE INDEX downpass_parent_idx ON downpass(parent_id);
-CREATE INDEX downpass_covering_idx ON downpass(parent_id,node_id,h);
+CREATE INDEX downpass_node_idx ON downpass(tree_id,node_id);
+CREATE INDEX downpass_parent_idx ON downpass(tree_id,parent_id);
+CREATE INDEX downpass_covering_idx ON downpass(tree_id,parent_id,node_id,h);
 CREATE TRIGGER dp_insert_leaf_trig
 AFTER INSERT ON downpass
-WHEN NEW.g NOT NULL
+WHEN NEW.g NOT NULL AND NEW.h IS NULL
 BEGIN
     UPDATE downpass SET (h) = (
         WITH
+        node_cost(j, cost) AS (
+            SELECT id, value FROM json_each(NEW.g)
+        ),
         stem_cost(i, cost) AS (
-            SELECT
-                cost.i,
-                min(cost.cost + json_each.value)
-            FROM
-                cost,
-                json_each(NEW.g)
-            WHERE cost.j = json_each.id
-            GROUP BY cost.i
+            SELECT i, min(cost) FROM (""" + stem_terms + """)
+            GROUP BY i
         )
-        SELECT json_group_array(cost) FROM stem_cost ORDER BY i
+        SELECT replace(json_group_array(cost), 'Inf', '9e999')
+        FROM stem_cost ORDER BY i
     )
     WHERE rowid = NEW.rowid;
 END;
@@ -107,52 +541,7 @@ CREATE TRIGGER dp_insert_node_trig
 AFTER INSERT ON downpass
 WHEN NEW.g IS NULL
 BEGIN
-    UPDATE downpass SET (g, h) = (
-        WITH
-        children(node_id,parent_id,h) AS (
-            SELECT
-                node_id,
-                parent_id,
-                h
-            FROM downpass WHERE parent_id = NEW.node_id
-        ),
-        lfdesc(id, h) AS (
-            SELECT
-                min(node_id),
-                h
-            FROM children
-        ),
-        rtdesc(id, h) AS (
-            SELECT
-                max(node_id),
-                h
-            FROM children
-        ),
-        node_cost(j, cost) AS (
-            SELECT
-                j0.id,
-                j0.value + j1.value
-            FROM
-                lfdesc,
-                rtdesc,
-                json_each(lfdesc.h) AS j0,
-                json_each(rtdesc.h) AS j1
-            WHERE j0.id = j1.id
-        ),
-        stem_cost(i, cost) AS (
-            SELECT
-                cost.i,
-                min(cost.cost + node_cost.cost)
-            FROM
-                cost,
-                node_cost
-            WHERE cost.j = node_cost.j
-            GROUP BY cost.i
-        )
-        VALUES(
-            (SELECT json_group_array(cost) FROM node_cost ORDER BY j),
-            (SELECT json_group_array(cost) FROM stem_cost ORDER BY i)
-        ))
+    UPDATE downpass SET (g, h) = (""" + node_cost + """)
     WHERE rowid = NEW.rowid;
 END;
 
@@ -162,37 +551,22 @@ CREATE TABLE uppass(
     parent_id       INTEGER,
     g               TEXT,       -- downpass node cost
     h               TEXT,       -- downpass stem cost
-    f               TEXT        -- final uppass cost
+    f               TEXT,       -- final uppass cost
+    tree_id         INTEGER NOT NULL DEFAULT 1
 );
-CREATE INDEX uppass_node_idx ON uppass(node_id);
-CREATE INDEX uppass_parent_idx ON uppass(parent_id);
+CREATE INDEX uppass_node_idx ON uppass(tree_id,node_id);
+CREATE INDEX uppass_parent_idx ON uppass(tree_id,parent_id);
 CREATE TRIGGER up_insert_root_trig
 AFTER INSERT ON uppass
-WHEN NEW.parent_id IS NULL
+WHEN NEW.parent_id IS NULL AND NEW.f IS NULL
 BEGIN
     UPDATE uppass SET f = NEW.g WHERE rowid = NEW.rowid;
 END;
 CREATE TRIGGER up_insert_node_trig
 AFTER INSERT ON uppass
-WHEN NEW.parent_id IS NOT NULL
+WHEN NEW.parent_id IS NOT NULL AND NEW.f IS NULL
 BEGIN
-    UPDATE uppass SET (f) = (
-        WITH
-        final(j, cost) AS (
-            SELECT
-                cost.j,
-                min((j0.value-j1.value) + cost.cost + j2.value)
-            FROM
-                cost,
-                json_each(
-                    (SELECT f FROM uppass WHERE node_id = NEW.parent_id)) AS j0,
-                json_each(NEW.h) AS j1,
-                json_each(NEW.g) AS j2
-            WHERE cost.i = j0.id AND cost.i = j1.id AND cost.j = j2.id
-            GROUP BY cost.j
-        )
-        SELECT json_group_array(cost) FROM final ORDER BY j
-    )
+    UPDATE uppass SET f = (""" + final_cost + """)
     WHERE rowid = NEW.rowid;
 END;
 
@@ -201,6 +575,380 @@ CREATE VIEW mpr AS
 SELECT
     node_id AS node,
     g AS downpass,
-    f AS uppass
+    f AS uppass,
+    tree_id AS tree
+FROM uppass;
+
+
+-- parsimony score of each tree
+CREATE VIEW score AS
+SELECT
+    tree_id AS tree,
+    min(j.value) AS score
+FROM downpass, json_each(downpass.g) AS j
+WHERE parent_id IS NULL
+GROUP BY tree_id;
+
+
+""" + cost_edits + result_cache + """
+
+
+-- Incremental recomputation. A recompute only re-evaluates the rows of h
+-- (downpass) and the columns of f (uppass) that an edit touches, unless
+-- something below (downpass) or above (uppass) a node changed, in which
+-- case its whole vector is recomputed.
+CREATE TABLE downpass_changed(
+    tree_id     INTEGER,
+    node_id     INTEGER,
+    PRIMARY KEY (tree_id, node_id)
+) WITHOUT ROWID;
+CREATE TRIGGER dp_changed_trig
+AFTER UPDATE OF g, h ON downpass
+WHEN OLD.h NOT NULL AND (NEW.g IS NOT OLD.g OR NEW.h IS NOT OLD.h)
+BEGIN
+    INSERT OR IGNORE INTO downpass_changed VALUES (NEW.tree_id, NEW.node_id);
+END;
+CREATE TABLE downpass_queue(tree_id INTEGER, node_id INTEGER);
+CREATE TRIGGER dp_queue_trig
+AFTER INSERT ON downpass_queue
+BEGIN
+    -- a child changed, so g and all of h are recomputed
+    UPDATE downpass SET (g, h) = (""" + node_cost + """)
+    WHERE tree_id = NEW.tree_id AND node_id = NEW.node_id AND EXISTS (
+        SELECT 1 FROM downpass AS d JOIN downpass_changed AS c
+        ON d.tree_id = c.tree_id AND d.node_id = c.node_id
+        WHERE d.tree_id = NEW.tree_id AND d.parent_id = NEW.node_id);
+    -- otherwise only the edited rows of h can have changed
+    UPDATE downpass SET h = (""" + edited_stem_cost + """)
+    WHERE tree_id = NEW.tree_id AND node_id = NEW.node_id AND NOT EXISTS (
+        SELECT 1 FROM downpass AS d JOIN downpass_changed AS c
+        ON d.tree_id = c.tree_id AND d.node_id = c.node_id
+        WHERE d.tree_id = NEW.tree_id AND d.parent_id = NEW.node_id);
+END;
+
+
+CREATE TABLE uppass_changed(
+    tree_id     INTEGER,
+    node_id     INTEGER,
+    PRIMARY KEY (tree_id, node_id)
+) WITHOUT ROWID;
+CREATE TRIGGER up_changed_trig
+AFTER UPDATE OF f ON uppass
+WHEN OLD.f NOT NULL AND NEW.f IS NOT OLD.f
+BEGIN
+    INSERT OR IGNORE INTO uppass_changed VALUES (NEW.tree_id, NEW.node_id);
+END;
+CREATE TABLE uppass_queue(tree_id INTEGER, node_id INTEGER);
+CREATE TRIGGER up_queue_trig
+AFTER INSERT ON uppass_queue
+BEGIN
+    UPDATE uppass SET f = CASE
+        -- the parent or the node's own downpass changed, so all of f is
+        -- recomputed
+        WHEN EXISTS (SELECT 1 FROM uppass_changed AS c
+                WHERE c.tree_id = NEW.tree_id
+                    AND c.node_id = uppass.parent_id)
+            OR EXISTS (SELECT 1 FROM downpass_changed AS c
+                WHERE c.tree_id = NEW.tree_id AND c.node_id = NEW.node_id)
+        THEN (""" + final_cost + """)
+        -- otherwise only the edited columns of f can have changed
+        ELSE (""" + edited_final_cost + """)
+        END
+    WHERE tree_id = NEW.tree_id AND node_id = NEW.node_id;
+END;
+
+
+CREATE TRIGGER recompute_trig
+AFTER UPDATE OF deferred ON recompute
+WHEN NEW.deferred = 0 AND EXISTS (SELECT 1 FROM cost_edit)
+BEGIN
+    DELETE FROM downpass_changed;
+    DELETE FROM uppass_changed;
+""" + cache_restore + """
+    -- leaf g never changes, so only the edited rows of h are recomputed
+    UPDATE downpass SET h = (""" + edited_leaf_stem_cost + """)
+    WHERE (tree_id, node_id) IN (
+        SELECT tree_id, id FROM node WHERE preorder = postorder)
+        AND NOT EXISTS (SELECT 1 FROM result_cache_hit);
+    DELETE FROM downpass_queue;
+    INSERT INTO downpass_queue
+    SELECT tree_id, id FROM node
+    WHERE preorder != postorder AND NOT EXISTS (SELECT 1 FROM result_cache_hit)
+    ORDER BY tree_id, postorder;
+    DELETE FROM downpass_queue;
+    UPDATE uppass SET (g, h) = (
+        SELECT g, h FROM downpass
+        WHERE downpass.tree_id = uppass.tree_id
+            AND downpass.node_id = uppass.node_id)
+    WHERE (tree_id, node_id) IN (
+        SELECT tree_id, node_id FROM downpass_changed);
+    UPDATE uppass SET f = g
+    WHERE parent_id IS NULL AND (tree_id, node_id) IN (
+        SELECT tree_id, node_id FROM downpass_changed);
+    DELETE FROM uppass_queue;
+    INSERT INTO uppass_queue
+    SELECT tree_id, id FROM node
+    WHERE anc NOT NULL AND NOT EXISTS (SELECT 1 FROM result_cache_hit)
+    ORDER BY tree_id, preorder;
+    DELETE FROM uppass_queue;
+    DELETE FROM cost_edit;
+""" + cache_store + """
+END;
+"""
+
+
+# Full computation of the downpass and uppass, in postorder and preorder
+# respectively, for use once the tables in schema2 have been populated. It
+# is skipped when cache_restore has just restored the results.
+compute_scores = """
+DELETE FROM downpass WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit);
+INSERT INTO downpass(tree_id,node_id,parent_id,g)
+SELECT
+    node.tree_id,
+    node.id,
+    node.anc,
+    node_state.state
+FROM node LEFT JOIN node_state
+    ON node.tree_id = node_state.tree_id AND node.id = node_state.node_id
+WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit)
+ORDER BY node.tree_id, postorder;
+DELETE FROM uppass WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit);
+INSERT INTO uppass(tree_id,node_id,parent_id,g,h)
+SELECT
+    downpass.tree_id,
+    node_id,
+    parent_id,
+    g,
+    h
+FROM downpass JOIN node ON downpass.tree_id=node.tree_id AND node_id=id
+WHERE NOT EXISTS (SELECT 1 FROM result_cache_hit)
+ORDER BY downpass.tree_id, preorder;
+DELETE FROM cost_edit;
+""" + cache_store
+
+
+# Packed cost matrix, kept in cost_matrix for the triggers in schema2_blob.
+# The number of states and the default are read outside the aggregate, so
+# that a cost table with no rows still gives a k x k matrix.
+pack_costs = """
+UPDATE cost_matrix SET m = vec_matrix(
+    (SELECT vec_cells(i, j, cost) FROM cost),
+    (SELECT count(*) FROM character_states),
+    (SELECT CASE WHEN sparse THEN (SELECT max_cost FROM max_cost LIMIT 1) END
+        FROM sparse_costs)
+);
+"""
+
+
+# Alternative to schema2 that stores the cost vectors as packed float64
+# BLOBs (see dbtree.vector). The triggers and the mpr view call the vec_*
+# functions, which must be registered on the connection. As vector
+# arithmetic is cheap a recompute simply redoes the full downpass and
+# uppass.
+schema2_blob = leaf_states + """
+CREATE TABLE cost_matrix(m BLOB);
+INSERT INTO cost_matrix VALUES (NULL);
+""" + pack_costs + """
+
+
+CREATE TABLE downpass(
+    node_id         INTEGER,
+    parent_id       INTEGER,
+    g               BLOB,      -- cost at node
+    h               BLOB,      -- cost at stem
+    tree_id         INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX downpass_node_idx ON downpass(tree_id,node_id);
+CREATE INDEX downpass_parent_idx ON downpass(tree_id,parent_id);
+CREATE INDEX downpass_covering_idx ON downpass(tree_id,parent_id,node_id,h);
+CREATE TRIGGER dp_insert_leaf_trig
+AFTER INSERT ON downpass
+WHEN NEW.g NOT NULL AND NEW.h IS NULL
+BEGIN
+    UPDATE downpass SET h = vec_minplus((SELECT m FROM cost_matrix), NEW.g)
+    WHERE rowid = NEW.rowid;
+END;
+CREATE TRIGGER dp_insert_node_trig
+AFTER INSERT ON downpass
+WHEN NEW.g IS NULL
+BEGIN
+    UPDATE downpass SET g = (
+        SELECT vec_sum(h) FROM downpass
+        WHERE tree_id = NEW.tree_id AND parent_id = NEW.node_id)
+    WHERE rowid = NEW.rowid;
+    UPDATE downpass SET h = vec_minplus((SELECT m FROM cost_matrix), g)
+    WHERE rowid = NEW.rowid;
+END;
+
+
+CREATE TABLE uppass(
+    node_id         INTEGER,
+    parent_id       INTEGER,
+    g               BLOB,       -- downpass node cost
+    h               BLOB,       -- downpass stem cost
+    f               BLOB,       -- final uppass cost
+    tree_id         INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX uppass_node_idx ON uppass(tree_id,node_id);
+CREATE INDEX uppass_parent_idx ON uppass(tree_id,parent_id);
+CREATE TRIGGER up_insert_root_trig
+AFTER INSERT ON uppass
+WHEN NEW.parent_id IS NULL AND NEW.f IS NULL
+BEGIN
+    UPDATE uppass SET f = NEW.g WHERE rowid = NEW.rowid;
+END;
+CREATE TRIGGER up_insert_node_trig
+AFTER INSERT ON uppass
+WHEN NEW.parent_id IS NOT NULL AND NEW.f IS NULL
+BEGIN
+    UPDATE uppass SET f = vec_add(
+        vec_minplus_t(
+            (SELECT m FROM cost_matrix),
+            vec_sub(
+                (SELECT f FROM uppass
+                    WHERE tree_id = NEW.tree_id AND node_id = NEW.parent_id),
+                NEW.h)),
+        NEW.g)
+    WHERE rowid = NEW.rowid;
+END;
+
+
+-- renders the packed vectors as JSON arrays, as in schema2
+CREATE VIEW mpr AS
+SELECT
+    node_id AS node,
+    vec_json(g) AS downpass,
+    vec_json(f) AS uppass,
+    tree_id AS tree
 FROM uppass;
+
+
+CREATE VIEW score AS
+SELECT
+    tree_id AS tree,
+    vec_min(g) AS score
+FROM downpass
+WHERE parent_id IS NULL;
+
+
+""" + cost_edits + result_cache + """
+
+
+CREATE TRIGGER recompute_trig
+AFTER UPDATE OF deferred ON recompute
+WHEN NEW.deferred = 0 AND EXISTS (SELECT 1 FROM cost_edit)
+BEGIN
+""" + pack_costs + cache_restore + compute_scores + """
+END;
+"""
+
+
+compute_scores_blob = pack_costs + compute_scores
+
+
+# Tables for a character matrix, scored in parallel by dbtree.matrix rather
+# than by the triggers above. Each character has its own states, costs and
+# leaf data, and its results are keyed by character id.
+schema_matrix = """
+CREATE TABLE character (
+    id          INTEGER PRIMARY KEY,
+    label       TEXT NOT NULL
+);
+
+
+CREATE TABLE character_state (
+    character_id    INTEGER NOT NULL,
+    id              INTEGER NOT NULL,   -- index into the cost vectors, from 1
+    label           TEXT NOT NULL,
+    PRIMARY KEY (character_id, id),
+    FOREIGN KEY (character_id) REFERENCES character(id)
+) WITHOUT ROWID;
+
+
+CREATE TABLE character_cost (
+    character_id    INTEGER NOT NULL,
+    i               INTEGER NOT NULL,
+    j               INTEGER NOT NULL,
+    cost            REAL NOT NULL CHECK (cost >= 0),
+    PRIMARY KEY (character_id, i, j),
+    FOREIGN KEY (character_id) REFERENCES character(id)
+) WITHOUT ROWID;
+
+
+-- one row per observation; state_id is NULL when the state is unknown
+CREATE TABLE character_data (
+    character_id    INTEGER NOT NULL,
+    otu_label       TEXT NOT NULL,
+    state_id        INTEGER,
+    FOREIGN KEY (character_id) REFERENCES character(id)
+);
+CREATE INDEX character_data_idx ON character_data(character_id);
+
+
+CREATE TABLE character_mpr (
+    character_id    INTEGER NOT NULL,
+    tree_id         INTEGER NOT NULL,
+    node_id         INTEGER NOT NULL,
+    downpass        TEXT,
+    uppass          TEXT,
+    PRIMARY KEY (character_id, tree_id, node_id)
+) WITHOUT ROWID;
+
+
+-- parsimony score of each character on each tree
+CREATE VIEW character_score AS
+SELECT
+    m.character_id AS character,
+    m.tree_id AS tree,
+    min(j.value) AS score
+FROM character_mpr AS m
+    JOIN node ON node.tree_id = m.tree_id AND node.id = m.node_id,
+    json_each(m.downpass) AS j
+WHERE node.anc IS NULL
+GROUP BY m.character_id, m.tree_id;
+"""
+
+
+# Results of evaluating a database under other cost matrices (see
+# dbtree.sweep). param is the asymmetry value or the cost file the matrix
+# came from, and score is the parsimony score of the tree under it.
+schema_sweep = """
+CREATE TABLE IF NOT EXISTS sweep_result (
+    param           NOT NULL,
+    tree_id         INTEGER NOT NULL,
+    node_id         INTEGER NOT NULL,
+    downpass,
+    uppass,
+    score           REAL,
+    PRIMARY KEY (param, tree_id, node_id)
+) WITHOUT ROWID;
+
+
+CREATE VIEW IF NOT EXISTS sweep_score AS
+SELECT
+    param,
+    tree_id AS tree,
+    min(score) AS score
+FROM sweep_result
+GROUP BY param, tree_id;
+"""
+
+
+# Support for each tree of a character matrix database from resampling
+# its characters (see dbtree.resample). score is the tree's score on the
+# matrix itself, support the fraction of replicates in which it has the
+# least score (shared among trees that tie), and mean_score and sd_score
+# summarize its scores over the replicates.
+schema_resample = """
+CREATE TABLE IF NOT EXISTS resample_support (
+    method          TEXT NOT NULL,      -- bootstrap or jackknife
+    tree_id         INTEGER NOT NULL,
+    replicates      INTEGER NOT NULL,
+    seed            INTEGER NOT NULL,
+    score           REAL NOT NULL,
+    support         REAL NOT NULL,
+    mean_score      REAL NOT NULL,
+    sd_score        REAL NOT NULL,
+    PRIMARY KEY (method, tree_id)
+) WITHOUT ROWID;
 """
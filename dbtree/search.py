@@ -0,0 +1,338 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from operator import add, sub
+from .database import read_tree, write_tree
+from .engine import cost_kernels, missing_cost
+from .node import regraft
+from .reconstruction import decode
+from .vector import connection
+
+"""
+Tree search.
+
+Improves a tree under the cost matrix stored in cost by subtree pruning
+and regrafting (SPR): a clade is cut from the tree, with its parent if
+that is left with one child, and joined again on another branch. Nearest
+neighbour interchanges (NNI) are the SPRs onto the branches next to the
+cut, so both are searched the same way, NNI as a radius of 1.
+
+No candidate is scored by a full pass. With the clade S cut, only the
+downpass of the nodes above the cut changes, and the final cost f' of the
+nodes of what is left follows from their parents' as in the uppass. S
+joined on the branch leading to d then costs
+
+    min over x of  f'[d][x] - g'[d][x] + h'[d][x] + h[S][x]
+
+as f'[d] - g'[d] is the cost of the rest of the tree above d. That is a
+pass along the path from the cut to the root for each cut, and one
+min-plus product for each branch tried, rather than a pass over the whole
+tree for each. Making a move likewise only recomputes the downpass above
+the cut and above the new parent. Each batch of BATCH cuts is spread over
+the worker processes, which score every branch within the radius of their
+cuts, and the best move of the batch is made if it improves the score.
+"""
+
+
+# cuts evaluated between moves, split among the workers
+BATCH = 64
+
+
+_down = None
+_up = None
+_radius = None
+_tree = None
+
+
+def _init(ids, cells, missing, parent, leaf, radius):
+    global _down, _up, _radius, _tree
+    _down, _up = cost_kernels(ids, cells, missing)
+    _radius = radius
+    _tree = Tree(parent, leaf, _down)
+
+
+class Tree:
+    """
+    A tree as the parent and children of each node position, with the
+    downpass g and stem costs h (the root's included) of each node, kept
+    up to date as clades are moved. leaf holds the state vector of each
+    tip and None for internal nodes.
+    """
+    def __init__(self, parent, leaf, down):
+        self.parent = list(parent)
+        self.leaf = list(leaf)
+        self.down = down
+        n = len(parent)
+        self.children = [[] for _ in range(n)]
+        for x, a in enumerate(parent):
+            if a < 0:
+                self.root = x
+            else:
+                self.children[a].append(x)
+        order = [self.root]
+        for x in order:
+            order.extend(self.children[x])
+        self.g = [None] * n
+        self.h = [None] * n
+        for x in reversed(order):
+            self._pass(x)
+        self.moves = 0
+
+    def _pass(self, x):
+        gx = self.leaf[x]
+        if gx is None:
+            h = self.h
+            for c in self.children[x]:
+                gx = h[c] if gx is None else list(map(add, gx, h[c]))
+        self.g[x] = gx
+        self.h[x] = self.down(gx)
+
+    def _update(self, x):
+        while x >= 0:
+            self._pass(x)
+            x = self.parent[x]
+
+    def score(self):
+        return min(self.g[self.root])
+
+    def move(self, s, d):
+        """
+        Move the clade at position s onto the branch leading to d, as
+        node.regraft does: the new parent takes the position of the old
+        one if that goes, else the next position.
+        """
+        parent = self.parent
+        children = self.children
+        p = parent[s]
+        children[p].remove(s)
+        if len(children[p]) == 1:
+            c, = children[p]
+            a = parent[p]
+            parent[c] = a
+            if a >= 0:
+                children[a][children[a].index(p)] = c
+            else:
+                self.root = c
+            if d == p:
+                d = c
+            x = p
+        else:
+            a = p
+            x = len(parent)
+            for v in (parent, children, self.leaf, self.g, self.h):
+                v.append(None)
+        up = parent[d]
+        parent[x] = up
+        if up >= 0:
+            children[up][children[up].index(d)] = x
+        else:
+            self.root = x
+        children[x] = [d, s]
+        parent[d] = parent[s] = x
+        # only the new parent and the nodes above it and above the cut
+        # change, and the path from the cut may pass through the former
+        self._pass(x)
+        self._update(a)
+        self._update(x)
+        self.moves += 1
+
+    def best_move(self, s, up, radius=None):
+        """
+        Return the least score of the tree with the clade at position s
+        moved onto another branch within radius branches of the cut (any
+        branch if radius is None), and that branch, as (score, s, d) where
+        d is the node the branch leads to, or None if there is none.
+        """
+        parent = self.parent
+        children = self.children
+        g = self.g
+        h = self.h
+        p = parent[s]
+        kids = [c for c in children[p] if c != s]
+        if not kids:
+            return None
+        newpar = {}
+        newkids = {}
+        if len(kids) == 1:
+            # p goes, and its other child takes over its branch, which is
+            # where the clade was
+            c = kids[0]
+            a = parent[p]
+            newpar[c] = a
+            if a >= 0:
+                newkids[a] = [c if x == p else x for x in children[a]]
+                top = self.root
+            else:
+                top = c
+            start = a
+            origin = c
+            frontier, dist = [c], 0
+        else:
+            newkids[p] = kids
+            start = p
+            top = self.root
+            origin = -1
+            frontier, dist = [p] + kids, 1
+
+        def par(x):
+            return newpar.get(x, parent[x])
+
+        def kids_of(x):
+            return newkids.get(x, children[x])
+
+        # the downpass above the cut
+        g2 = {}
+        h2 = {}
+        x = start
+        while x >= 0:
+            gx = None
+            for c in kids_of(x):
+                hc = h2[c] if c in h2 else h[c]
+                gx = hc if gx is None else list(map(add, gx, hc))
+            g2[x] = gx
+            h2[x] = self.down(gx)
+            x = par(x)
+
+        def G(x):
+            return g2[x] if x in g2 else g[x]
+
+        def H(x):
+            return h2[x] if x in h2 else h[x]
+
+        # the uppass of what is left, from the root down to where needed
+        F = {top: G(top)}
+
+        def final(d):
+            path = []
+            x = d
+            while x not in F:
+                path.append(x)
+                x = par(x)
+            for y in reversed(path):
+                F[y] = list(map(add, up(list(map(sub, F[par(y)], H(y)))), G(y)))
+            return F[d]
+
+        hs = h[s]
+        best = None
+        seen = set(frontier)
+        while frontier:
+            for d in frontier:
+                if d == origin:
+                    continue
+                score = min(map(add, map(add, map(sub, final(d), G(d)), H(d)),
+                    hs))
+                if best is None or score < best[0]:
+                    best = (score, s, d)
+            if radius is not None and dist >= radius:
+                break
+            nxt = []
+            for d in frontier:
+                near = list(kids_of(d))
+                if d != top:
+                    a = par(d)
+                    near.append(a)
+                    near.extend(kids_of(a))
+                for y in near:
+                    if y not in seen:
+                        seen.add(y)
+                        nxt.append(y)
+            frontier = nxt
+            dist += 1
+        return best
+
+
+def _evaluate(task):
+    """
+    Return the best move (see Tree.best_move) of any of the cuts in a
+    task, after making the moves made since the last task.
+    """
+    moves, cuts = task
+    tree = _tree
+    for s, d in moves[tree.moves:]:
+        tree.move(s, d)
+    best = None
+    for s in cuts:
+        move = tree.best_move(s, _up, _radius)
+        if move is not None and (best is None or move[0] < best[0]):
+            best = move
+    return best
+
+
+def search(database, tree_id=1, radius=None, jobs=1, seconds=None,
+        moves=None, engine="sql"):
+    """
+    Improve a tree of the database by SPR moves within radius branches of
+    each cut (NNI for a radius of 1), until no move improves its score, or
+    for at most seconds seconds or moves moves. The tree is then written
+    back to node with write_tree, which recomputes the scores with engine.
+    Returns the score before and after the search and the number of moves.
+    """
+    if radius is not None and radius < 1:
+        raise Exception("radius must be at least 1")
+    root = read_tree(database, tree_id)
+    with connection(database) as db:
+        ids = [i for i, in db.execute(
+            "SELECT id FROM character_states ORDER BY id")]
+        cells = db.execute("SELECT i, j, cost FROM cost ORDER BY i, j").fetchall()
+        missing = missing_cost(db)
+        states = {id: decode(state) for id, state in db.execute(
+            "SELECT node_id, state FROM node_state WHERE tree_id = ?",
+            (tree_id,))}
+    nodes = list(root.preorder())
+    for node in nodes:
+        if node.istip and node.index not in states:
+            raise Exception(f"no state for tip {node.index} of tree {tree_id}")
+    leaf = [states[node.index] if node.istip else None for node in nodes]
+    slot = {node: i for i, node in enumerate(nodes)}
+    parent = [-1 if node.anc is None else slot[node.anc] for node in nodes]
+    started = time.monotonic()
+    made = []
+
+    def spent():
+        return ((seconds is not None and time.monotonic() - started >= seconds)
+            or (moves is not None and len(made) >= moves))
+
+    _init(ids, cells, missing, parent, leaf, radius)
+    first = score = _tree.score()
+    pool = None
+    if jobs > 1:
+        pool = ProcessPoolExecutor(jobs, initializer=_init,
+            initargs=(ids, cells, missing, parent, leaf, radius))
+    try:
+        improved = True
+        while improved and not spent():
+            improved = False
+            s = 0
+            while s < len(nodes) and not spent():
+                cuts = [x for x in range(s, min(s + BATCH, len(nodes)))
+                    if nodes[x].anc is not None]
+                s += BATCH
+                step = -(-len(cuts) // max(jobs, 1))
+                tasks = [(made, cuts[i:i + step])
+                    for i in range(0, len(cuts), step)]
+                results = (pool.map(_evaluate, tasks) if pool
+                    else map(_evaluate, tasks))
+                best = min((m for m in results if m is not None), default=None)
+                if best is None or best[0] >= score - 1e-9 * max(1.0, abs(score)):
+                    continue
+                _, x, d = best
+                # the new parent of x takes the position of its old one if
+                # that goes, else the next position, as in Tree.move
+                old = nodes[x].anc
+                gone = len(list(old.children())) == 2
+                root = regraft(nodes[x], nodes[d])
+                if gone:
+                    i = slot.pop(old)
+                else:
+                    i = len(nodes)
+                    nodes.append(None)
+                nodes[i] = nodes[x].anc
+                slot[nodes[i]] = i
+                made.append((x, d))
+                score = best[0]
+                improved = True
+    finally:
+        if pool:
+            pool.shutdown()
+    if made:
+        write_tree(root, database, tree_id, engine)
+    return first, score, len(made)
@@ -0,0 +1,322 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import add
+from urllib.parse import parse_qs, urlsplit
+from .engine import cost_kernels, downpass, load_tree, missing_cost, uppass
+from .sweep import asymmetry_costs
+from .vector import connect, unpack
+
+"""
+Scoring server.
+
+Serves one finished database over HTTP, on a TCP port or a Unix socket.
+The tree, the decoded leaf state vectors and the cost matrix are loaded
+once and kept in memory, so that what-if requests (the scores, and
+optionally the reconstructions, under other costs or another asymmetry)
+are computed by the native engine without touching the database. Queries
+of the stored results go through a pool of read connections, which in
+WAL mode do not wait for writers. Edits to the costs go through a single
+writer connection, one at a time, and are recomputed by the triggers
+installed by sankoff/tdalp finalize_database, as a deferred batch.
+
+GET  /score                     scores of every tree
+GET  /mpr?tree=T[&node=N]       rows of the mpr view
+GET  /costs                     the cost matrix, as [i, j, cost] cells
+POST /whatif                    score under other costs without storing them
+POST /costs                     store other costs and recompute
+
+The body of a POST is a JSON object with either "asymmetry" (tdalp) or
+"costs", a list of [i, j, cost] cells to change, and for /whatif "mpr":
+true to return the downpass and uppass of every node as well.
+"""
+
+
+# what-if results kept by each Scorer
+CACHE = 16
+
+
+class Scorer:
+    """
+    The tree, leaf states and cost matrix of a database, loaded once.
+    """
+    def __init__(self, db):
+        self.ids = [i for i, in db.execute(
+            "SELECT id FROM character_states ORDER BY id")]
+        nodes, self.preorder = load_tree(db)
+        self.nodes = [(id, anc, None if state is None else
+            list(unpack(state)) if isinstance(state, bytes) else json.loads(state))
+            for id, anc, state in nodes]
+        self.roots = [id for id, anc, _ in self.nodes if anc is None]
+        # the postorder as positions, with each leaf pointing to one of the
+        # distinct leaf vectors, for scoring without the uppass
+        pos = {id: p for p, (id, _, _) in enumerate(self.nodes)}
+        self.parent = [-1 if anc is None else pos[anc]
+            for _, anc, _ in self.nodes]
+        distinct = {}
+        self.leaf = [None if state is None else
+            distinct.setdefault(tuple(state), len(distinct))
+            for _, _, state in self.nodes]
+        self.distinct = list(distinct)
+        self.missing = missing_cost(db)
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.tdalp = db.execute("""
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'asymmetry'""").fetchone() is not None
+        self.load_costs(db)
+
+    def load_costs(self, db):
+        self.cells = db.execute(
+            "SELECT i, j, cost FROM cost ORDER BY i, j").fetchall()
+
+    def costs(self, db, request):
+        """
+        Return the cost cells a request asks for: those for its asymmetry
+        parameter, or the current cells with its costs changed.
+        """
+        if "asymmetry" in request:
+            if not self.tdalp:
+                raise Exception("asymmetry needs a tdalp database")
+            return asymmetry_costs(db, float(request["asymmetry"]))
+        cells = {(i, j): c for i, j, c in self.cells}
+        for i, j, c in edits(request, self.ids):
+            cells[i, j] = c
+        return [(i, j, c) for (i, j), c in sorted(cells.items())]
+
+    def score(self, cells, mpr=False):
+        """
+        Return the scores of the trees, and their mpr rows if mpr is true,
+        under the given cost cells. The last CACHE results are kept.
+        """
+        key = (tuple(cells), mpr)
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        down, up = cost_kernels(self.ids, cells, self.missing)
+        if mpr:
+            g, h = downpass(self.nodes, down)
+            f = uppass(self.nodes, self.preorder, up, g, h)
+            result = {
+                "score": [{"tree": t, "score": min(g[t, id])}
+                    for t, id in self.roots],
+                "mpr": [{"tree": t, "node": id, "downpass": list(g[t, id]),
+                    "uppass": list(f[t, id])} for t, id in self.preorder]}
+        else:
+            result = {"score": self.downpass_scores(down)}
+        with self.cache_lock:
+            self.cache[key] = result
+            if len(self.cache) > CACHE:
+                self.cache.popitem(last=False)
+        return result
+
+    def downpass_scores(self, down):
+        # the downpass alone, over positions, computing the stem costs of
+        # each distinct leaf vector once and none for the roots
+        products = [down(v) for v in self.distinct]
+        distinct = self.distinct
+        acc = [None] * len(self.parent)
+        scores = []
+        for p, (a, leaf) in enumerate(zip(self.parent, self.leaf)):
+            if a < 0:
+                g = acc[p] if leaf is None else distinct[leaf]
+                scores.append(min(g))
+                continue
+            if leaf is None:
+                h = down(acc[p])
+                acc[p] = None
+            else:
+                h = products[leaf]
+            s = acc[a]
+            acc[a] = h if s is None else list(map(add, s, h))
+        return [{"tree": t, "score": score}
+            for (t, _), score in zip(self.roots, scores)]
+
+
+def edits(request, ids):
+    """
+    Return the [i, j, cost] cells of a request, checked.
+    """
+    known = set(ids)
+    cells = []
+    for cell in request.get("costs", []):
+        i, j, c = cell
+        if i not in known or j not in known:
+            raise Exception(f"unknown state in cost: {i},{j}")
+        if c < 0:
+            raise Exception("costs must not be negative")
+        cells.append((i, j, float(c)))
+    return cells
+
+
+def scores(db):
+    return [{"tree": t, "score": s}
+        for t, s in db.execute("SELECT tree, score FROM score ORDER BY tree")]
+
+
+def mprs(db, tree, node=None):
+    sql = "SELECT tree, node, downpass, uppass FROM mpr WHERE tree = ?"
+    args = [tree]
+    if node is not None:
+        sql += " AND node = ?"
+        args.append(node)
+    return [{"tree": t, "node": n, "downpass": json.loads(g),
+        "uppass": json.loads(f)} for t, n, g, f in db.execute(sql, args)]
+
+
+class Server:
+    """
+    Serve a database (see the module docstring) through readers read
+    connections and one writer.
+    """
+    def __init__(self, database, readers=4):
+        self.database = database
+        self.writer = connect(database, isolation_level=None,
+            check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        self.scorer = Scorer(self.writer)
+        self.readers = asyncio.Queue()
+        for _ in range(readers):
+            db = connect(database, isolation_level=None,
+                check_same_thread=False)
+            db.execute("PRAGMA query_only = 1")
+            self.readers.put_nowait(db)
+        self.lock = asyncio.Lock()
+        self.executor = ThreadPoolExecutor(readers + 1)
+
+    async def read(self, fn, *args):
+        db = await self.readers.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, fn, db, *args)
+        finally:
+            self.readers.put_nowait(db)
+
+    def whatif(self, db, request):
+        cells = self.scorer.costs(db, request)
+        return self.scorer.score(cells, bool(request.get("mpr")))
+
+    def write(self, request):
+        db = self.writer
+        scorer = self.scorer
+        cells = edits(request, scorer.ids)
+        # the policy of an upsert would override the OR IGNORE of the
+        # cost_edit triggers, so update and then insert what is missing
+        cells = list({(i, j): c for i, j, c in cells}.items())
+        db.execute("BEGIN")
+        try:
+            db.execute("UPDATE recompute SET deferred = 1")
+            if "asymmetry" in request:
+                if not scorer.tdalp:
+                    raise Exception("asymmetry needs a tdalp database")
+                l = float(request["asymmetry"])
+                if l <= 0:
+                    raise Exception("asymmetry must be positive")
+                db.execute("UPDATE asymmetry SET l = ?", (l,))
+            db.executemany("UPDATE cost SET cost = ? WHERE i = ? AND j = ?",
+                ((c, i, j) for (i, j), c in cells))
+            db.executemany("INSERT OR IGNORE INTO cost VALUES (?, ?, ?)",
+                ((i, j, c) for (i, j), c in cells))
+            db.execute("UPDATE recompute SET deferred = 0")
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        scorer.load_costs(db)
+        return {"score": scores(db)}
+
+    async def dispatch(self, method, target, body):
+        """
+        Return the result of a request, or None if there is no such request.
+        """
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        route = (method, url.path)
+        if route == ("GET", "/score"):
+            return {"score": await self.read(scores)}
+        if route == ("GET", "/mpr"):
+            node = query.get("node")
+            return {"mpr": await self.read(mprs, int(query.get("tree", 1)),
+                None if node is None else int(node))}
+        if route == ("GET", "/costs"):
+            return {"costs": self.scorer.cells}
+        if route == ("POST", "/whatif"):
+            return await self.read(self.whatif, json.loads(body or b"{}"))
+        if route == ("POST", "/costs"):
+            request = json.loads(body or b"{}")
+            async with self.lock:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.write, request)
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get("content-length", 0)))
+                try:
+                    status, result = "200 OK", await self.dispatch(
+                        method, target, body)
+                    if result is None:
+                        status, result = "404 Not Found", {
+                            "error": f"no such request: {method} {target}"}
+                except Exception as err:
+                    status, result = "400 Bad Request", {"error": str(err)}
+                data = json.dumps(result).encode()
+                close = (headers.get("connection", "").lower() == "close"
+                    or version == "HTTP/1.0")
+                writer.write(f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n"
+                    "\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        self.writer.close()
+
+
+async def serve(database, host="127.0.0.1", port=8000, path=None, readers=4,
+        ready=None):
+    """
+    Serve database on host and port, or on the Unix socket path if given,
+    until cancelled. ready, if given, is called once the server listens.
+    """
+    server = Server(database, readers)
+    try:
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            listener = await asyncio.start_unix_server(server.handle, path)
+        else:
+            listener = await asyncio.start_server(server.handle, host, port)
+        async with listener:
+            if ready is not None:
+                ready()
+            await listener.serve_forever()
+    finally:
+        server.close()
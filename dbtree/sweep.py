@@ -0,0 +1,127 @@
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from .engine import cost_kernels, downpass, load_tree, missing_cost, uppass
+from .schema import schema_sweep
+from .vector import connection, dumps, is_packed, pack, unpack
+
+"""
+Parameter sweeps.
+
+Evaluates a finished database under a series of cost matrices, either the
+tdalp costs for a grid of asymmetry values or the costs in a list of
+sankoff cost files, without touching cost, downpass or uppass. The tree
+and leaf state vectors are loaded and decoded once and shared by every
+evaluation, which is done by the native engine, and the results are kept
+side by side in sweep_result.
+"""
+
+
+def asymmetry_costs(db, l):
+    """
+    Return the (i, j, cost) cells that asym_compute_new_costs_and_scores_trig
+    would leave in cost after setting the asymmetry parameter to l.
+    """
+    if l <= 0:
+        raise Exception("asymmetry must be positive")
+    states = db.execute(
+        "SELECT id, value FROM character_states ORDER BY id").fetchall()
+    cells = [(i, j, c) for i, j, c in db.execute(
+        "SELECT i, j, cost FROM cost WHERE i = j")]
+    for i, f in states:
+        for j, t in states:
+            if i != j:
+                cells.append((i, j, l * (t - f) if f < t else f - t))
+    return sorted(cells)
+
+
+def costfile_costs(db, costfile):
+    """
+    Return the (i, j, cost) cells that sankoff.import_costs would insert for
+    costfile.
+    """
+    ids = dict(db.execute("SELECT label, id FROM character_states"))
+    cells = []
+    with open(costfile, newline='') as f:
+        for frm, to, cost in csv.reader(f):
+            if frm not in ids or to not in ids:
+                raise Exception(f"unknown state in cost file: {frm},{to}")
+            cells.append((ids[frm], ids[to], float(cost)))
+    return sorted(cells)
+
+
+_nodes = None
+_preorder = None
+_ids = None
+_missing = None
+
+
+def _init(nodes, preorder, ids, missing):
+    global _nodes, _preorder, _ids, _missing
+    _nodes = nodes
+    _preorder = preorder
+    _ids = ids
+    _missing = missing
+
+
+def _evaluate(task):
+    """
+    Score the tree(s) under one cost matrix. Returns the downpass and
+    uppass vectors keyed by (tree_id, node_id).
+    """
+    param, cells = task
+    down, up = cost_kernels(_ids, cells, _missing)
+    g, h = downpass(_nodes, down)
+    f = uppass(_nodes, _preorder, up, g, h)
+    return param, g, f
+
+
+def sweep(database, params, costs, jobs=1):
+    """
+    Evaluate the cost matrices costs(db, param) for each of params and
+    store the results in sweep_result, replacing any earlier results for
+    the same param.
+    """
+    with connection(database) as db:
+        db.executescript(schema_sweep)
+        encode = pack if is_packed(db) else dumps
+        ids = [i for i, in db.execute("SELECT id FROM character_states ORDER BY id")]
+        nodes, preorder = load_tree(db)
+        nodes = [(id, anc, None if state is None else
+            list(unpack(state)) if isinstance(state, bytes) else json.loads(state))
+            for id, anc, state in nodes]
+        missing = missing_cost(db)
+        tasks = [(param, costs(db, param)) for param in params]
+        db.execute("BEGIN")
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=_init,
+                    initargs=(nodes, preorder, ids, missing)) as pool:
+                results = pool.map(_evaluate, tasks)
+                for param, g, f in results:
+                    store(db, param, g, f, encode)
+        else:
+            _init(nodes, preorder, ids, missing)
+            for param, g, f in map(_evaluate, tasks):
+                store(db, param, g, f, encode)
+        db.execute("COMMIT")
+
+
+def store(db, param, g, f, encode):
+    db.execute("DELETE FROM sweep_result WHERE param = ?", (param,))
+    db.executemany("INSERT INTO sweep_result VALUES (?,?,?,?,?,?)",
+        ((param, t, id, encode(g[t, id]), encode(f[t, id]), min(f[t, id]))
+            for t, id in f))
+
+
+def sweep_asymmetry(database, values, jobs=1):
+    """
+    Evaluate a tdalp database for each asymmetry parameter in values
+    """
+    sweep(database, [float(l) for l in values], asymmetry_costs, jobs)
+
+
+def sweep_costfiles(database, costfiles, jobs=1):
+    """
+    Evaluate a sankoff database for each cost file in costfiles
+    """
+    sweep(database, list(costfiles), costfile_costs, jobs)
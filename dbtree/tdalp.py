@@ -1,7 +1,10 @@
 import csv
-import sqlite3
+from bisect import bisect_right
 from math import inf as INF
 from .schema import schema1 as schema_init
+from .database import compute_parsimony_scores
+from .matrix import create_tables, is_missing, read_matrix
+from .vector import connection
 
 """
 Schema for parsimony analysis of continuous character states.
@@ -41,8 +44,10 @@ CREATE TABLE character_state_data(
     state_value       REAL NOT NULL,
     state_label       TEXT
 );
+-- the loaders below bin values themselves; this covers other inserts
 CREATE TRIGGER character_state_data_bin_trig
 AFTER INSERT ON character_state_data
+WHEN NEW.state_label IS NULL
 BEGIN
     UPDATE character_state_data SET state_label = (
         SELECT
@@ -58,42 +63,66 @@ END;
 
 
 def create_database(database):
-    db = sqlite3.connect(database)
-    db.executescript(schema1)
-    db.close()
+    with connection(database) as db:
+        db.executescript(schema1)
 
 
-def import_chars(charfile, database):
-    db = sqlite3.connect(database, isolation_level=None)
-    db.execute("BEGIN")
+def read_chars(charfile):
     with open(charfile, newline='') as f:
-        for otu, state in csv.reader(f):
-            db.execute(
-                "INSERT INTO character_state_data(otu_label,state_value) VALUES (?,?)", (otu, state))
-    db.execute("COMMIT")
-    db.close()
+        return [(otu, float(state)) for otu, state in csv.reader(f)]
 
 
-def import_costs(brksfile, nbreaks, asymmetry, charfile, database):
-    db = sqlite3.connect(database, isolation_level=None)
-    db.execute("BEGIN")
-    MN = INF
-    MX = -INF
-    with open(charfile) as f:
-        for otu, state in csv.reader(f):
-            state = float(state)
-            if state < MN:
-                MN = state
-            if state > MX:
-                MX = state
+def bin_finder(bins):
+    """
+    Return a function that maps a value to the position in bins of the
+    (mn, mx) bin holding it, or None, by binary search over the bin starts
+    """
+    order = sorted(range(len(bins)), key=lambda i: bins[i][0])
+    starts = [bins[i][0] for i in order]
+    def find(value):
+        k = bisect_right(starts, value) - 1
+        if k >= 0 and value < bins[order[k]][1]:
+            return order[k]
+        return None
+    return find
+
+
+def insert_chars(db, chars):
+    """
+    Insert (otu, value) pairs into character_state_data, labelled with the
+    character_states bin holding each value
+    """
+    states = db.execute("SELECT mn, mx, label FROM character_states").fetchall()
+    find = bin_finder(states)
+    def rows():
+        for otu, value in chars:
+            i = find(value)
+            yield (otu, value, None if i is None else states[i][2])
+    db.executemany("""INSERT INTO character_state_data
+        (otu_label,state_value,state_label) VALUES (?,?,?)""", rows())
+
+
+def import_chars(charfile, database):
+    chars = read_chars(charfile)
+    with connection(database) as db:
+        db.execute("BEGIN")
+        insert_chars(db, chars)
+        db.execute("COMMIT")
+
+
+def make_bins(MN, MX, nbreaks, brksfile=None):
+    """
+    Return the (mn, mx) bounds of the character states, either nbreaks
+    equal-width bins spanning [MN, MX] or the bins read from brksfile.
+    """
+    bins = []
     if brksfile is None:
         MN -= 1e-4 * (MX - MN)
         MX += 1e-4 * (MX - MN)
         step = (MX - MN) / nbreaks
         mn = MN
         for i in range(nbreaks):
-            db.execute(
-                "INSERT INTO character_states(mn,mx) VALUES (?,?)", (mn,mn+step))
+            bins.append((mn, mn+step))
             mn += step
     else:
         with open(brksfile) as f:
@@ -104,53 +133,105 @@ def import_costs(brksfile, nbreaks, asymmetry, charfile, database):
             raise Exception('invalid number of breaks')
         if max(brks) <= MX or min(brks) > MN:
             raise Exception('breaks do not span range of values')
-        brks = zip(brks[:len(brks)], brks[1:])
-        for mn, mx in brks:
-            db.execute(
-                "INSERT INTO character_states(mn,mx) VALUES (?,?)", (mn,mx))
-    db.execute("UPDATE asymmetry SET l = ?", (asymmetry,))
-    db.execute("COMMIT")
-    db.close()
-
-def finalize_database(database):
-    db = sqlite3.connect(database)
-    db.executescript("""
-        CREATE TRIGGER asym_compute_new_costs_and_scores_trig
-        AFTER UPDATE ON asymmetry
-        BEGIN
-            DELETE FROM cost WHERE i != j;
-            INSERT INTO cost
-            SELECT
-                f.id,
-                t.id,
-                CASE
-                    WHEN f.value < t.value
-                    THEN (NEW.l) * (t.value - f.value)
-                    ELSE (f.value - t.value)
-                END
-            FROM character_states AS f, character_states AS t
-            WHERE f.id != t.id;
-            DELETE FROM downpass;
-            INSERT INTO downpass(node_id,parent_id,g)
-            SELECT
-                node.id,
-                node.anc,
-                node_state.state
-            FROM node LEFT JOIN node_state ON node.id = node_state.node_id
-            ORDER BY postorder;
-            DELETE FROM uppass;
-            INSERT INTO uppass(node_id,parent_id,g,h)
-            SELECT
-                node_id,
-                parent_id,
-                g,
-                h
-            FROM downpass JOIN node ON node_id=id
-            ORDER BY preorder;
-        END;
-        UPDATE asymmetry SET l = (
-            SELECT l FROM asymmetry
-        );
-        """
-    )
-    db.close()
+        bins.extend(zip(brks[:len(brks)], brks[1:]))
+    return bins
+
+
+def import_costs(brksfile, nbreaks, asymmetry, charfile, database):
+    with connection(database) as db:
+        db.execute("BEGIN")
+        MN = INF
+        MX = -INF
+        with open(charfile) as f:
+            for otu, state in csv.reader(f):
+                state = float(state)
+                if state < MN:
+                    MN = state
+                if state > MX:
+                    MX = state
+        db.executemany("INSERT INTO character_states(mn,mx) VALUES (?,?)",
+            make_bins(MN, MX, nbreaks, brksfile))
+        db.execute("UPDATE asymmetry SET l = ?", (asymmetry,))
+        db.execute("COMMIT")
+
+
+def import_data(brksfile, nbreaks, asymmetry, charfile, database):
+    """
+    Same as import_costs followed by import_chars, but reads charfile once
+    """
+    chars = read_chars(charfile)
+    with connection(database) as db:
+        db.execute("BEGIN")
+        values = [value for _, value in chars]
+        db.executemany("INSERT INTO character_states(mn,mx) VALUES (?,?)",
+            make_bins(min(values, default=INF), max(values, default=-INF),
+                nbreaks, brksfile))
+        db.execute("UPDATE asymmetry SET l = ?", (asymmetry,))
+        insert_chars(db, chars)
+        db.execute("COMMIT")
+
+
+def import_matrix(brksfile, nbreaks, asymmetry, charfile, database):
+    """
+    Import a character matrix (see dbtree.matrix). Each character is cut
+    into states as import_costs does, and given the same linear costs.
+    """
+    labels, rows = read_matrix(charfile)
+    create_tables(database)
+    with connection(database) as db:
+        db.execute("BEGIN")
+        db.execute("UPDATE asymmetry SET l = ?", (asymmetry,))
+        for c, label in enumerate(labels, 1):
+            db.execute("INSERT INTO character VALUES (?,?)", (c, label))
+            values = [(otu, None if is_missing(cells[c-1]) else float(cells[c-1]))
+                for otu, cells in rows]
+            observed = [v for _, v in values if v is not None]
+            if not observed:
+                raise Exception(f"no values for character {label}")
+            bins = make_bins(min(observed), max(observed), nbreaks, brksfile)
+            db.executemany(
+                "INSERT INTO character_state VALUES (?,?,'['||?||','||?||')')",
+                ((c, i, mn, mx) for i, (mn, mx) in enumerate(bins, 1)))
+            find = bin_finder(bins)
+            data = []
+            for otu, v in values:
+                i = None if v is None else find(v)
+                data.append((c, otu, None if i is None else i + 1))
+            db.executemany("INSERT INTO character_data VALUES (?,?,?)", data)
+            mid = [(mn + mx) / 2.0 for mn, mx in bins]
+            db.executemany("INSERT INTO character_cost VALUES (?,?,?,?)",
+                ((c, i + 1, j + 1,
+                    asymmetry * (t - f) if f < t else f - t)
+                    for i, f in enumerate(mid) for j, t in enumerate(mid)
+                    if i != j))
+        db.execute("COMMIT")
+
+def finalize_database(database, engine="sql"):
+    with connection(database) as db:
+        db.executescript("""
+            CREATE TRIGGER asym_compute_new_costs_and_scores_trig
+            AFTER UPDATE ON asymmetry
+            BEGIN
+                DELETE FROM cost WHERE i != j;
+                INSERT INTO cost
+                SELECT
+                    f.id,
+                    t.id,
+                    CASE
+                        WHEN f.value < t.value
+                        THEN (NEW.l) * (t.value - f.value)
+                        ELSE (f.value - t.value)
+                    END
+                FROM character_states AS f, character_states AS t
+                WHERE f.id != t.id;
+                UPDATE recompute SET deferred = 0 WHERE deferred = 0;
+            END;
+            UPDATE recompute SET deferred = 1;
+            UPDATE asymmetry SET l = (
+                SELECT l FROM asymmetry
+            );
+            DELETE FROM cost_edit;
+            UPDATE recompute SET deferred = 0;
+            """
+        )
+    compute_parsimony_scores(database, engine)
@@ -0,0 +1,220 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+from array import array
+from math import inf as INF
+from operator import add, sub
+from .kernels import kernels
+
+"""
+Packed cost vectors.
+
+Cost vectors (and the cost matrix) are stored as BLOBs of native float64
+values instead of JSON text. The vec_* SQL functions registered by
+connect() operate on them directly.
+"""
+
+
+def pack(vec):
+    return array("d", vec).tobytes()
+
+
+def unpack(blob):
+    vec = array("d")
+    vec.frombytes(blob)
+    return vec
+
+
+def _number(x):
+    # infinity as SQLite's JSON functions write and read it
+    if x == INF:
+        return "9e999"
+    if x == -INF:
+        return "-9e999"
+    return repr(x)
+
+
+def dumps(vec):
+    return "[" + ",".join(map(_number, vec)) + "]"
+
+
+def vec_json(blob):
+    if blob is None:
+        return None
+    return dumps(unpack(blob))
+
+
+def vec_from_json(text):
+    if text is None:
+        return None
+    return pack(json.loads(text))
+
+
+def vec_add(a, b):
+    return array("d", map(add, unpack(a), unpack(b))).tobytes()
+
+
+def vec_sub(a, b):
+    return array("d", map(sub, unpack(a), unpack(b))).tobytes()
+
+
+_kernels = {}
+
+
+def matrix_kernels(m, k):
+    """
+    Return the downpass and uppass kernels (see dbtree.kernels) of a packed
+    k x k matrix m (see vec_matrix), remembering the last few matrices
+    seen. An empty or NULL m has no cells, so every change is disallowed.
+    """
+    if m not in _kernels:
+        if len(_kernels) >= 8:
+            _kernels.clear()
+        m_ = unpack(m) if m else array("d")
+        if not m_:
+            _kernels[m] = kernels(k, [])
+        elif m_[0] < 0:
+            cells = [(int(m_[p]), int(m_[p+1]), m_[p+2])
+                for p in range(2, len(m_), 3)]
+            _kernels[m] = kernels(k, cells, m_[1])
+        else:
+            cells = [(i, j, m_[i*k + j]) for i in range(k) for j in range(k)
+                if m_[i*k + j] != INF]
+            _kernels[m] = kernels(k, cells)
+    return _kernels[m]
+
+
+def vec_minplus(m, v):
+    """
+    h[i] = min_j m[i,j] + v[j], for a packed k x k matrix m.
+    """
+    v = unpack(v)
+    down, _, _ = matrix_kernels(m, len(v))
+    return array("d", down(v)).tobytes()
+
+
+def vec_minplus_t(m, v):
+    """
+    f[j] = min_i v[i] + m[i,j], for a packed k x k matrix m.
+    """
+    v = unpack(v)
+    _, up, _ = matrix_kernels(m, len(v))
+    return array("d", up(v)).tobytes()
+
+
+def vec_min(blob):
+    if blob is None:
+        return None
+    return min(unpack(blob))
+
+
+class VecSum:
+    """
+    Aggregate elementwise sum of packed vectors.
+    """
+    def __init__(self):
+        self.vec = None
+
+    def step(self, blob):
+        if self.vec is None:
+            self.vec = unpack(blob)
+        else:
+            self.vec = array("d", map(add, self.vec, unpack(blob)))
+
+    def finalize(self):
+        return None if self.vec is None else self.vec.tobytes()
+
+
+class VecCells:
+    """
+    Aggregate (i, j, cost) rows into packed triples, for vec_matrix.
+    """
+    def __init__(self):
+        self.cells = array("d")
+
+    def step(self, i, j, cost):
+        self.cells.extend((i, j, cost))
+
+    def finalize(self):
+        return self.cells.tobytes() or None
+
+
+def vec_matrix(cells, k, default=None):
+    """
+    Pack the (i, j, cost) triples of vec_cells (NULL if there are none)
+    into a k x k matrix. Without a default, cells that are not given are
+    infinite, so min-plus skips them as the JSON joins do, and the matrix
+    is packed row-major. With a default, cells that are not given cost
+    default and only the cells given are packed, as -k, default and then
+    (i, j, cost) triples of 0-based positions. Costs are never negative,
+    so the two are told apart by the sign of the first value. k and the
+    default are passed in rather than aggregated, as a matrix may have no
+    cells at all.
+    """
+    cells = unpack(cells) if cells else array("d")
+    triples = [(int(cells[p]), int(cells[p+1]), cells[p+2])
+        for p in range(0, len(cells), 3)]
+    if default is not None:
+        m = array("d", [-k, default])
+        for i, j, cost in triples:
+            m.extend((i-1, j-1, cost))
+        return m.tobytes()
+    m = array("d", [INF]) * (k * k)
+    for i, j, cost in triples:
+        m[(i-1)*k + (j-1)] = cost
+    return m.tobytes()
+
+
+def register(db):
+    db.create_function("vec_json", 1, vec_json, deterministic=True)
+    db.create_function("vec_from_json", 1, vec_from_json, deterministic=True)
+    db.create_function("vec_min", 1, vec_min, deterministic=True)
+    db.create_function("vec_add", 2, vec_add, deterministic=True)
+    db.create_function("vec_sub", 2, vec_sub, deterministic=True)
+    db.create_function("vec_minplus", 2, vec_minplus, deterministic=True)
+    db.create_function("vec_minplus_t", 2, vec_minplus_t, deterministic=True)
+    db.create_function("vec_matrix", 3, vec_matrix, deterministic=True)
+    db.create_aggregate("vec_sum", 1, VecSum)
+    db.create_aggregate("vec_cells", 3, VecCells)
+
+
+def connect(database, **kwargs):
+    """
+    Open a connection with the vec_* functions registered. Databases that
+    store packed vectors need these for their triggers and views.
+    """
+    db = sqlite3.connect(database, **kwargs)
+    register(db)
+    return db
+
+
+@contextmanager
+def connection(database):
+    """
+    Yield database itself if it is already a connection, so that a build
+    can share one connection across stages, else a new connection (see
+    connect) in autocommit mode that is closed on exit.
+    """
+    if isinstance(database, sqlite3.Connection):
+        db = database
+    else:
+        db = connect(database, isolation_level=None)
+    try:
+        yield db
+    except:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    finally:
+        if db is not database:
+            db.close()
+
+
+def is_packed(db):
+    """
+    True if the downpass and uppass vectors are stored packed.
+    """
+    row = db.execute(
+        "SELECT type FROM pragma_table_info('downpass') WHERE name = 'g'"
+        ).fetchone()
+    return row is not None and row[0] == "BLOB"
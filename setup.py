@@ -6,6 +6,10 @@ setup(
     packages=["dbtree"],
     include_package_data=True,
     install_requires=["click"],
+    extras_require={
+        "results": ["numpy"],
+        "parquet": ["pyarrow"],
+    },
     entry_points="""
         [console_scripts]
         dbtree=dbtree.cli:cli
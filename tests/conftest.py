@@ -0,0 +1,46 @@
+import pytest
+from dbtree import sankoff
+from dbtree.database import bulk_load, finalize_database, import_newick
+from dbtree.vector import connect
+
+
+TREE = "((A,B),(C,(D,E)),(F,G,H));"
+
+CHARS = """A,red
+B,green
+C,red
+D,blue
+E,green
+F,blue
+G,blue
+H,red
+"""
+
+
+@pytest.fixture
+def build(tmp_path):
+    """
+    Return a function that builds a sankoff database of a tree (TREE by
+    default) and CHARS in tmp_path and returns an autocommit connection to
+    it. costs is the text of a cost file, or None for unit costs.
+    """
+    (tmp_path / "chars.csv").write_text(CHARS)
+
+    def build(name="test.db", storage="json", engine="sql", costs=None,
+            sparse=False, tree=TREE):
+        treefile = tmp_path / (name + ".tre")
+        treefile.write_text(tree)
+        costfile = None
+        if costs is not None:
+            costfile = tmp_path / (name + ".csv")
+            costfile.write_text(costs)
+        path = tmp_path / name
+        with bulk_load(str(path)) as db:
+            sankoff.create_database(db)
+            import_newick(str(treefile), db)
+            sankoff.import_chars(str(tmp_path / "chars.csv"), db)
+            sankoff.import_costs(costfile and str(costfile), db, sparse)
+            finalize_database(db, storage)
+            sankoff.finalize_database(db, engine)
+        return connect(str(path), isolation_level=None)
+    return build
@@ -0,0 +1,39 @@
+import io
+import pytest
+from dbtree.newick import Newick, parse_arrays, parse_tokens, tokenize
+
+
+MALFORMED = [
+    "(A B,C);",
+    "((A,B)C D,E);",
+    "A(B,C);",
+    "(A[x],B);",
+    "(A :1,B);",
+]
+
+WELLFORMED = [
+    "((A,B),C);",
+    "(A:1,B:2)R;",
+    "[&R]((A,B),C);",
+    "(A, (B,C)D:0.5);",
+]
+
+
+def tokens(newick):
+    return tokenize(io.StringIO(newick))
+
+
+@pytest.mark.parametrize("newick", MALFORMED)
+def test_malformed_labels_are_rejected(newick):
+    for parse in (Newick.parse, lambda s: parse_tokens(tokens(s)),
+            lambda s: parse_arrays(tokens(s))):
+        with pytest.raises(Exception, match="invalid character in node label"):
+            parse(newick)
+
+
+@pytest.mark.parametrize("newick", WELLFORMED)
+def test_parsers_agree(newick):
+    root = Newick.parse(newick.replace(" ", ""))
+    expected = list(root.rows())
+    assert list(parse_tokens(tokens(newick)).rows()) == expected
+    assert list(parse_arrays(tokens(newick)).rows()) == expected
@@ -0,0 +1,83 @@
+import pytest
+from dbtree.database import deferred_recompute
+
+
+UNIT = """red,red,0
+red,green,1
+red,blue,1
+green,red,1
+green,green,0
+green,blue,1
+blue,red,1
+blue,green,1
+blue,blue,0
+"""
+
+
+def results(db):
+    return (
+        db.execute("""
+            SELECT tree_id, node_id, parent_id, g, h FROM downpass
+            ORDER BY tree_id, node_id""").fetchall(),
+        db.execute("""
+            SELECT tree_id, node_id, parent_id, g, h, f FROM uppass
+            ORDER BY tree_id, node_id""").fetchall())
+
+
+def costs(db):
+    return "".join(f"{i},{j},{c}\n" for i, j, c in db.execute("""
+        SELECT f.label, t.label, cost
+        FROM cost
+            JOIN character_states AS f ON f.id = cost.i
+            JOIN character_states AS t ON t.id = cost.j
+        ORDER BY cost.i, cost.j"""))
+
+
+def state(db, label):
+    id, = db.execute(
+        "SELECT id FROM character_states WHERE label = ?", (label,)).fetchone()
+    return id
+
+
+@pytest.mark.parametrize("storage", ["json", "blob"])
+def test_single_edit_matches_full_build(build, storage):
+    db = build("edited.db", storage, costs=UNIT)
+    db.execute("UPDATE cost SET cost = 3 WHERE i = ? AND j = ?",
+        (state(db, "red"), state(db, "blue")))
+    assert results(db) == results(build("full.db", storage, costs=costs(db)))
+
+
+@pytest.mark.parametrize("storage", ["json", "blob"])
+def test_deferred_edits_match_full_build(build, storage):
+    db = build("edited.db", storage, costs=UNIT)
+    red, green, blue = (state(db, s) for s in ("red", "green", "blue"))
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    with deferred_recompute(path) as edit:
+        edit.execute("UPDATE cost SET cost = 2 WHERE i = ? AND j = ?",
+            (green, blue))
+        edit.execute("UPDATE cost SET cost = 4 WHERE i = ? AND j = ?",
+            (blue, red))
+        # a deleted pair is disallowed, and an insert puts it back at a
+        # different cost
+        edit.execute("DELETE FROM cost WHERE i = ? AND j = ?", (red, green))
+        edit.execute("DELETE FROM cost WHERE i = ? AND j = ?", (green, red))
+        edit.execute("INSERT INTO cost VALUES (?, ?, 5)", (green, red))
+    assert results(db) == results(build("full.db", storage, costs=costs(db)))
+
+
+@pytest.mark.parametrize("storage", ["json", "blob"])
+def test_cache_restore_matches_full_build(build, storage):
+    db = build("edited.db", storage, costs=UNIT)
+    first = results(db)
+    red, blue = state(db, "red"), state(db, "blue")
+    db.execute("UPDATE cost SET cost = 3 WHERE i = ? AND j = ?", (red, blue))
+    # back to the original matrix, which is restored from the cache
+    db.execute("UPDATE cost SET cost = 1 WHERE i = ? AND j = ?", (red, blue))
+    assert results(db) == first
+    assert first == results(build("full.db", storage, costs=UNIT))
+    # the results did come from the cache: a marked snapshot is restored
+    db.execute("UPDATE cost SET cost = 3 WHERE i = ? AND j = ?", (red, blue))
+    db.execute("UPDATE result_cache_data SET f = 'marked' WHERE node_id = 1")
+    db.execute("UPDATE cost SET cost = 1 WHERE i = ? AND j = ?", (red, blue))
+    assert db.execute(
+        "SELECT f FROM uppass WHERE node_id = 1").fetchone() == ("marked",)
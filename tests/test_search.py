@@ -0,0 +1,39 @@
+import pytest
+from dbtree.search import search
+
+
+# groups the tips of different states together, so that moves improve it
+TREE = "((A,D),(B,F),(C,E),(G,H));"
+
+
+def check_tree(db, tips):
+    roots = db.execute(
+        "SELECT count(*) FROM node WHERE tree_id = 1 AND anc IS NULL").fetchone()
+    assert roots == (1,)
+    dangling = db.execute("""
+        SELECT count(*) FROM node AS n
+        WHERE n.tree_id = 1 AND n.anc IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM node AS a WHERE a.tree_id = n.tree_id AND a.id = n.anc)
+        """).fetchone()
+    assert dangling == (0,)
+    assert tip_labels(db) == tips
+
+
+def tip_labels(db):
+    return sorted(label for label, in db.execute("""
+        SELECT label FROM node
+        WHERE tree_id = 1 AND preorder = postorder"""))
+
+
+@pytest.mark.parametrize("radius", [None, 1])
+@pytest.mark.parametrize("engine", ["sql", "native"])
+def test_search_score_matches_written_tree(build, radius, engine):
+    db = build(tree=TREE)
+    tips = tip_labels(db)
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    first, score, moves = search(path, radius=radius, engine=engine)
+    assert moves > 0
+    assert score < first
+    assert db.execute("SELECT score FROM score WHERE tree = 1").fetchone() == (
+        score,)
+    check_tree(db, tips)
@@ -0,0 +1,35 @@
+from math import inf
+
+
+def test_blob_flush_with_no_costs(build):
+    db = build(storage="blob")
+    db.execute("UPDATE recompute SET deferred = 1")
+    db.execute("DELETE FROM cost")
+    db.execute("UPDATE recompute SET deferred = 0")
+    assert db.execute("SELECT score FROM score").fetchall() == [(inf,)]
+
+
+
+def test_empty_sparse_costs(build):
+    scores = {build(f"{storage}_{engine}.db", storage, engine, costs="",
+            sparse=True).execute("SELECT score FROM score").fetchone()
+        for storage in ("json", "blob") for engine in ("sql", "native")}
+    assert len(scores) == 1
+
+
+def test_native_json_with_disallowed_states(build):
+    # blue has no costs, so changes to and from it cost infinity
+    costs = "red,red,0\nred,green,1\ngreen,green,0\ngreen,red,1\n"
+    sql = build("sql.db", costs=costs)
+    before = sql.execute("SELECT score FROM score").fetchone()
+    sql.execute("UPDATE cost SET cost = 2 WHERE i != j")
+    after = sql.execute("SELECT score FROM score").fetchone()
+    for storage in ("json", "blob"):
+        db = build(f"{storage}.db", storage, "native", costs=costs)
+        assert db.execute("SELECT score FROM score").fetchone() == before
+        assert db.execute("""
+            SELECT count(*) FROM mpr
+            WHERE NOT json_valid(downpass) OR NOT json_valid(uppass)
+            """).fetchone() == (0,)
+        db.execute("UPDATE cost SET cost = 2 WHERE i != j")
+        assert db.execute("SELECT score FROM score").fetchone() == after